@@ -0,0 +1,121 @@
+import os
+import json
+import hashlib
+import numpy as np
+import ChordVecUtils as cvu
+import ChordTraceUtils as ctrace
+
+CACHE_DIR = 'CACHE'
+
+def corpus_hash(corpus, meters, titles):
+    """
+    Return a hex digest of the content of the ingested corpus (titles,
+    chord symbols and beats of every song)
+    """
+    h = hashlib.sha1()
+    for title, song, meter in zip(titles, corpus, meters):
+        h.update(title.encode())
+        h.update(b'\0')
+        h.update('\t'.join(song).encode())
+        h.update(b'\0')
+        h.update(np.asarray(meter, dtype=float).tobytes())
+    return h.hexdigest()
+
+def path_cache_key(chash, win_size, causal, cmpress, samples=None, embedding=None):
+    """
+    Return the cache key for one co-occurrence configuration of the
+    corpus with content hash chash, and the energy of the projection of
+    the chord vectors if they are projected (see cvu.project_rows)
+    """
+    if samples is None:
+        samples = cvu.membrane_samples()
+    h = hashlib.sha1()
+    h.update(chash.encode())
+    h.update(json.dumps([win_size, bool(causal), bool(cmpress)]).encode())
+    h.update(np.asarray(samples, dtype=float).tobytes())
+    if embedding is not None:
+        h.update(json.dumps(['embedding', embedding]).encode())
+    return h.hexdigest()[:16]
+
+def save_path_cache(path, points, titles):
+    """
+    Write the (N x S x K) path samples to path + '.npy' and the offset
+    index (song title => row of the block) to path + '.json'.  Both
+    files are written under a temporary name and renamed into place so
+    concurrent readers never see a partial cache
+    """
+    pid = str(os.getpid())
+    np.save(path + '.' + pid + '.npy', points)
+    with open(path + '.' + pid + '.json', 'w') as f:
+        json.dump({'titles': list(titles), 'shape': list(points.shape)}, f)
+    os.replace(path + '.' + pid + '.npy', path + '.npy')
+    os.replace(path + '.' + pid + '.json', path + '.json')
+
+def load_path_cache(path):
+    """
+    Return the memory-mapped path samples stored at path and the offset
+    index (a dict mapping song title to row), or (None, None) if there
+    is no cache at path
+    """
+    if not (os.path.exists(path + '.npy') and os.path.exists(path + '.json')):
+        return None, None
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    points = np.load(path + '.npy', mmap_mode='r')
+    if list(points.shape) != meta['shape']:
+        return None, None
+    offsets = {t: k for k, t in enumerate(meta['titles'])}
+    return points, offsets
+
+def cached_corpus_path_samples(corpus, meters, titles, chord_idx, M,
+                               win_size, causal, cmpress, cache_dir=CACHE_DIR,
+                               n_samples=cvu.MEMBRANE_SAMPLES, embedding=None):
+    """
+    Return the (N x S x K) path samples of the corpus as a read-only
+    memory-mapped array, computing and storing them on the first call
+    for a given corpus content, co-occurrence configuration (win_size,
+    causal, cmpress) and number of samples S.  Repeated experiments and
+    worker processes opening the same cache share its pages through
+    the OS.  If the rows of M have been projected (see
+    cvu.project_rows), embedding must be the projection energy, so that
+    projected and full paths are cached separately
+    """
+    samples = cvu.membrane_samples(n_samples)
+    key = path_cache_key(corpus_hash(corpus, meters, titles), win_size, causal, cmpress, samples, embedding)
+    path = os.path.join(cache_dir, 'paths_' + key)
+    points, offsets = load_path_cache(path)
+    if points is not None and list(offsets) == list(titles):
+        ctrace.count('path cache hits')
+        return points
+
+    ctrace.count('path cache misses')
+    os.makedirs(cache_dir, exist_ok=True)
+    points = cvu.make_corpus_path_samples(corpus, meters, chord_idx, M, samples)
+    save_path_cache(path, points, titles)
+    points, offsets = load_path_cache(path)
+    return points
+
+def cached_distance_matrix(corpus, meters, titles, chord_idx, M,
+                           win_size, causal, cmpress, cache_dir=CACHE_DIR,
+                           n_samples=cvu.MEMBRANE_SAMPLES, embedding=None, processes=1):
+    """
+    Return the (N x N) float32 matrix of membrane areas between all
+    songs of the corpus as a read-only memory-mapped array, computing
+    it from the cached path samples (see cached_corpus_path_samples)
+    with processes threads and storing it on the first call, under the
+    same key as the path samples
+    """
+    samples = cvu.membrane_samples(n_samples)
+    key = path_cache_key(corpus_hash(corpus, meters, titles), win_size, causal, cmpress, samples, embedding)
+    path = os.path.join(cache_dir, 'distances_' + key + '.npy')
+    if os.path.exists(path):
+        ctrace.count('distance cache hits')
+        return np.load(path, mmap_mode='r')
+
+    ctrace.count('distance cache misses')
+    points = cached_corpus_path_samples(corpus, meters, titles, chord_idx, M, win_size, causal, cmpress,
+                                        cache_dir, n_samples, embedding)
+    tmp = path[:-len('.npy')] + '.' + str(os.getpid()) + '.npy'
+    cvu.membrane_distance_matrix(points, out=tmp, processes=processes)
+    os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
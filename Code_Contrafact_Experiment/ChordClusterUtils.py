@@ -0,0 +1,433 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from texttable import Texttable
+import ChordVecUtils as cvu
+import ChordCorpusUtils as ccorp
+import ChordCacheUtils as ccache
+import ChordTraceUtils as ctrace
+
+# k-medoids clustering of the corpus over membrane areas, with the
+# FasterPAM swap search (Schubert and Rousseeuw, 2021).  PAM evaluates
+# every (medoid, non-medoid) swap, k times the work of one pass over
+# the candidates; FasterPAM evaluates the best swap of each candidate
+# against all medoids at once and applies it as soon as it lowers the
+# total distance.  Here the candidates are taken in batches: the gains
+# of a batch are one vectorized expression and one matrix multiply,
+# and after an applied swap the batch is resumed at the next candidate.
+#
+# The distances come from a MembraneDistances, either a precomputed
+# matrix (see ccache.cached_distance_matrix) or the path samples, from
+# which rows are computed on demand and kept in a cache.  A full pass
+# over the candidates reads every row, so on demand distances pay off
+# when the candidates per pass are sampled (as in CLARANS) or when few
+# passes are needed.
+
+KMEDOIDS_K = 8
+KMEDOIDS_BATCH = 64
+KMEDOIDS_MAX_PASSES = 100
+
+class MembraneDistances:
+    """Membrane areas between the songs of a corpus, read from a
+    precomputed (N x N) matrix or computed on demand from the (N x S x
+    K) path samples.  On demand rows are computed in one
+    cvu.membrane_distance_matrix call per request (with processes
+    threads) and the last cache_rows of them are kept
+
+    """
+
+    def __init__(self, points=None, matrix=None, cache_rows=4096, processes=1):
+        if (points is None) == (matrix is None):
+            raise ValueError('Give either the path samples or the distance matrix')
+        self.points = points
+        self.matrix = matrix
+        self.cache_rows = cache_rows
+        self.processes = processes
+        self.cache = OrderedDict()
+        self.computed = 0
+
+    @property
+    def precomputed(self):
+        return self.matrix is not None
+
+    def __len__(self):
+        return len(self.matrix if self.precomputed else self.points)
+
+    def rows(self, indices):
+        """Return the float64 distances from the songs indices to every
+        song (len(indices) x N)
+
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.precomputed:
+            return np.asarray(self.matrix[indices], dtype=float)
+        missing = [k for k in dict.fromkeys(indices.tolist()) if k not in self.cache]
+        if missing:
+            new = cvu.membrane_distance_matrix(self.points[missing], self.points, dtype=float,
+                                               processes=self.processes)
+            self.computed += len(missing)
+            ctrace.count('distance rows computed', len(missing))
+            for k, row in zip(missing, new):
+                self.cache[k] = row
+        out = np.empty((len(indices), len(self)))
+        for r, k in enumerate(indices.tolist()):
+            out[r] = self.cache[k]
+            self.cache.move_to_end(k)
+        while len(self.cache) > max(self.cache_rows, len(indices)):
+            self.cache.popitem(last=False)
+        return out
+
+    def block(self, rows, cols):
+        """Return the float64 distances between the songs rows and the
+        songs cols (len(rows) x len(cols)), without computing full rows
+
+        """
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        if self.precomputed:
+            return np.asarray(self.matrix[np.ix_(rows, cols)], dtype=float)
+        if all(k in self.cache for k in rows.tolist()):
+            return self.rows(rows)[:,cols]
+        return cvu.membrane_distance_matrix(self.points[rows], self.points[cols], dtype=float,
+                                            processes=self.processes)
+
+def build_init(dist, k):
+    """
+    Return k initial medoids chosen greedily as in the BUILD step of
+    PAM: each one is the song that lowers the total distance of all
+    songs to their nearest medoid the most.  Reads every row
+    """
+    N = len(dist)
+    total = np.zeros(N)
+    for i in range(0, N, 1024):
+        total[i:i+1024] = dist.rows(np.arange(i, min(i+1024, N))).sum(axis=1)
+    medoids = [int(np.argmin(total))]
+    nearest = dist.rows(medoids)[0]
+    for _ in range(1, k):
+        gain = np.zeros(N)
+        for i in range(0, N, 1024):
+            gain[i:i+1024] = np.maximum(nearest - dist.rows(np.arange(i, min(i+1024, N))), 0).sum(axis=1)
+        gain[medoids] = -1
+        medoids.append(int(np.argmax(gain)))
+        nearest = np.minimum(nearest, dist.rows(medoids[-1:])[0])
+    return np.array(medoids)
+
+def lab_init(dist, k, rng):
+    """
+    Return k initial medoids chosen by the linear approximative BUILD
+    of FasterPAM: BUILD with the candidates and the songs they are
+    evaluated on drawn afresh, 10 + sqrt(N) of each, at every step.
+    Reads only (10 + sqrt(N))^2 distances per medoid
+    """
+    N = len(dist)
+    m = min(N, 10 + int(np.ceil(np.sqrt(N))))
+    medoids = []
+    for _ in range(k):
+        points = rng.choice(N, m, replace=False)
+        free = np.setdiff1d(np.arange(N), medoids)
+        candidates = rng.choice(free, min(m, len(free)), replace=False)
+        D = dist.block(candidates, points)
+        if medoids:
+            nearest = dist.block(medoids, points).min(axis=0)
+            cost = np.minimum(D, nearest).sum(axis=1)
+        else:
+            cost = D.sum(axis=1)
+        medoids.append(int(candidates[np.argmin(cost)]))
+    return np.array(medoids)
+
+def nearest_medoids(medoid_rows):
+    """
+    Return, for every song, the index (into the medoids) of its nearest
+    medoid, the distance to it and the distance to the second nearest,
+    given the (k x N) distances from the medoids
+    """
+    order = np.argsort(medoid_rows, axis=0, kind='stable')[:2]
+    cols = np.arange(medoid_rows.shape[1])
+    return order[0], medoid_rows[order[0], cols], medoid_rows[order[1], cols]
+
+def swap_gains(rows, nearest, d_nearest, d_second, removal_loss):
+    """
+    Return the change of total distance of the best swap of each
+    candidate (one per row of rows, its distances to every song) and
+    the medoid it would replace.  As in FasterPAM the change of
+    swapping medoid m for candidate c is
+
+      removal_loss[m] + sum over songs o of min(d(o,c) - dn(o), 0)
+                      + sum over songs o of medoid m of v(o, c)
+
+    with v(o,c) = dn(o) - ds(o) if c is closer to o than its nearest
+    medoid, d(o,c) - ds(o) if it is only closer than the second nearest
+    and 0 otherwise
+    """
+    k = len(removal_loss)
+    closer = rows < d_nearest
+    v = np.where(closer, d_nearest - d_second, np.minimum(rows - d_second, 0))
+    shared = np.minimum(rows - d_nearest, 0).sum(axis=1)
+    onehot = np.zeros((len(nearest), k))
+    onehot[np.arange(len(nearest)), nearest] = 1
+    delta = v @ onehot + removal_loss
+    best = np.argmin(delta, axis=1)
+    return delta[np.arange(len(rows)), best] + shared, best
+
+@ctrace.traced()
+def fasterpam(dist, k=KMEDOIDS_K, init='build', max_passes=KMEDOIDS_MAX_PASSES, candidates=None,
+              batch=KMEDOIDS_BATCH, seed=0):
+    """
+    Cluster the songs of dist (a MembraneDistances) around k medoids
+    with FasterPAM, starting from init ('build', 'lab', 'random' or an
+    array of medoids).  Every pass takes the non-medoids in a fixed
+    random order (or, if candidates is given, that many of them drawn
+    afresh each pass) and applies each improving swap as soon as it is
+    found.  The search stops after a pass without swaps, a local
+    optimum of the total distance if all candidates are taken.
+
+    Returns the medoids, the label of every song (the index of its
+    medoid), and a report dict with the total distance (loss), the
+    nearest and second nearest medoid distances of every song, the
+    numbers of passes and swaps and the seconds it took
+    """
+    t0 = time.perf_counter()
+    N = len(dist)
+    if not 2 <= k < N:
+        raise ValueError('k must be at least 2 and less than the number of songs')
+    rng = np.random.default_rng(seed)
+    if isinstance(init, str):
+        if init == 'build':
+            medoids = build_init(dist, k)
+        elif init == 'lab':
+            medoids = lab_init(dist, k, rng)
+        elif init == 'random':
+            medoids = rng.choice(N, k, replace=False)
+        else:
+            raise ValueError('Unknown initialization ' + init)
+    else:
+        medoids = np.asarray(init)
+    medoids = np.array(medoids, dtype=np.int64)
+    init_seconds = time.perf_counter() - t0
+
+    medoid_rows = dist.rows(medoids)
+    nearest, d_nearest, d_second = nearest_medoids(medoid_rows)
+    removal_loss = np.bincount(nearest, d_second - d_nearest, minlength=k)
+    is_medoid = np.zeros(N, dtype=bool)
+    is_medoid[medoids] = True
+    order = rng.permutation(N)
+    tol = 1e-9*d_nearest.sum()
+
+    swaps = passes = 0
+    while passes < max_passes:
+        passes += 1
+        swapped = False
+        if candidates is not None:
+            order = rng.choice(N, min(candidates, N), replace=False)
+        start = 0
+        while start < len(order):
+            chunk = order[start:start+batch]
+            free = np.flatnonzero(~is_medoid[chunk])
+            if not len(free):
+                start += len(chunk)
+                continue
+            rows = dist.rows(chunk[free])
+            gains, best = swap_gains(rows, nearest, d_nearest, d_second, removal_loss)
+            hits = np.flatnonzero(gains < -tol)
+            if not len(hits):
+                start += len(chunk)
+                continue
+
+            # Apply the first improving swap and resume after it
+            h = hits[0]
+            m, c = best[h], chunk[free[h]]
+            is_medoid[medoids[m]], is_medoid[c] = False, True
+            medoids[m] = c
+            medoid_rows[m] = rows[h]
+            nearest, d_nearest, d_second = nearest_medoids(medoid_rows)
+            removal_loss = np.bincount(nearest, d_second - d_nearest, minlength=k)
+            swaps += 1
+            swapped = True
+            start += free[h] + 1
+        if not swapped:
+            break
+
+    ctrace.count('kmedoids swaps', swaps)
+    report = {'k': k, 'loss': float(d_nearest.sum()), 'passes': passes, 'swaps': swaps,
+              'd_nearest': d_nearest, 'd_second': d_second,
+              'init_seconds': init_seconds, 'seconds': time.perf_counter() - t0}
+    return medoids, nearest, report
+
+def silhouettes(dist, labels, k=None, batch=1024):
+    """
+    Return the silhouette of every song: (b - a)/max(a, b) with a the
+    mean distance to the other songs of its cluster and b the smallest
+    mean distance to the songs of another cluster (0 for songs alone in
+    their cluster).  Reads every row of dist
+    """
+    N = len(labels)
+    if k is None:
+        k = int(labels.max()) + 1
+    onehot = np.zeros((N, k))
+    onehot[np.arange(N), labels] = 1
+    sizes = onehot.sum(axis=0)
+    s = np.zeros(N)
+    for i in range(0, N, batch):
+        idx = np.arange(i, min(i+batch, N))
+        sums = dist.rows(idx) @ onehot
+        own = labels[idx]
+        a = sums[np.arange(len(idx)), own]/np.maximum(sizes[own] - 1, 1)
+        sums /= np.maximum(sizes, 1)
+        sums[np.arange(len(idx)), own] = np.inf
+        sums[:, sizes == 0] = np.inf
+        b = sums.min(axis=1)
+        s[idx] = np.where(sizes[own] > 1, (b - a)/np.maximum(np.maximum(a, b), 1e-300), 0)
+    return s
+
+def medoid_silhouettes(d_nearest, d_second):
+    """
+    Return the medoid silhouette of every song, 1 - dn/ds with dn and
+    ds the distances to its nearest and second nearest medoids (1 for
+    the medoids themselves): an approximation of the silhouette that
+    needs only the k distances to the medoids
+    """
+    return 1 - d_nearest/np.maximum(d_second, 1e-300)
+
+def cluster_corpus(dist, ks, init='build', candidates=None, exact_silhouette=None, seed=0, processes=1):
+    """
+    Cluster the corpus with FasterPAM for every number of clusters in
+    ks and return one result dict per k: the medoids, labels and report
+    of fasterpam, with the per-song medoid silhouettes and, if
+    exact_silhouette (by default when the distances are precomputed),
+    the per-song silhouettes.  The values of k are spread across a pool
+    of processes (forked, so a precomputed matrix is shared)
+    """
+    if exact_silhouette is None:
+        exact_silhouette = dist.precomputed
+    _cluster_state.update({'dist': dist, 'init': init, 'candidates': candidates,
+                           'exact_silhouette': exact_silhouette, 'seed': seed})
+    ks = list(ks)
+    # Spawned workers would not see _cluster_state: run inline without fork
+    if processes == 1 or len(ks) == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return list(map(_cluster_k, ks))
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(min(processes, len(ks))) as pool:
+        return pool.map(_cluster_k, ks)
+
+# State shared with forked clustering workers
+_cluster_state = {}
+
+def _cluster_k(k):
+    """Cluster the corpus around k medoids, with silhouettes
+
+    """
+    state = _cluster_state
+    dist = state['dist']
+    medoids, labels, report = fasterpam(dist, k, state['init'], candidates=state['candidates'], seed=state['seed'])
+    result = {'k': k, 'medoids': medoids, 'labels': labels, 'report': report,
+              'medoid_silhouettes': medoid_silhouettes(report['d_nearest'], report['d_second'])}
+    if state['exact_silhouette']:
+        t0 = time.perf_counter()
+        result['silhouettes'] = silhouettes(dist, labels, k)
+        report['silhouette_seconds'] = time.perf_counter() - t0
+    return result
+
+def cluster_sizes_table(results):
+    """
+    Return the comparison table of clusterings of several k (loss, mean
+    silhouette and medoid silhouette, passes, swaps and seconds) as a
+    string
+    """
+    t = Texttable()
+    t.set_deco(Texttable.BORDER | Texttable.HEADER | Texttable.VLINES)
+    t.set_cols_align(['r', 'r', 'r', 'r', 'r', 'r', 'r'])
+    t.set_cols_dtype(['i', 'f', 't', 'f', 'i', 'i', 'f'])
+    t.set_precision(3)
+    t.add_row(['k', 'loss', 'silhouette', 'medoid silhouette', 'passes', 'swaps', 'seconds'])
+    for r in results:
+        s = '{:.3f}'.format(r['silhouettes'].mean()) if 'silhouettes' in r else '-'
+        t.add_row([r['k'], r['report']['loss'], s, r['medoid_silhouettes'].mean(),
+                   r['report']['passes'], r['report']['swaps'], r['report']['seconds']])
+    return t.draw()
+
+def cluster_table(result, titles, songs=None, members=5):
+    """
+    Return the table of the clusters of one clustering (see
+    cluster_corpus) as a string: the medoid of each cluster (with its
+    SongDB title if songs, the store metadata, is given), its size, its
+    mean silhouette and the members closest to the medoid
+    """
+    labels, medoids = result['labels'], result['medoids']
+    d_nearest = result['report']['d_nearest']
+    sil = result.get('silhouettes', result['medoid_silhouettes'])
+    t = Texttable()
+    t.set_deco(Texttable.HEADER)
+    t.set_cols_dtype(['i', 't', 'i', 'f', 't'])
+    t.set_cols_align(['r', 'l', 'r', 'r', 'l'])
+    t.set_precision(3)
+    t.add_row(['cluster', 'medoid', 'songs', 'silhouette', 'closest members'])
+    for c in np.argsort(-np.bincount(labels, minlength=len(medoids)), kind='stable'):
+        idx = np.flatnonzero(labels == c)
+        idx = idx[np.argsort(d_nearest[idx], kind='stable')]
+        name = songs[medoids[c]]['title'] if songs is not None else titles[medoids[c]]
+        closest = [titles[i].split('.')[0] for i in idx if i != medoids[c]][:members]
+        t.add_row([c+1, name, len(idx), sil[idx].mean(), ', '.join(closest)])
+    return t.draw()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='k-medoids clustering of the corpus over membrane areas')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('cluster', help='cluster the corpus with FasterPAM and report silhouettes')
+    p.add_argument('-k', type=int, nargs='+', default=[KMEDOIDS_K], help='numbers of clusters')
+    p.add_argument('--lazy', action='store_true',
+                   help='compute distance rows on demand instead of the cached distance matrix')
+    p.add_argument('--init', default=None, choices=['build', 'lab', 'random'],
+                   help='initial medoids (default: build, or lab with --lazy)')
+    p.add_argument('--candidates', type=int, default=None, help='swap candidates drawn per pass (default: all songs)')
+    p.add_argument('--exact-silhouette', action='store_true', help='compute silhouettes with --lazy too')
+    p.add_argument('--processes', type=int, default=None)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--win-size', type=int, default=1)
+    p.add_argument('--output', default=None, help='also write the assignments, medoids and silhouettes to this JSON file')
+    p.add_argument('songdb_paths', nargs='*', default=ccorp.SONGDB_PATHS)
+    args = parser.parse_args()
+
+    if args.command == 'cluster':
+        processes = args.processes or os.cpu_count()
+        romans, meters, titles, timings = ccorp.ingest_corpus(args.songdb_paths)
+        corpus = cvu.Corpus.from_lists(romans, meters, titles)
+        M, chord_idx = cvu.co_occurrence_matrix(corpus, args.win_size, compressed=True, dense=True)
+        M = cvu.normalize_rows(M)
+        t0 = time.perf_counter()
+        if args.lazy:
+            points = ccache.cached_corpus_path_samples(romans, meters, titles, chord_idx, M,
+                                                       args.win_size, False, True)
+            dist = MembraneDistances(points=points, processes=processes)
+        else:
+            matrix = ccache.cached_distance_matrix(romans, meters, titles, chord_idx, M,
+                                                   args.win_size, False, True, processes=processes)
+            dist = MembraneDistances(matrix=matrix)
+        sys.stderr.write('Distances ready in {:.2f} s\n'.format(time.perf_counter() - t0))
+        init = args.init or ('lab' if args.lazy else 'build')
+        results = cluster_corpus(dist, args.k, init, args.candidates,
+                                 args.exact_silhouette or not args.lazy, args.seed,
+                                 1 if args.lazy else processes)
+
+        store = ccorp.open_corpus_store(args.songdb_paths)
+        for r in results:
+            print('k = {}'.format(r['k']))
+            print(cluster_table(r, titles, store.songs))
+            print()
+        print(cluster_sizes_table(results))
+        if args.output:
+            out = []
+            for r in results:
+                entry = {'k': r['k'], 'loss': r['report']['loss'],
+                         'medoids': [titles[m] for m in r['medoids']],
+                         'assignments': {titles[i]: titles[r['medoids'][c]] for i, c in enumerate(r['labels'])},
+                         'medoid_silhouettes': dict(zip(titles, r['medoid_silhouettes'].tolist()))}
+                if 'silhouettes' in r:
+                    entry['silhouettes'] = dict(zip(titles, r['silhouettes'].tolist()))
+                    entry['silhouette'] = float(r['silhouettes'].mean())
+                out.append(entry)
+            with open(args.output, 'w') as f:
+                json.dump(out, f, indent=1)
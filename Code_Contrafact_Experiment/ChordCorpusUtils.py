@@ -0,0 +1,567 @@
+import os
+import re
+import sys
+import time
+import json
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+from ChordProgUtils import getsong, estimatekeys, rank_keys, map2roman, get_beats, strip_bars, chord_table, set_chord_table, check_lemmatizer
+from ChordCacheUtils import CACHE_DIR
+import ChordTraceUtils as ctrace
+
+SONGDB_PATHS = ['../SongDB/Songs[#,A-G]', '../SongDB/Songs[H-O]', '../SongDB/Songs[P-Z]']
+CORPUS_STORE = os.path.join(CACHE_DIR, 'corpus.bin')
+STORE_MAGIC = b'JCPCORP1'
+SONG_INDEX = os.path.join(CACHE_DIR, 'song_index.npz')
+
+def list_songdb(songdb_paths=SONGDB_PATHS):
+    """
+    Return the list of song file paths in the SongDB subdirectories, in
+    the order used by the experiments (subdirectory, then os.listdir)
+    """
+    return [sdb+'/'+f for sdb in songdb_paths for f in os.listdir(sdb)]
+
+def songdb_hash(files):
+    """
+    Return a hex digest of the content of the song files: their paths
+    and bytes.  Any edit, addition, removal or reordering of files
+    changes the digest, even if it keeps the file sizes and
+    modification times
+    """
+    h = hashlib.sha1()
+    for f in files:
+        h.update(f.encode())
+        h.update(b'\0')
+        with open(f, 'rb') as fp:
+            data = fp.read()
+        h.update(str(len(data)).encode())
+        h.update(b'\0')
+        h.update(data)
+    return h.hexdigest()
+
+def songdb_stat(files):
+    """
+    Return a hex digest of the file system state of the song files:
+    their paths, sizes, modification and change times and inodes.  It
+    is cheap to compute, and any write to a file changes its change
+    time, so songdb_hash only needs rereading when this digest changes
+    """
+    h = hashlib.sha1()
+    for f in files:
+        st = os.stat(f)
+        h.update(f.encode())
+        h.update(b'\0')
+        h.update(str((st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def compile_corpus(files, path=CORPUS_STORE):
+    """
+    Parse every song file with getsong and write the corpus to a single
+    binary store at path.  The store holds a JSON header (source hash
+    and stat digest, chord vocabulary, per-song metadata, array layout) followed by
+    8-byte aligned arrays:
+
+      tokens       int32  interned chord ids of all songs, without bars
+      bar_offsets  int64  start of each bar in tokens (CSR style)
+      song_bars    int64  start of each song in bar_offsets (CSR style)
+    """
+    vocab = {}
+    tokens = []
+    bar_offsets = [0]
+    song_bars = [0]
+    songs = []
+    for f in files:
+        title, composedby, dbkeysig, timesig, nbars, prog = getsong(f)
+        for c in prog:
+            if c == '|':
+                bar_offsets.append(len(tokens))
+            else:
+                tokens.append(vocab.setdefault(c, len(vocab)))
+        bar_offsets.append(len(tokens))
+        song_bars.append(len(bar_offsets)-1)
+        songs.append({'file': os.path.basename(f), 'title': title, 'composer': composedby,
+                      'key': dbkeysig, 'timesig': timesig, 'bars': nbars})
+
+    arrays = {'tokens': np.array(tokens, dtype=np.int32),
+              'bar_offsets': np.array(bar_offsets, dtype=np.int64),
+              'song_bars': np.array(song_bars, dtype=np.int64)}
+    header = {'source_hash': songdb_hash(files), 'source_stat': songdb_stat(files), 'vocab': list(vocab), 'songs': songs, 'arrays': {}}
+
+    # The array offsets depend on the header length, which depends on
+    # the offsets, so lay the arrays out relative to the end of the
+    # header and fix the header size up front
+    offset = 0
+    for name, a in arrays.items():
+        header['arrays'][name] = [a.dtype.str, len(a), offset]
+        offset += -(-a.nbytes//8)*8
+    hbytes = json.dumps(header).encode()
+    hbytes += b' '*(-(len(hbytes)+16) % 8)
+    base = 16 + len(hbytes)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.' + str(os.getpid())
+    with open(tmp, 'wb') as fh:
+        fh.write(STORE_MAGIC)
+        fh.write(np.uint64(len(hbytes)).tobytes())
+        fh.write(hbytes)
+        for name, a in arrays.items():
+            fh.seek(base + header['arrays'][name][2])
+            fh.write(a.tobytes())
+        fh.truncate(base + offset)
+    os.replace(tmp, path)
+
+class CorpusStore:
+    """A compiled corpus store opened with a single memory map.  Song k
+    is returned by getsong(k) as the same tuple that
+    ChordProgUtils.getsong returns for its file
+
+    """
+
+    def __init__(self, path=CORPUS_STORE):
+        with open(path, 'rb') as fh:
+            if fh.read(8) != STORE_MAGIC:
+                raise ValueError(path + ' is not a compiled corpus store')
+            hlen = int(np.frombuffer(fh.read(8), dtype=np.uint64)[0])
+            header = json.loads(fh.read(hlen))
+        self.path = path
+        self.source_hash = header['source_hash']
+        self.source_stat = header.get('source_stat')
+        self.vocab = header['vocab']
+        self.songs = header['songs']
+        self.files = [s['file'] for s in self.songs]
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+        base = 16 + hlen
+        for name, (dtype, n, offset) in header['arrays'].items():
+            a = np.frombuffer(buf, dtype=dtype, count=n, offset=base+offset)
+            setattr(self, name, a)
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.files[k], self.getsong(k)
+
+    def progression(self, k):
+        """Return the progression of song k (chords and bar symbols)
+
+        """
+        b0, b1 = self.song_bars[k], self.song_bars[k+1]
+        bounds = self.bar_offsets[b0:b1+1].tolist()
+        chords = [self.vocab[t] for t in self.tokens[bounds[0]:bounds[-1]].tolist()]
+        prog = []
+        for j in range(len(bounds)-1):
+            if j > 0:
+                prog.append('|')
+            prog += chords[bounds[j]-bounds[0]:bounds[j+1]-bounds[0]]
+        return prog
+
+    def getsong(self, k):
+        """Return (title, composedby, dbkeysig, timesig, nbars, prog) for
+        song k
+
+        """
+        s = self.songs[k]
+        return s['title'], s['composer'], s['key'], list(s['timesig']), s['bars'], self.progression(k)
+
+def restat_corpus_store(path, source_stat):
+    """
+    Record a new stat digest (see songdb_stat) in the header of the
+    store at path, in place.  Returns False if the header has no room
+    for it (stores compiled before the digest was recorded)
+    """
+    with open(path, 'r+b') as fh:
+        fh.seek(8)
+        hlen = int(np.frombuffer(fh.read(8), dtype=np.uint64)[0])
+        header = json.loads(fh.read(hlen))
+        header['source_stat'] = source_stat
+        hbytes = json.dumps(header).encode()
+        if len(hbytes) > hlen:
+            return False
+        fh.seek(16)
+        fh.write(hbytes + b' '*(hlen - len(hbytes)))
+    return True
+
+def open_corpus_store(songdb_paths=SONGDB_PATHS, path=CORPUS_STORE):
+    """
+    Return the CorpusStore for the songs in songdb_paths, compiling it
+    first if it does not exist or if any song file has changed since it
+    was compiled.  The song files are only read (to compare their
+    content hash) when their stat digest differs from the store's, and
+    a store whose songs were merely touched or checked out again is
+    kept, with its stat digest updated
+    """
+    files = list_songdb(songdb_paths)
+    if os.path.exists(path):
+        store = CorpusStore(path)
+        stat = songdb_stat(files)
+        if store.source_stat == stat:
+            return store
+        if store.source_hash == songdb_hash(files) and restat_corpus_store(path, stat):
+            return CorpusStore(path)
+    compile_corpus(files, path)
+    return CorpusStore(path)
+
+def metadata_words(text):
+    """
+    Return the lowercase words of a title, composer or file name:
+    camel case is split (OnGreenDolphinStreet.txt), apostrophes are
+    dropped (It's) and anything else that is not a letter or digit
+    separates words
+    """
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', os.path.splitext(text)[0] if text.endswith('.txt') else text)
+    return re.findall(r'[a-z0-9]+', text.replace("'", '').lower())
+
+def word_trigrams(word):
+    """
+    Return the set of trigrams of a word padded with '$' at both ends
+    """
+    padded = '$' + word + '$'
+    return {padded[i:i+3] for i in range(max(1, len(padded)-2))}
+
+class SongIndex:
+    """Metadata index of the songs of a corpus store: file, SongDB path,
+    title, composer, key, time signature and bar count of every song,
+    with a word and trigram index for fuzzy title and composer search.
+
+    Titles (with the words of the file name) and composers are split
+    into words (see metadata_words).  Each query word scores every
+    indexed word: 1 if equal, PREFIX_SCORE if it is a prefix of it, and
+    otherwise the Dice coefficient of their trigram sets, counted from
+    the trigram posting lists.  A song scores, for each query word, the
+    best of its words in the searched fields (composer words weighted
+    by FIELD_WEIGHTS, so that title matches rank first), and its score is the mean
+    over the query words, so a query matches best the songs containing
+    all of its words.  The index is built from the store's header and
+    saved with np.savez, keyed by the store's source hash.
+
+    """
+
+    PREFIX_SCORE = 0.9
+    FIELDS = ('title', 'composer')
+    FIELD_WEIGHTS = {'title': 1.0, 'composer': 0.9}
+
+    def __init__(self, songs, paths, source_hash, words, gram_keys, gram_starts, gram_postings,
+                 word_grams, fields, exact):
+        self.songs = songs
+        self.paths = list(paths)
+        self.source_hash = source_hash
+        self.words = list(words)
+        self.word_array = np.array(self.words)
+        self.word_idx = {w: i for i, w in enumerate(self.words)}
+        self.gram_idx = {g: i for i, g in enumerate(gram_keys)}
+        self.gram_starts = np.asarray(gram_starts)
+        self.gram_postings = np.asarray(gram_postings)
+        self.word_grams = np.asarray(word_grams)
+        self.fields = fields
+        self.exact = exact
+
+    @classmethod
+    def build(cls, store, paths=None):
+        """Build the index of a CorpusStore, whose songs were compiled
+        from the files at paths (their basenames if None)
+
+        """
+        songs = store.songs
+        song_words = {f: [] for f in cls.FIELDS}
+        for s in songs:
+            song_words['title'].append(set(metadata_words(s['title']) + metadata_words(s['file'])))
+            song_words['composer'].append(set(metadata_words(s['composer'])))
+        words = sorted(set().union(*song_words['title'], *song_words['composer']))
+        word_idx = {w: i for i, w in enumerate(words)}
+
+        grams = [sorted(word_trigrams(w)) for w in words]
+        gram_keys = sorted(set().union(*grams))
+        gram_idx = {g: i for i, g in enumerate(gram_keys)}
+        pairs = np.array([(gram_idx[g], i) for i, gs in enumerate(grams) for g in gs], dtype=np.int64)
+        order = np.lexsort((pairs[:,1], pairs[:,0]))
+        gram_starts = np.searchsorted(pairs[order,0], np.arange(len(gram_keys)+1))
+        gram_postings = pairs[order,1].astype(np.int32)
+        word_grams = np.array([len(gs) for gs in grams], dtype=np.int32)
+
+        fields = {}
+        for f in cls.FIELDS:
+            ids = [sorted(word_idx[w] for w in ws) for ws in song_words[f]]
+            offsets = np.zeros(len(ids)+1, dtype=np.int64)
+            np.cumsum([len(w) for w in ids], out=offsets[1:])
+            fields[f] = (np.array([i for w in ids for i in w], dtype=np.int32), offsets)
+        # Normalized titles and file names, resolved to their first song
+        exact = {}
+        for k in reversed(range(len(songs))):
+            for name in (songs[k]['title'], songs[k]['file']):
+                exact[' '.join(metadata_words(name))] = k
+        return cls(songs, paths or store.files, store.source_hash, words, gram_keys, gram_starts,
+                   gram_postings, word_grams, fields, exact)
+
+    def save(self, path):
+        """Save the index to path, a .npz file
+
+        """
+        tmp = path + '.' + str(os.getpid()) + '.npz'
+        arrays = {f + '_' + name: a for f, pair in self.fields.items() for name, a in zip(('words', 'offsets'), pair)}
+        np.savez(tmp, meta=np.array(json.dumps({'songs': self.songs, 'paths': self.paths,
+                                               'source_hash': self.source_hash, 'exact': self.exact})),
+                 words=np.array(self.words), gram_keys=np.array(list(self.gram_idx)),
+                 gram_starts=self.gram_starts, gram_postings=self.gram_postings,
+                 word_grams=self.word_grams, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with save
+
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            fields = {f: (data[f + '_words'], data[f + '_offsets']) for f in cls.FIELDS}
+            return cls(meta['songs'], meta['paths'], meta['source_hash'], data['words'].tolist(),
+                       data['gram_keys'].tolist(), data['gram_starts'], data['gram_postings'],
+                       data['word_grams'], fields, meta['exact'])
+
+    @classmethod
+    def open(cls, songdb_paths=SONGDB_PATHS, path=SONG_INDEX):
+        """Load the index saved at path if it was built from the current
+        corpus store of songdb_paths, otherwise build it and save it there
+
+        """
+        store = open_corpus_store(songdb_paths)
+        if os.path.exists(path):
+            index = cls.load(path)
+            if index.source_hash == store.source_hash:
+                return index
+        files = list_songdb(songdb_paths)
+        index = cls.build(store, files if [os.path.basename(f) for f in files] == store.files else None)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        index.save(path)
+        return index
+
+    def __len__(self):
+        return len(self.songs)
+
+    def song(self, k):
+        """Return the metadata of song k as a dict
+
+        """
+        meta = dict(self.songs[k])
+        meta['path'] = self.paths[k]
+        return meta
+
+    def word_scores(self, word):
+        """Return the score of every indexed word for the query word
+
+        """
+        scores = np.zeros(len(self.words))
+        grams = [self.gram_idx[g] for g in word_trigrams(word) if g in self.gram_idx]
+        if grams:
+            hits = np.concatenate([self.gram_postings[self.gram_starts[g]:self.gram_starts[g+1]] for g in grams])
+            shared = np.bincount(hits, minlength=len(self.words))
+            scores = 2*shared/(len(word_trigrams(word)) + self.word_grams)
+        lo = np.searchsorted(self.word_array, word)
+        hi = np.searchsorted(self.word_array, word + '\uffff')
+        scores[lo:hi] = np.maximum(scores[lo:hi], self.PREFIX_SCORE)
+        if word in self.word_idx:
+            scores[self.word_idx[word]] = 1.0
+        return scores
+
+    def scores(self, query, fields=FIELDS):
+        """Return the score of every song for the query string, searching
+        the given fields, and the coverage of every song's words in the
+        first field (the mean over them of their best score for a query
+        word), which ranks 'Summertime' above 'Once Upon A Summertime'
+
+        """
+        words = metadata_words(query)
+        total = np.zeros(len(self.songs))
+        matched = np.zeros(len(self.words))
+        for word in words:
+            scores = self.word_scores(word)
+            matched = np.maximum(matched, scores)
+            best = np.zeros(len(self.songs))
+            for f in fields:
+                ids, offsets = self.fields[f]
+                nonempty = np.flatnonzero(np.diff(offsets) > 0)
+                if len(nonempty):
+                    field_best = self.FIELD_WEIGHTS[f]*np.maximum.reduceat(scores[ids], offsets[nonempty])
+                    best[nonempty] = np.maximum(best[nonempty], field_best)
+            total += best
+
+        ids, offsets = self.fields[fields[0]]
+        coverage = np.zeros(len(self.songs))
+        nonempty = np.flatnonzero(np.diff(offsets) > 0)
+        if len(nonempty):
+            coverage[nonempty] = np.add.reduceat(matched[ids], offsets[nonempty])/np.diff(offsets)[nonempty]
+        return total/max(1, len(words)), coverage
+
+    def search(self, query, k=10, fields=FIELDS, min_score=0.3):
+        """Return up to k (song index, score) pairs for the query, best
+        first (ties broken by coverage, then corpus order), with scores
+        of at least min_score
+
+        """
+        scores, coverage = self.scores(query, fields)
+        order = np.lexsort((np.arange(len(scores)), -coverage, -scores))[:k]
+        return [(int(j), float(scores[j])) for j in order if scores[j] >= min_score]
+
+    def lookup(self, titles, fields=('title',), min_score=0.5):
+        """Return the index of the song best matching each of titles (a
+        title or file name), or None if no song scores at least
+        min_score.  Exact matches of the normalized title or file name
+        are resolved with a dict, without searching
+
+        """
+        result = []
+        for title in titles:
+            k = self.exact.get(' '.join(metadata_words(title)))
+            if k is None:
+                best = self.search(title, 1, fields, min_score)
+                k = best[0][0] if best else None
+            result.append(k)
+        return result
+
+INGEST_STAGES = ('getsong', 'estimatekey', 'map2roman', 'get_beats', 'strip_bars')
+
+def ingest_songs(store, indices, timings):
+    """
+    Convert the songs of the store with the given indices to roman
+    numeral notation and return a list of their roman numeral
+    progressions (with <START> and <END> tags) and beats.  Keys are
+    estimated for all of the songs in one batch, and the lemmatized
+    progressions are reused by map2roman.  The time spent in each stage
+    is added to timings
+    """
+    t0 = time.perf_counter()
+    songs = [store.getsong(k) for k in indices]
+    t1 = time.perf_counter()
+    key_scores, lemmas = estimatekeys([song[3][0] for song in songs], [song[5] for song in songs])
+    bestkeys = [rank_keys(row)[0][0] for row in key_scores]
+    t2 = time.perf_counter()
+    roman_progs = [map2roman(bestkey, song[5], lemma) for bestkey, song, lemma in zip(bestkeys, songs, lemmas)]
+    t3 = time.perf_counter()
+    beats = [get_beats(song[3], roman_prog) for song, roman_prog in zip(songs, roman_progs)]
+    t4 = time.perf_counter()
+    romans = [['<START>'] + strip_bars(roman_prog) + ['<END>'] for roman_prog in roman_progs]
+    t5 = time.perf_counter()
+    for stage, dt in zip(INGEST_STAGES, (t1-t0, t2-t1, t3-t2, t4-t3, t5-t4)):
+        timings[stage] += dt
+    return [(roman, [0] + b + [0]) for roman, b in zip(romans, beats)]
+
+_worker_stores = {}
+
+def _ingest_chunk(args):
+    """Pool worker: ingest the songs [start, stop) of the store at path
+
+    """
+    path, start, stop = args
+    if path not in _worker_stores:
+        _worker_stores[path] = CorpusStore(path)
+    store = _worker_stores[path]
+    timings = dict.fromkeys(INGEST_STAGES, 0.0)
+    songs = ingest_songs(store, range(start, stop), timings)
+    return songs, timings
+
+@ctrace.traced()
+def ingest_corpus(songdb_paths=SONGDB_PATHS, processes=None, chunksize=64, progress=False):
+    """
+    Ingest the corpus: every song is read from the compiled store and
+    run through getsong -> estimatekeys -> map2roman -> get_beats ->
+    strip_bars.  Chunks of songs are spread across a pool of forked
+    processes (all cores if processes is None, inline if it is 1 or
+    fork is unavailable) and the results are assembled in corpus order,
+    so the output does not depend on the number of processes.  Returns corpus_romans, corpus_meters,
+    corpus_titles and a dict of the total time spent in each stage
+    (summed over workers), plus the wall time under 'total'
+    """
+    t0 = time.perf_counter()
+    store = open_corpus_store(songdb_paths)
+    N = len(store)
+    if processes is None:
+        processes = os.cpu_count()
+    # The workers are forked: the experiment scripts run at module
+    # level and must not be re-imported by spawned workers, so the
+    # songs are ingested inline where fork is unavailable (Windows)
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+    chunks = [(store.path, k, min(k+chunksize, N)) for k in range(0, N, chunksize)]
+
+    if processes == 1:
+        results = map(_ingest_chunk, chunks)
+        pool = None
+    else:
+        ctx = multiprocessing.get_context('fork')
+
+        # Parse the corpus chord symbols once here and hand the table to
+        # the workers, so they do not each re-parse them
+        table = chord_table()
+        table.intern(store.vocab)
+        pool = ctx.Pool(processes, initializer=set_chord_table, initargs=(table,))
+        results = pool.imap(_ingest_chunk, chunks)
+
+    corpus_romans = []
+    corpus_meters = []
+    timings = dict.fromkeys(INGEST_STAGES, 0.0)
+    try:
+        for songs, chunk_timings in results:
+            for roman, meter in songs:
+                corpus_romans.append(roman)
+                corpus_meters.append(meter)
+            for stage in INGEST_STAGES:
+                timings[stage] += chunk_timings[stage]
+            if progress:
+                sys.stderr.write('\rIngested {}/{} songs'.format(len(corpus_romans), N))
+                sys.stderr.flush()
+    finally:
+        # All results are in (or a chunk failed): stop the workers
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if progress:
+        sys.stderr.write('\n')
+
+    timings['total'] = time.perf_counter() - t0
+    # Worker processes are not traced, so add their stage timings here
+    for stage in INGEST_STAGES:
+        ctrace.add_time('ingest.' + stage, timings[stage])
+    ctrace.count('songs ingested', N)
+    return corpus_romans, corpus_meters, list(store.files), timings
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Jazz chord progression corpus utilities')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('compile-corpus', help='compile SongDB into a binary corpus store')
+    p.add_argument('--output', default=CORPUS_STORE)
+    p.add_argument('songdb_paths', nargs='*', default=SONGDB_PATHS)
+    p = subparsers.add_parser('check-lemmatizer', help='check lemmatize_batch against lemmatize on the corpus')
+    p.add_argument('songdb_paths', nargs='*', default=SONGDB_PATHS)
+    p = subparsers.add_parser('find', help='search the song titles and composers')
+    p.add_argument('-k', type=int, default=10)
+    p.add_argument('query')
+    p.add_argument('songdb_paths', nargs='*', default=SONGDB_PATHS)
+    p = subparsers.add_parser('ingest', help='ingest the corpus and report per-stage timings')
+    p.add_argument('--processes', type=int, default=None)
+    p.add_argument('songdb_paths', nargs='*', default=SONGDB_PATHS)
+    args = parser.parse_args()
+
+    if args.command == 'compile-corpus':
+        files = list_songdb(args.songdb_paths)
+        compile_corpus(files, args.output)
+        print('Compiled', len(files), 'songs to', args.output)
+    elif args.command == 'check-lemmatizer':
+        store = open_corpus_store(args.songdb_paths)
+        bad = check_lemmatizer([store.progression(k) for k in range(len(store))])
+        for k in bad:
+            print('Mismatch:', store.files[k])
+        print(len(store) - len(bad), 'of', len(store), 'songs lemmatized identically')
+        if bad:
+            sys.exit(1)
+    elif args.command == 'find':
+        index = SongIndex.open(args.songdb_paths)
+        for k, score in index.search(args.query, args.k):
+            s = index.song(k)
+            print('{:5.2f}  {:<40} {:<30} {}'.format(score, s['title'], s['composer'], s['path']))
+    elif args.command == 'ingest':
+        romans, meters, titles, timings = ingest_corpus(args.songdb_paths, args.processes, progress=True)
+        for stage, dt in timings.items():
+            print('{:<12} {:8.3f} s'.format(stage, dt))
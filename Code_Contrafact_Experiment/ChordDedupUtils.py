@@ -0,0 +1,243 @@
+import json
+import time
+import argparse
+import numpy as np
+from texttable import Texttable
+import ChordVecUtils as cvu
+import ChordCorpusUtils as ccorp
+import ChordTraceUtils as ctrace
+
+# Near-duplicate detection: songs that are the same tune with an
+# alternate harmonization share most of their roman numeral n-grams.
+# Every song is reduced to a MinHash signature of its set of n-gram
+# shingles (of the run compressed progression), signatures are
+# bucketed by bands with locality-sensitive hashing, and only songs
+# sharing a bucket in some band are compared: first by the fraction of
+# equal signature entries (an estimate of the Jaccard similarity of
+# their shingle sets), then by the exact membrane area between their
+# paths.  The confirmed pairs are grouped into clusters.
+#
+# With b bands of r rows, two songs of Jaccard similarity J share a
+# bucket with probability 1 - (1 - J^r)^b, an S-curve centred near
+# (1/b)^(1/r).  The defaults (shingles of 4 chords, 42 bands of 3 rows)
+# catch pairs with J = 0.4 with probability 0.94 and J = 0.5 with 0.996,
+# while 99% of random pairs of the corpus have J < 0.16.  Shorter
+# shingles are shared by most songs built on ii-V-I progressions and
+# chain unrelated tunes into large clusters.  Reharmonizations that
+# change most of the chords are beyond any shingle threshold.
+
+SHINGLE_SIZE = 4
+MINHASH_BANDS = 42
+MINHASH_ROWS = 3
+MIN_JACCARD = 0.4
+MAX_AREA = 0.07
+
+def song_shingles(corpus, n=SHINGLE_SIZE):
+    """
+    Return the distinct n-gram shingles of the run compressed
+    progression of every song of a cvu.Corpus, as integer ids, and the
+    song of each shingle (sorted by song).  Each song is padded at its
+    end with n-1 pad codes, so that a song shorter than n has one
+    shingle and the last chords of every song appear in n shingles
+    """
+    codes, docs, chord_idx = cvu.encode_corpus(corpus)
+    codes, docs = cvu.compress_codes(codes, docs)
+    base = len(chord_idx) + 1
+    if base**n >= 2**63:
+        raise ValueError('Shingles of {} chords do not fit in 64 bits'.format(n))
+
+    # Lay the songs out with n-1 pad codes after each one
+    ends = np.flatnonzero(np.diff(docs, append=-1))
+    slot = np.arange(len(codes)) + (n-1)*np.searchsorted(ends, np.arange(len(codes)))
+    seq = np.full(len(codes) + (n-1)*len(ends), base-1, dtype=np.int64)
+    seq[slot] = codes
+    ids = np.zeros(len(codes), dtype=np.int64)
+    for j in range(n):
+        ids += seq[slot + j]*base**j
+
+    order = np.lexsort((ids, docs))
+    ids, docs = ids[order], docs[order]
+    keep = np.ones(len(ids), dtype=bool)
+    keep[1:] = (ids[1:] != ids[:-1]) | (docs[1:] != docs[:-1])
+    return ids[keep], docs[keep]
+
+def mix64(x):
+    """
+    Return the 64-bit finalizer of splitmix64 applied to the uint64
+    array x, spreading shingle ids over all bits
+    """
+    x = x.astype(np.uint64)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+@ctrace.traced()
+def minhash_signatures(shingles, songs, n_songs, n_hashes=MINHASH_BANDS*MINHASH_ROWS, seed=0, chunk=16):
+    """
+    Return the (n_songs x n_hashes) uint32 MinHash signatures of the
+    songs' shingle sets (see song_shingles): entry i of a signature is
+    the smallest value of the multiply-shift hash h_i(x) = (a_i x + b_i
+    mod 2^64) >> 32 over the song's shingles.  The hashes are evaluated
+    for all shingles at once, chunk hash functions at a time
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**63, size=n_hashes, dtype=np.uint64)*np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2**63, size=n_hashes, dtype=np.uint64)
+    x = mix64(shingles)
+    present = np.unique(songs)
+    starts = np.searchsorted(songs, present)
+    signatures = np.full((n_songs, n_hashes), np.iinfo(np.uint32).max, dtype=np.uint32)
+    for c in range(0, n_hashes, chunk):
+        h = ((a[c:c+chunk,None]*x + b[c:c+chunk,None]) >> np.uint64(32)).astype(np.uint32)
+        signatures[present, c:c+chunk] = np.minimum.reduceat(h, starts, axis=1).T
+    return signatures
+
+@ctrace.traced()
+def lsh_candidate_pairs(signatures, bands=MINHASH_BANDS, rows=MINHASH_ROWS):
+    """
+    Return the pairs of songs (a < b, as two arrays) whose signatures
+    agree on all rows of at least one band.  Each band's rows are
+    combined into one 64-bit bucket key, the songs are sorted by key and
+    every bucket holding more than one song contributes its pairs, so
+    the work grows with the number of songs and candidate pairs rather
+    than with all pairs
+    """
+    N = len(signatures)
+    pairs = []
+    for band in range(bands):
+        key = np.zeros(N, dtype=np.uint64)
+        for r in range(band*rows, (band+1)*rows):
+            key = mix64(key ^ signatures[:,r].astype(np.uint64))
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        starts = np.flatnonzero(np.diff(key, prepend=~key[:1]))
+        sizes = np.diff(np.append(starts, N))
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            members = np.sort(order[start:start+size])
+            i, j = np.triu_indices(size, 1)
+            pairs.append(members[i]*N + members[j])
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs//N, pairs % N
+
+def duplicate_clusters(n_songs, a, b):
+    """
+    Return the connected components of the graph of songs with edges
+    (a[i], b[i]) having more than one song, as sorted lists of song
+    indices, largest first
+    """
+    parent = np.arange(n_songs)
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for x, y in zip(a.tolist(), b.tolist()):
+        rx, ry = find(x), find(y)
+        if rx != ry:
+            parent[max(rx, ry)] = min(rx, ry)
+    roots = np.array([find(x) for x in range(n_songs)])
+    clusters = {}
+    for k, r in enumerate(roots.tolist()):
+        clusters.setdefault(r, []).append(k)
+    return sorted((c for c in clusters.values() if len(c) > 1), key=lambda c: (-len(c), c[0]))
+
+@ctrace.traced()
+def find_duplicates(corpus, chord_idx, M, n=SHINGLE_SIZE, bands=MINHASH_BANDS, rows=MINHASH_ROWS,
+                    min_jaccard=MIN_JACCARD, max_area=MAX_AREA, seed=0):
+    """
+    Find the near-duplicate songs of a cvu.Corpus.  Candidate pairs
+    come from LSH over MinHash signatures of the songs' n-gram shingles,
+    are kept if their estimated Jaccard similarity is at least
+    min_jaccard, and are confirmed if the exact membrane area between
+    their paths (with the chord vectors of M, see
+    cvu.exact_membrane_area) is at most max_area.  Returns the clusters
+    (see duplicate_clusters), the confirmed pairs as a list of (a, b,
+    jaccard, area) and a report dict of counts and timings
+    """
+    t0 = time.perf_counter()
+    shingles, songs = song_shingles(corpus, n)
+    signatures = minhash_signatures(shingles, songs, len(corpus), bands*rows, seed)
+    t1 = time.perf_counter()
+    a, b = lsh_candidate_pairs(signatures, bands, rows)
+    jaccard = (signatures[a] == signatures[b]).mean(axis=1) if len(a) else np.zeros(0)
+    similar = jaccard >= min_jaccard
+    t2 = time.perf_counter()
+
+    # Breakpoints only for the songs that need them
+    need = np.unique(np.concatenate([a[similar], b[similar]]))
+    breakpoints = dict(zip(need.tolist(), cvu.make_corpus_breakpoints(corpus.subset(need), None, chord_idx, M)))
+    pairs = []
+    for x, y, j in zip(a[similar].tolist(), b[similar].tolist(), jaccard[similar].tolist()):
+        area = cvu.exact_membrane_area(breakpoints[x], breakpoints[y])
+        if area <= max_area:
+            pairs.append((x, y, j, area))
+    t3 = time.perf_counter()
+
+    confirmed = np.array([(x, y) for x, y, j, area in pairs], dtype=np.int64).reshape(-1, 2)
+    clusters = duplicate_clusters(len(corpus), confirmed[:,0], confirmed[:,1])
+    report = {'songs': len(corpus), 'shingles': len(shingles), 'candidates': len(a),
+              'similar': int(similar.sum()), 'confirmed': len(pairs), 'clusters': len(clusters),
+              'signature_seconds': t1 - t0, 'lsh_seconds': t2 - t1, 'confirm_seconds': t3 - t2}
+    ctrace.count('dedup candidates', len(a))
+    return clusters, pairs, report
+
+def duplicate_report(clusters, pairs, titles, songs=None):
+    """
+    Return the duplicate cluster report as a string: one table per
+    cluster listing its songs (with their SongDB title and composer if
+    songs, the store metadata, is given) and the confirmed pairs between
+    them with their estimated Jaccard similarity and membrane area
+    """
+    by_cluster = {}
+    member = {k: c for c, cluster in enumerate(clusters) for k in cluster}
+    for x, y, j, area in pairs:
+        by_cluster.setdefault(member[x], []).append((x, y, j, area))
+    out = []
+    for c, cluster in enumerate(clusters):
+        t = Texttable()
+        t.set_deco(Texttable.HEADER)
+        t.set_cols_dtype(['t', 't', 't'])
+        t.add_row(['file', 'title', 'composer'])
+        for k in cluster:
+            meta = songs[k] if songs is not None else {'title': '', 'composer': ''}
+            t.add_row([titles[k], meta['title'], meta['composer']])
+        out.append('Cluster {} ({} songs)\n'.format(c+1, len(cluster)) + t.draw())
+        for x, y, j, area in by_cluster.get(c, []):
+            out.append('  {} ~ {}  jaccard {:.2f}  area {:.4f}'.format(titles[x], titles[y], j, area))
+        out.append('')
+    return '\n'.join(out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Near-duplicate song detection')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('dedup', help='report clusters of near-duplicate songs')
+    p.add_argument('--shingle', type=int, default=SHINGLE_SIZE, help='chords per shingle')
+    p.add_argument('--bands', type=int, default=MINHASH_BANDS)
+    p.add_argument('--rows', type=int, default=MINHASH_ROWS)
+    p.add_argument('--min-jaccard', type=float, default=MIN_JACCARD)
+    p.add_argument('--max-area', type=float, default=MAX_AREA, help='largest exact membrane area of a duplicate')
+    p.add_argument('--win-size', type=int, default=1)
+    p.add_argument('--output', default=None, help='also write the clusters and pairs to this JSON file')
+    p.add_argument('songdb_paths', nargs='*', default=ccorp.SONGDB_PATHS)
+    args = parser.parse_args()
+
+    if args.command == 'dedup':
+        romans, meters, titles, timings = ccorp.ingest_corpus(args.songdb_paths)
+        corpus = cvu.Corpus.from_lists(romans, meters, titles)
+        M, chord_idx = cvu.co_occurrence_matrix(corpus, args.win_size, compressed=True, dense=True)
+        M = cvu.normalize_rows(M)
+        clusters, pairs, report = find_duplicates(corpus, chord_idx, M, args.shingle, args.bands, args.rows,
+                                                  args.min_jaccard, args.max_area)
+        store = ccorp.open_corpus_store(args.songdb_paths)
+        print(duplicate_report(clusters, pairs, titles, store.songs))
+        print(json.dumps(report, indent=1))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'report': report, 'clusters': [[titles[k] for k in c] for c in clusters],
+                           'pairs': [{'a': titles[x], 'b': titles[y], 'jaccard': j, 'area': area}
+                                     for x, y, j, area in pairs]}, f, indent=1)
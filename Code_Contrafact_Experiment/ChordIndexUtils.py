@@ -0,0 +1,410 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import ChordVecUtils as cvu
+import ChordCorpusUtils as ccorp
+from ChordCacheUtils import CACHE_DIR
+
+NGRAM_INDEX = os.path.join(CACHE_DIR, 'ngrams')
+NGRAM_WILDCARD = '*'
+
+def points_digest(points, chunk=256):
+    """
+    Return a hex digest of the shape, type and content of the (N x S x
+    K) path samples, read chunk songs at a time
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([list(points.shape), str(points.dtype)]).encode())
+    for k in range(0, len(points), chunk):
+        h.update(np.ascontiguousarray(points[k:k+chunk]).tobytes())
+    return h.hexdigest()
+
+def sample_distances(points, song, chunk=256):
+    """
+    Return the (N x S) distances between the path samples of song (S x
+    K) and those of every song in points (N x S x K), chunk songs at a
+    time.  Their row sums are the membrane areas, bit for bit as
+    cvu.membrane_area computes them
+    """
+    d = np.empty(points.shape[:2])
+    for k in range(0, len(points), chunk):
+        d[k:k+chunk] = np.linalg.norm(points[k:k+chunk] - song, axis=-1)
+    return d
+
+class MembraneIndex:
+    """Exact top-k nearest song queries under the membrane area.
+
+    The sampled membrane area is a sum of L2 distances between
+    corresponding path samples, so it is a metric and obeys the
+    triangle inequality sample by sample.  The index (LAESA style)
+    splits the samples into n_groups consecutive groups and stores, for
+    every song and a few pivot songs chosen farthest first (max-min),
+    the sum of the sample distances within each group.  For a query q
+    and every group g, |d_g(q,p) - d_g(x,p)| is a lower bound on
+    d_g(q,x) for every pivot p, and the sum over the groups of the best
+    of these bounds is a lower bound on d(q,x), tighter than the bound
+    from the whole areas since each group can use its own pivot.
+    Candidates are evaluated exactly in order of increasing lower
+    bound, a few at a time, and the search stops as soon as the next
+    lower bound exceeds the k-th best area found so far, so the result
+    is the same as a brute force search (ties broken by corpus order).
+
+    On SongDB (254 samples, 63 dimensions) with the default 32 pivots
+    and 8 groups, a top-10 query evaluates about 500 of the 2614 songs
+    (32 of them the pivots) and takes about 80 ms, against about 650 ms
+    for cvu.membrane_areas over the corpus.  The songs are spread out
+    in many dimensions, so the bounds cannot prune much more: 64
+    pivots cut the evaluations to about 425 but the extra pivot areas
+    make queries slower.  Building the index takes one membrane_areas
+    pass per pivot (about 20 s), which is why it is saved.
+
+    """
+
+    def __init__(self, points, titles, pivots, pivot_areas, digest=None):
+        self.points = points
+        self.digest = digest
+        self.titles = list(titles)
+        self.title_idx = {t: k for k, t in enumerate(self.titles)}
+        self.pivots = np.asarray(pivots, dtype=np.int64)
+        self.pivot_areas = np.asarray(pivot_areas)
+        self.groups = np.linspace(0, points.shape[1], self.pivot_areas.shape[2]+1).astype(int)[:-1]
+        self.stats = {'queries': 0, 'evaluations': 0, 'seconds': 0.0}
+
+    @classmethod
+    def build(cls, points, titles, n_pivots=32, n_groups=8):
+        """Build the index over the (N x S x K) path samples of a corpus,
+        choosing n_pivots pivots farthest first and summing the sample
+        distances to them in n_groups groups of samples
+
+        """
+        N, S = points.shape[:2]
+        n_pivots = min(n_pivots, N)
+        n_groups = min(n_groups, S)
+        groups = np.linspace(0, S, n_groups+1).astype(int)[:-1]
+        pivots = [0]
+        pivot_areas = np.empty((N, n_pivots, n_groups))
+        nearest = np.full(N, np.inf)
+        for j in range(n_pivots):
+            d = sample_distances(points, points[pivots[j]])
+            pivot_areas[:, j] = np.add.reduceat(d, groups, axis=1)
+            nearest = np.minimum(nearest, d.sum(axis=-1))
+            if j+1 < n_pivots:
+                pivots.append(int(np.argmax(nearest)))
+        return cls(points, titles, pivots, pivot_areas, points_digest(points))
+
+    def save(self, path):
+        """Save the pivots and grouped pivot areas (not the path samples)
+        to path, a .npz file, with the digest of the path samples
+
+        """
+        if self.digest is None:
+            self.digest = points_digest(self.points)
+        np.savez(path, pivots=self.pivots, pivot_areas=self.pivot_areas, titles=np.array(self.titles),
+                 digest=np.array(self.digest))
+
+    @classmethod
+    def load(cls, path, points):
+        """Load an index saved with save, over the same path samples
+
+        """
+        data = np.load(path)
+        digest = str(data['digest']) if 'digest' in data.files else None
+        return cls(points, [str(t) for t in data['titles']], data['pivots'], data['pivot_areas'], digest)
+
+    @classmethod
+    def open(cls, path, points, titles, n_pivots=32, n_groups=8):
+        """Load the index saved at path if it was built over the same
+        songs and path samples (another co-occurrence configuration,
+        number of samples or embedding gives other pivot areas) with
+        the same numbers of pivots and groups, otherwise build it and
+        save it there
+
+        """
+        if os.path.exists(path):
+            data = np.load(path)
+            shape = (len(titles), min(n_pivots, len(titles)), min(n_groups, points.shape[1]))
+            if data['pivot_areas'].shape == shape:
+                index = cls.load(path, points)
+                if index.titles == list(titles) and index.digest == points_digest(points):
+                    return index
+        index = cls.build(points, titles, n_pivots, n_groups)
+        index.save(path)
+        return index
+
+    def query(self, song, k=10, exclude=(), batch=8, rtol=1e-9):
+        """Return the k songs nearest to song as a list of (title, area),
+        nearest first.  song is either the title of a song in the index
+        or an (S x K) matrix of path samples (see make_path_samples).
+        Titles in exclude are skipped (a title query excludes itself).
+        Candidates are evaluated exactly batch songs at a time, and only
+        while their lower bound does not exceed the k-th best area.
+        Lower bounds are relaxed by rtol times the largest pivot area to
+        absorb floating point rounding in the triangle inequality
+
+        """
+        t0 = time.perf_counter()
+        exclude = set(exclude)
+        if isinstance(song, str):
+            exclude.add(song)
+            song = self.points[self.title_idx[song]]
+        skip = np.array([self.title_idx[t] for t in exclude if t in self.title_idx], dtype=np.int64)
+
+        # Exact (grouped) areas to the pivots, then lower bounds for
+        # every song
+        d = sample_distances(self.points[self.pivots], song)
+        q_pivots = np.add.reduceat(d, self.groups, axis=1)
+        lower = np.abs(self.pivot_areas - q_pivots).max(axis=1).sum(axis=1)
+        lower -= rtol*len(self.groups)*max(1.0, float(self.pivot_areas.max()))
+        lower[skip] = np.inf
+        order = np.argsort(lower, kind='stable')
+
+        areas = np.full(len(self.titles), np.inf)
+        areas[self.pivots] = d.sum(axis=-1)
+        evaluated = np.zeros(len(self.titles), dtype=bool)
+        evaluated[self.pivots] = True
+        evaluated[skip] = True
+        n_eval = len(self.pivots)
+
+        # The k best areas so far (of songs not skipped)
+        best = areas[self.pivots[~np.isin(self.pivots, skip)]]
+        kth = np.partition(best, k-1)[k-1] if len(best) >= k else np.inf
+        for start in range(0, len(order), batch):
+            idx = order[start:start+batch]
+            idx = idx[lower[idx] <= kth]
+            if not len(idx):
+                break
+            idx = idx[~evaluated[idx]]
+            if len(idx):
+                areas[idx] = cvu.membrane_area(self.points[idx], song)
+                evaluated[idx] = True
+                n_eval += len(idx)
+                best = np.concatenate([best, areas[idx]])
+                if len(best) >= k:
+                    best = np.partition(best, k-1)[:k]
+                    kth = best.max()
+
+        self.stats['queries'] += 1
+        self.stats['evaluations'] += n_eval
+        candidates = np.flatnonzero(evaluated)
+        candidates = candidates[~np.isin(candidates, skip)]
+        best = candidates[np.lexsort((candidates, areas[candidates]))][:k]
+        self.stats['seconds'] += time.perf_counter() - t0
+        return [(self.titles[j], float(areas[j])) for j in best]
+
+class NgramIndex:
+    """Inverted index of the roman numeral n-grams of a corpus, for
+    pattern queries such as 'iim vii7 im bviiM' or 'iim * im' (NGRAM_WILDCARD
+    matches any one chord).
+
+    The songs of a cvu.Corpus are laid end to end as one sequence of
+    vocabulary codes, run compressed (see compress_sequence) if
+    compressed is True.  Every position of the sequence has its song
+    id, its token position in the song and its beat offset from the
+    start of the song stored in three columns (for a compressed index,
+    those of the first chord of the run).  The unigrams and the bigrams
+    (within a song) have posting lists of the positions at which they
+    occur, in ascending order, stored back to back and sliced by the
+    sorted n-gram ids.  A pattern is covered with bigrams and, where a
+    wildcard leaves a lone chord, unigrams; each posting list is
+    shifted back by the offset of its n-gram in the pattern and the
+    lists are intersected, smallest first.  Matches whose first and
+    last positions are in different songs are dropped.
+
+    The arrays are saved as .npy files beside a JSON file of metadata
+    and memory-mapped at load, so opening an index costs no more than
+    reading its metadata.
+
+    """
+
+    ARRAYS = ('song', 'position', 'beat', 'gram1_keys', 'gram1_starts', 'gram1_postings',
+              'gram2_keys', 'gram2_starts', 'gram2_postings')
+
+    def __init__(self, arrays, vocab, titles, compressed, digest):
+        self.arrays = arrays
+        self.vocab = list(vocab)
+        self.titles = list(titles)
+        self.compressed = compressed
+        self.digest = digest
+        self.chord_idx = {w: i for i, w in enumerate(self.vocab)}
+
+    @staticmethod
+    def corpus_digest(corpus):
+        """Return a hex digest of the content of a cvu.Corpus
+
+        """
+        h = hashlib.sha1()
+        for a in (corpus.tokens, corpus.beats, corpus.offsets):
+            h.update(np.ascontiguousarray(a).tobytes())
+        h.update(json.dumps([corpus.vocab, corpus.titles]).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def build(cls, corpus, compressed=False):
+        """Build the index of a cvu.Corpus
+
+        """
+        codes, docs, chord_idx = cvu.encode_corpus(corpus)
+        position = np.arange(len(codes)) - corpus.offsets[docs]
+        ends = np.cumsum(corpus.beats, dtype=float)
+        song_start = np.concatenate([[0.0], ends])[corpus.offsets[:-1]]
+        beat = ends - corpus.beats - song_start[docs]
+        if compressed:
+            keep = np.ones(len(codes), dtype=bool)
+            keep[1:] = (codes[1:] != codes[:-1]) | (docs[1:] != docs[:-1])
+            codes, docs, position, beat = codes[keep], docs[keep], position[keep], beat[keep]
+
+        arrays = {'song': docs.astype(np.int32), 'position': position.astype(np.int32),
+                  'beat': beat.astype(np.float32)}
+        V = len(corpus.vocab)
+        where = np.flatnonzero(docs[1:] == docs[:-1])
+        for n, ids, at in ((1, codes, np.arange(len(codes))), (2, codes[where]*V + codes[where+1], where)):
+            order = np.argsort(ids, kind='stable')
+            keys, starts = np.unique(ids[order], return_index=True)
+            arrays['gram{}_keys'.format(n)] = keys.astype(np.int64)
+            arrays['gram{}_starts'.format(n)] = np.append(starts, len(ids)).astype(np.int64)
+            arrays['gram{}_postings'.format(n)] = at[order].astype(np.int32)
+        return cls(arrays, corpus.vocab, corpus.titles, compressed, cls.corpus_digest(corpus))
+
+    def save(self, path):
+        """Save the index to path + '.<array>.npy' files and path +
+        '.json', each written under a temporary name and renamed into
+        place (the metadata last)
+
+        """
+        pid = str(os.getpid())
+        for name in self.ARRAYS:
+            np.save(path + '.' + name + '.' + pid + '.npy', self.arrays[name])
+            os.replace(path + '.' + name + '.' + pid + '.npy', path + '.' + name + '.npy')
+        meta = {'vocab': self.vocab, 'titles': self.titles, 'compressed': self.compressed,
+                'digest': self.digest, 'shapes': {name: list(self.arrays[name].shape) for name in self.ARRAYS}}
+        with open(path + '.' + pid + '.json', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.' + pid + '.json', path + '.json')
+
+    @classmethod
+    def load(cls, path):
+        """Load the index saved at path with its arrays memory-mapped, or
+        return None if there is no complete index there
+
+        """
+        if not os.path.exists(path + '.json'):
+            return None
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in cls.ARRAYS:
+            if not os.path.exists(path + '.' + name + '.npy'):
+                return None
+            arrays[name] = np.load(path + '.' + name + '.npy', mmap_mode='r')
+            if list(arrays[name].shape) != meta['shapes'][name]:
+                return None
+        return cls(arrays, meta['vocab'], meta['titles'], meta['compressed'], meta['digest'])
+
+    @classmethod
+    def open(cls, corpus, compressed=False, path=NGRAM_INDEX):
+        """Load the index of a cvu.Corpus saved at path (with a suffix
+        for compressed indexes) if it was built over the same corpus,
+        otherwise build it and save it there
+
+        """
+        path = path + ('_compressed' if compressed else '_raw')
+        index = cls.load(path)
+        if index is not None and index.compressed == compressed and index.digest == cls.corpus_digest(corpus):
+            return index
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        index = cls.build(corpus, compressed)
+        index.save(path)
+        return index
+
+    def postings(self, n, gram):
+        """Return the posting list (positions in ascending order) of the
+        n-gram with id gram
+
+        """
+        keys = self.arrays['gram{}_keys'.format(n)]
+        i = np.searchsorted(keys, gram)
+        if i == len(keys) or keys[i] != gram:
+            return np.zeros(0, dtype=np.int64)
+        starts = self.arrays['gram{}_starts'.format(n)]
+        return self.arrays['gram{}_postings'.format(n)][starts[i]:starts[i+1]]
+
+    def parse(self, pattern):
+        """Return the codes of the chords of pattern (a string of space
+        separated chords or a list), None for wildcards and -1 for chords
+        not in the vocabulary.  For a compressed index, repeated chords
+        are collapsed as in the indexed sequence
+
+        """
+        terms = pattern.split() if isinstance(pattern, str) else list(pattern)
+        codes = [None if t == NGRAM_WILDCARD else self.chord_idx.get(t, -1) for t in terms]
+        if self.compressed:
+            codes = [c for i, c in enumerate(codes) if i == 0 or c is None or c != codes[i-1]]
+        return codes
+
+    def find(self, pattern):
+        """Return the matches of pattern in the corpus as arrays of song
+        ids, token positions and beat offsets of their first chord, in
+        corpus order
+
+        """
+        codes = self.parse(pattern)
+        n = len(self.arrays['song'])
+        if not codes or -1 in codes:
+            starts = np.zeros(0, dtype=np.int64)
+        else:
+            V = len(self.vocab)
+            lists = []
+            i = 0
+            while i < len(codes):
+                if codes[i] is None:
+                    i += 1
+                elif i+1 < len(codes) and codes[i+1] is not None:
+                    lists.append(self.postings(2, codes[i]*V + codes[i+1]).astype(np.int64) - i)
+                    i += 2
+                else:
+                    lists.append(self.postings(1, codes[i]).astype(np.int64) - i)
+                    i += 1
+            if lists:
+                lists.sort(key=len)
+                starts = lists[0]
+                for other in lists[1:]:
+                    starts = np.intersect1d(starts, other, assume_unique=True)
+            else:
+                starts = np.arange(n)
+            starts = starts[(starts >= 0) & (starts + len(codes) <= n)]
+            song = self.arrays['song']
+            starts = starts[song[starts] == song[starts + len(codes) - 1]]
+        return (np.asarray(self.arrays['song'][starts]), np.asarray(self.arrays['position'][starts]),
+                np.asarray(self.arrays['beat'][starts]))
+
+    def songs(self, pattern):
+        """Return the titles of the songs containing pattern, in corpus
+        order
+
+        """
+        return [self.titles[k] for k in np.unique(self.find(pattern)[0])]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Contrafact corpus indexes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('ngrams', help='find the songs containing roman numeral patterns')
+    p.add_argument('--compressed', action='store_true', help='match run compressed progressions')
+    p.add_argument('--index', default=NGRAM_INDEX)
+    p.add_argument('--songdb', nargs='*', default=ccorp.SONGDB_PATHS)
+    p.add_argument('patterns', nargs='+', help="chords separated by spaces, '" + NGRAM_WILDCARD + "' matches any chord")
+    args = parser.parse_args()
+
+    if args.command == 'ngrams':
+        romans, meters, titles, timings = ccorp.ingest_corpus(args.songdb)
+        corpus = cvu.Corpus.from_lists(romans, meters, titles)
+        index = NgramIndex.open(corpus, args.compressed, args.index)
+        for pattern in args.patterns:
+            t0 = time.perf_counter()
+            songs, positions, beats = index.find(pattern)
+            dt = time.perf_counter() - t0
+            print('{}: {} matches in {} songs ({:.2f} ms)'.format(pattern, len(songs), len(np.unique(songs)), dt*1000))
+            for k, pos, beat in zip(songs.tolist(), positions.tolist(), beats.tolist()):
+                print('  {:<40} chord {:>4}  beat {:>7.2f}'.format(titles[k], pos, beat))
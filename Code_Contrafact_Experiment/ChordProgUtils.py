@@ -1,7 +1,115 @@
-import os
 import re
+import numpy as np
+from collections import namedtuple
 from itertools import groupby
 from texttable import Texttable
+import ChordTraceUtils as ctrace
+
+CHROMATIC = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
+
+ChordSymbol = namedtuple('ChordSymbol', ['symbol', 'root', 'pitch', 'quality', 'enharmonic', 'deslashed', 'bass'])
+ChordSymbol.__doc__ = """Parsed form of a chord symbol: its root (None if unparseable),
+root pitch class (0 = C, None if not one of CHROMATIC), quality class
+(see getclass), enharmonically unique form (see map_enharmonic),
+de-slashed form (see convert_slash) and slash bass note (None if not a
+slash chord).  Forms that cannot be derived are None.
+
+"""
+
+class ChordTable:
+    """Intern table of chord symbols.  Each distinct symbol is parsed
+    exactly once into a ChordSymbol record, on first lookup, with the
+    precompiled patterns below.  The table is a plain dict underneath
+    and pickles cheaply, so a table filled in one process can be handed
+    to worker processes (see set_chord_table)
+
+    """
+
+    def __init__(self, symbols=()):
+        self.records = {}
+        self.codes = {}
+        self.symbols = []
+        self.pitches = []
+        self.qualities = []
+        self.inversions = []
+        self._arrays = None
+        self.intern(symbols)
+
+    def __getitem__(self, symbol):
+        try:
+            return self.records[symbol]
+        except KeyError:
+            record = parse_chord_symbol(symbol)
+            self.records[symbol] = record
+            return record
+
+    def __contains__(self, symbol):
+        return symbol in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def code(self, symbol):
+        """Return the integer code of a symbol, assigning the next free
+        code to symbols not seen before.  The root pitch class (-1 if
+        none) and quality code (see QUALITY_CLASSES) of code k are
+        pitches[k] and qualities[k]
+
+        """
+        try:
+            return self.codes[symbol]
+        except KeyError:
+            record = self[symbol]
+            k = len(self.symbols)
+            self.codes[symbol] = k
+            self.symbols.append(symbol)
+            self.pitches.append(-1 if record.pitch is None else record.pitch)
+            self.qualities.append(QUALITY_CODE[record.quality])
+            self.inversions.append(None)
+            return k
+
+    def code_arrays(self):
+        """Return the pitches and qualities of all codes as arrays
+
+        """
+        if self._arrays is None or len(self._arrays[0]) != len(self.symbols):
+            self._arrays = (np.array(self.pitches, dtype=np.int64), np.array(self.qualities, dtype=np.int64))
+        return self._arrays
+
+    def inversion(self, k):
+        """Return the code of the sus4 form of code k (see _sus_inversion)
+
+        """
+        if self.inversions[k] is None:
+            self.inversions[k] = self.code(_sus_inversion(self.symbols[k]))
+        return self.inversions[k]
+
+    def intern(self, symbols):
+        """Parse the symbols, and the enharmonic and de-slashed forms
+        derived from them, into the table
+
+        """
+        for s in symbols:
+            record = self[s]
+            for derived in (record.enharmonic, record.deslashed):
+                if derived is not None:
+                    self[derived]
+
+CHORD_TABLE = ChordTable()
+
+def chord_table():
+    """Return the chord symbol table used by this module
+
+    """
+    return CHORD_TABLE
+
+def set_chord_table(table):
+    """Replace the chord symbol table used by this module, for example
+    with one parsed by a parent process
+
+    """
+    global CHORD_TABLE
+    CHORD_TABLE = table
 
 def display_prog(progression, bpl = 8):
     """Display the progression in tabular format to the terminal
@@ -51,9 +159,12 @@ def convert2progression(timesig, data):
         
     return progression
         
-def map2roman(songkey, progression):
+@ctrace.traced(events=False)
+def map2roman(songkey, progression, normalized_prog=None):
     """Given a key and a chord progression (consisting of chords and bar
-    separation symbols), map the progression to roman numeral notation
+    separation symbols), map the progression to roman numeral notation.
+    The lemmatized progression is computed unless it is passed in as
+    normalized_prog (see estimatekeys)
 
     """
 
@@ -79,7 +190,8 @@ def map2roman(songkey, progression):
     # Lemmatize the progression and extract the list of just chords
     # (without the bar symbols)
     
-    normalized_prog = lemmatize(progression)
+    if normalized_prog is None:
+        normalized_prog = lemmatize_batch([progression])[0]
     chords = strip_bars(normalized_prog)
 
     # For each chord find the equivalent roman numeral corresponding
@@ -104,133 +216,195 @@ def map2roman(songkey, progression):
     return roman_prog
     
 
-def estimatekey(bpm, progression):
+# A major chord could come from two major scales
 
-# Find the weighted major key of each chord (except diminished) and return the
-# most frequent
+MAJOR_KEYS = {
+    'C':  ('C', 'G'),
+    'F':  ('F', 'C'),
+    'Bb': ('Bb', 'F'),
+    'Eb': ('Eb', 'Bb'),
+    'Ab': ('Ab', 'Eb'),
+    'Db': ('Db', 'Ab'),
+    'Gb': ('Gb', 'Db'),
+    'B': ('B', 'Gb'),
+    'E': ('E', 'B'),
+    'A': ('A', 'E'),
+    'D': ('D', 'A'),
+    'G': ('G', 'D')
+}
 
-    normalized_prog = lemmatize(progression)
-    chords = strip_bars(normalized_prog)
+# A minor chord could come from three major scales
+
+MINOR_KEYS = {
+    'C': ('Bb', 'Ab', 'Eb'),
+    'F': ('Eb', 'Db', 'Ab'),
+    'Bb': ('Ab', 'Gb', 'Db'),
+    'Eb': ('Db', 'B', 'Gb'),
+    'Ab': ('Gb', 'E', 'B'),
+    'Db': ('B', 'A', 'E'),
+    'Gb': ('E', 'D', 'A'),
+    'B': ('A', 'G', 'D'),
+    'E': ('D', 'C', 'G'),
+    'A': ('G', 'F', 'C'),
+    'D': ('C', 'Bb', 'F'),
+    'G': ('F', 'Eb', 'Bb')
+}
+
+# A 7th chord could come from one major scale
+
+SEVEN_KEYS = {
+    'C': ('F',),
+    'F': ('Bb',),
+    'Bb': ('Eb',),
+    'Eb': ('Ab',),
+    'Ab': ('Db',),
+    'Db': ('Gb',),
+    'Gb': ('B',),
+    'B': ('E',),
+    'E': ('A',),
+    'A': ('D',),
+    'D': ('G',),
+    'G': ('C',)
+}
+
+# A m7b5 chord could come from one major scale
+
+HALF_KEYS = {
+    'C': ('Db',),
+    'F': ('Gb',),
+    'Bb': ('B',),
+    'Eb': ('E',),
+    'Ab': ('A',),
+    'Db': ('D',),
+    'Gb': ('G',),
+    'B': ('C',),
+    'E': ('F',),
+    'A': ('Bb',),
+    'D': ('Eb',),
+    'G': ('Ab',)
+}
+
+# A five chord (eg, a power chord like C5) can belong to six major scales
+
+FIVE_KEYS = {
+    'C': ('C', 'Eb', 'F', 'G', 'Ab', 'Bb'),
+    'F': ('C', 'Db', 'Eb', 'F', 'Ab', 'Bb'),
+    'Bb': ('Db', 'Eb', 'F', 'Gb', 'Ab', 'Bb'),
+    'Eb': ('Db', 'Eb', 'Gb', 'Ab', 'Bb', 'B'),
+    'Ab': ('Db', 'Eb', 'E', 'Gb', 'Ab', 'B'),
+    'Db': ('Db', 'E', 'Gb', 'Ab', 'A', 'B'),
+    'Gb': ('Db', 'D', 'E', 'Gb', 'A', 'B'),
+    'B': ('D', 'E', 'Gb', 'G', 'A', 'B'),
+    'E': ('C', 'D', 'E', 'G', 'A', 'B'),
+    'A': ('C', 'D', 'E', 'F', 'G', 'A'),
+    'D': ('C', 'D', 'F', 'G', 'A', 'Bb'),
+    'G': ('C', 'D', 'Eb', 'F', 'G', 'Bb')
+}
+
+# Keys in the order in which estimatekey ranks ties
+
+KEY_ORDER = list(MAJOR_KEYS)
+
+def chord_keys(quality, root):
+    """Return the major keys that a chord of the given quality class and
+    root could come from (diminished chords, for example, belong to
+    none)
+
+    """
+    s = ()
+    if quality == '7':
+        s = SEVEN_KEYS[root]
+    elif re.match('M7|M', quality):
+        s = MAJOR_KEYS[root]
+    elif re.match('m7|m', quality):
+        s = MINOR_KEYS[root]
+    elif quality == 'h7':
+        s = HALF_KEYS[root]
+    elif quality == '5':
+        s = FIVE_KEYS[root]
+    return s
+
+def key_weight_table():
+    """Return the (quality code x root pitch class x key) table of
+    chord_keys: entry [q, r, k] is 1 if a chord of quality
+    QUALITY_CLASSES[q] and root CHROMATIC[r] could come from the key
+    KEY_ORDER[k]
+
+    """
+    W = np.zeros((len(QUALITY_CLASSES), 12, len(KEY_ORDER)))
+    for q, quality in enumerate(QUALITY_CLASSES):
+        for r, root in enumerate(CHROMATIC):
+            for key in chord_keys(quality, root):
+                W[q, r, KEY_ORDER.index(key)] = 1
+    return W
+
+def chord_beats(bpm, progression):
+    """Return the beats of each chord in a progression, sharing the beats
+    of each bar equally among its chords (as used for key estimation)
+
+    """
     bars = ' '.join(progression).split(' | ')
     cpm = [len(b.split(' ')) for b in bars]  # chords per measure
 
     beats = []
     for b in cpm:
-        m0 = [bpm/b for k in range(b)]
-        beats += m0
-    
-# A major chord could come from two major scales
-    
-    major_dict = {
-        'C':  ('C', 'G'),
-        'F':  ('F', 'C'),
-        'Bb': ('Bb', 'F'),
-        'Eb': ('Eb', 'Bb'),
-        'Ab': ('Ab', 'Eb'),
-        'Db': ('Db', 'Ab'),
-        'Gb': ('Gb', 'Db'),
-        'B': ('B', 'Gb'),
-        'E': ('E', 'B'),
-        'A': ('A', 'E'),
-        'D': ('D', 'A'),
-        'G': ('G', 'D')
-    }
+        beats += [bpm/b]*b
+    return beats
 
-# A minor chord could come from three major scales
+@ctrace.traced()
+def estimatekeys(bpms, progressions):
+    """Batch key estimation.  For each song, the beats of each chord are
+    added (in chord order) to the keys the chord could come from, using
+    the precomputed (quality x root) => key table.  Returns the
+    (songs x 12) matrix of key scores, with columns in KEY_ORDER, and
+    the lemmatized progressions, which can be passed on to map2roman.
+    estimatekey(bpm, progression) is the ranking of one row.
 
-    minor_dict = {
-        'C': ('Bb', 'Ab', 'Eb'),
-        'F': ('Eb', 'Db', 'Ab'),
-        'Bb': ('Ab', 'Gb', 'Db'),
-        'Eb': ('Db', 'B', 'Gb'),
-        'Ab': ('Gb', 'E', 'B'),
-        'Db': ('B', 'A', 'E'),
-        'Gb': ('E', 'D', 'A'),
-        'B': ('A', 'G', 'D'),
-        'E': ('D', 'C', 'G'),
-        'A': ('G', 'F', 'C'),
-        'D': ('C', 'Bb', 'F'),
-        'G': ('F', 'Eb', 'Bb')
-    }
+    """
 
-# A 7th chord could come from one major scale
+    ctrace.count('songs keyed', len(progressions))
+    lemmas = lemmatize_batch(progressions)
+    codes = []
+    weights = []
+    songs = []
+    for n, (bpm, progression, lemma) in enumerate(zip(bpms, progressions, lemmas)):
+        chords = strip_bars(lemma)
+        beats = chord_beats(bpm, progression)
+        codes += map(CHORD_TABLE.code, chords)
+        weights += [beats[k] for k in range(len(chords))]
+        songs += [n]*len(chords)
+
+    pitches, qualities = CHORD_TABLE.code_arrays()
+    codes = np.array(codes, dtype=np.int64)
+    p = pitches[codes]
+    q = qualities[codes]
+    keyed = KEY_WEIGHTS[q].any(axis=(1, 2))
+    if (keyed & (p < 0)).any():
+        bad = CHORD_TABLE.symbols[codes[keyed & (p < 0)][0]]
+        raise ValueError('Cannot find the keys of chord symbol: ' + repr(bad))
+
+    # Scatter-add the beat weights.  np.add.at accumulates in index
+    # order, so each key's score is summed in chord order exactly as in
+    # a loop over the chords
+    chord, key = np.nonzero(KEY_WEIGHTS[q, np.maximum(p, 0)])
+    scores = np.zeros((len(progressions), len(KEY_ORDER)))
+    np.add.at(scores, (np.array(songs, dtype=np.int64)[chord], key), np.array(weights)[chord])
+    return scores, lemmas
+
+def rank_keys(scores):
+    """Return the keys sorted by decreasing score (ties in KEY_ORDER) as
+    a list of (key, score) tuples, given one row of estimatekeys
 
-    seven_dict = {
-        'C': ('F',),
-        'F': ('Bb',),
-        'Bb': ('Eb',),
-        'Eb': ('Ab',),
-        'Ab': ('Db',),
-        'Db': ('Gb',),
-        'Gb': ('B',),
-        'B': ('E',),
-        'E': ('A',),
-        'A': ('D',),
-        'D': ('G',),
-        'G': ('C',)
-    }
+    """
+    return sorted(zip(KEY_ORDER, scores.tolist()), reverse = 1, key = lambda x: x[1])
 
-# A m7b5 chord could come from one major scale
-    
-    half_dict = {
-        'C': ('Db',),
-        'F': ('Gb',),
-        'Bb': ('B',),
-        'Eb': ('E',),
-        'Ab': ('A',),
-        'Db': ('D',),
-        'Gb': ('G',),
-        'B': ('C',),
-        'E': ('F',),
-        'A': ('Bb',),
-        'D': ('Eb',),
-        'G': ('Ab',)
-    }
+def estimatekey(bpm, progression):
 
-# A five chord (eg, a power chord like C5) can belong to six major scales
-    
+# Find the weighted major key of each chord (except diminished) and return the
+# most frequent
 
-    five_dict = {
-        'C': ('C', 'Eb', 'F', 'G', 'Ab', 'Bb'),
-        'F': ('C', 'Db', 'Eb', 'F', 'Ab', 'Bb'),
-        'Bb': ('Db', 'Eb', 'F', 'Gb', 'Ab', 'Bb'),
-        'Eb': ('Db', 'Eb', 'Gb', 'Ab', 'Bb', 'B'),
-        'Ab': ('Db', 'Eb', 'E', 'Gb', 'Ab', 'B'),
-        'Db': ('Db', 'E', 'Gb', 'Ab', 'A', 'B'),
-        'Gb': ('Db', 'D', 'E', 'Gb', 'A', 'B'),
-        'B': ('D', 'E', 'Gb', 'G', 'A', 'B'),
-        'E': ('C', 'D', 'E', 'G', 'A', 'B'),
-        'A': ('C', 'D', 'E', 'F', 'G', 'A'),
-        'D': ('C', 'D', 'F', 'G', 'A', 'Bb'),
-        'G': ('C', 'D', 'Eb', 'F', 'G', 'Bb')
-    }
-        
-# Tabulate chord root populations
-
-    majkey_frq = {item: 0 for item in major_dict}
-
-    for k, c in enumerate(chords):
-        w = beats[k]
-        q = getclass(c);
-        r = getroot(c);
-
-        s = ()
-        if q == '7':
-            s = seven_dict[r]
-        elif re.match('M7|M', q):
-            s = major_dict[r]
-        elif re.match('m7|m', q):
-            s = minor_dict[r]
-        elif q == 'h7':
-            s = half_dict[r]
-        elif q == '5':
-            s = five_dict[r]
-
-        for k in s:
-            majkey_frq[k] += w
-            
-    sorted_majkeys = sorted(majkey_frq.items(), reverse = 1, key = lambda x: x[1])
-    return sorted_majkeys
+    scores, lemmas = estimatekeys([bpm], [progression])
+    return rank_keys(scores[0])
             
 def lemmatize(progression):
     """Convert all slash chords, sus chords, major triads, and add9 chords
@@ -281,7 +455,19 @@ def map_enharmonic(chord):
     symbols (for example 'NC' and '|') are unchanged.
 
     """
-    chord = re.sub(r'\s+', '', chord)
+    enharmonic = CHORD_TABLE[chord].enharmonic
+    if enharmonic is None:
+        raise ValueError('Cannot map chord symbol to enharmonic form: ' + repr(chord))
+    return enharmonic
+
+_WHITESPACE = re.compile(r'\s+')
+_ENHARMONIC_ROOT = re.compile(r'([A-G](b|#)?)(.*)')
+
+def _map_enharmonic(chord):
+    """Parse the enharmonic form of a chord symbol (see map_enharmonic)
+
+    """
+    chord = _WHITESPACE.sub('', chord)
     chorddict = {
         'A':  'A',
         'B':  'B',
@@ -311,8 +497,8 @@ def map_enharmonic(chord):
     # Split slash chords and polychords into two parts and process
     # each separarately
     
-    slashchord = re.split(r'\/', chord)
-    polychord = re.split(r'\\', chord)
+    slashchord = chord.split('/')
+    polychord = chord.split('\\')
     type = ''
     if len(slashchord) == 2:
         c0 = map_enharmonic(slashchord[0])
@@ -322,8 +508,8 @@ def map_enharmonic(chord):
         c0 = map_enharmonic(polychord[0])
         c1 = map_enharmonic(polychord[1])
         return c0 + '\\' + c1
-    elif re.match(r'[A-G](b|#)?', chord):
-        m = re.match(r'([A-G](b|#)?)(.*)', chord)
+    elif _ENHARMONIC_ROOT.match(chord):
+        m = _ENHARMONIC_ROOT.match(chord)
         (root, accidental, type) = m.groups()
     else:
         root = chord
@@ -341,11 +527,20 @@ def convert_slash(chord):
     analyzes the context and decides how to appropriately convert
     slash chords.
 
+    """
+    deslashed = CHORD_TABLE[chord].deslashed
+    if deslashed is None:
+        raise ValueError('Cannot convert slash chord symbol: ' + repr(chord))
+    return deslashed
+
+def _convert_slash(chord):
+    """Parse the de-slashed form of a chord symbol (see convert_slash)
+
     """
 
-    if re.search('/', chord):
+    if '/' in chord:
         slashchord = chord
-        [upperchord, bass] = re.split('/', slashchord)
+        [upperchord, bass] = slashchord.split('/')
         interval = getinterval(upperchord, bass)
         root = getroot(upperchord)
         quality = getclass(upperchord)
@@ -394,9 +589,9 @@ def convert_slash(chord):
             converted_chord = bass + 'sus4b9'
         else:
             converted_chord = upperchord
-    elif re.search('\\\\', chord):
+    elif '\\' in chord:
         polychord = chord
-        [lowerchord, upperchord] = re.split('\\\\', polychord)
+        [lowerchord, upperchord] = polychord.split('\\')
         converted_chord = upperchord
     else:
         converted_chord = chord
@@ -642,6 +837,197 @@ def convert_major_triad(compressed):
 
     return compressed
 
+# Quality classes returned by getclass, followed by the classes that the
+# context rules of convert_add9, convert_major_triad and
+# convert_sus_chord test for.  getclass does not currently return the
+# latter, so those rules are dormant, but they are kept in the tables
+# so that the integer lemmatizer follows the same rules as lemmatize
+
+QUALITY_CLASSES = ['M', 'm', '7', 'h', 'o', 'NC', 'U', 'add9', 'madd9', 'MT', 'sus', '7b9']
+QUALITY_CODE = {q: k for k, q in enumerate(QUALITY_CLASSES)}
+
+# Interval code used when either chord has no root pitch class (eg, NC)
+
+NO_INTERVAL = 12
+
+def lemma_rule_tables():
+    """Express the context rules of lemmatize as lookup tables of
+    actions.  An action is a (root offset, suffix) pair rewriting a
+    chord with root pitch class r as CHROMATIC[(r+offset)%12] + suffix;
+    action 0 leaves the chord unchanged.  The add9 table is indexed by
+    quality code, and the major triad and sus tables by (quality, next
+    quality, interval from the root to the next root), the interval
+    being NO_INTERVAL if either chord has no root.  A fifth down is an
+    interval of 5 and a semitone down one of 11.
+
+    """
+
+    actions = [None]
+    def action(offset, suffix):
+        if (offset, suffix) not in actions:
+            actions.append((offset, suffix))
+        return actions.index((offset, suffix))
+
+    Q = QUALITY_CODE
+    add9 = np.zeros(len(Q), dtype=np.int64)
+    add9[Q['add9']] = action(2, '9sus4')
+    add9[Q['madd9']] = action(2, 'sus4b9')
+
+    triad = np.zeros((len(Q), len(Q), NO_INTERVAL+1), dtype=np.int64)
+    triad[Q['MT']] = action(0, 'M7')
+    for interval in (5, 11):
+        triad[Q['MT'], Q['M'], interval] = action(0, '7')
+        triad[Q['MT'], Q['MT'], interval] = action(0, '7')
+        triad[Q['MT'], Q['m'], interval] = action(0, '7b9')
+
+    sus = np.zeros((len(Q), len(Q), NO_INTERVAL+1), dtype=np.int64)
+    sus[Q['sus']] = action(0, '7')
+    for interval in (5, 11):
+        sus[Q['sus'], Q['m'], interval] = action(0, '7b9')
+    sus[Q['sus'], Q['7'], 0] = action(7, 'm7')
+    sus[Q['sus'], Q['7b9'], 0] = action(7, 'm7b5')
+
+    return actions, add9, triad, sus
+
+LEMMA_ACTIONS, ADD9_RULES, TRIAD_RULES, SUS_RULES = lemma_rule_tables()
+KEY_WEIGHTS = key_weight_table()
+
+_SUS2 = re.compile('sus2$')
+
+def _sus_inversion(symbol):
+    """Map sus2 chords to their sus4 inversions and sus24 chords to sus4
+    chords, as at the start of convert_sus_chord
+
+    """
+    if _SUS2.search(symbol):
+        pitch = CHORD_TABLE[symbol].pitch
+        if pitch is None:
+            raise ValueError('Cannot invert sus2 chord symbol: ' + repr(symbol))
+        symbol = CHROMATIC[(pitch+7)%12] + 'sus4'
+    if 'sus24' in symbol:
+        symbol = symbol.replace('sus24', 'sus4')
+    return symbol
+
+def _apply_lemma_actions(run_codes, actions):
+    """Rewrite the runs whose action is non-zero
+
+    """
+    fire = np.flatnonzero(actions)
+    if len(fire) == 0:
+        return run_codes
+    run_codes = run_codes.copy()
+    for k, a in zip(fire.tolist(), actions[fire].tolist()):
+        record = CHORD_TABLE[CHORD_TABLE.symbols[run_codes[k]]]
+        if record.pitch is None:
+            raise ValueError('Cannot apply lemmatization rule to chord symbol: ' + repr(record.symbol))
+        offset, suffix = LEMMA_ACTIONS[a]
+        run_codes[k] = CHORD_TABLE.code(CHROMATIC[(record.pitch+offset)%12] + suffix)
+    return run_codes
+
+def _context_actions(rules, run_codes, nxt):
+    """Look up the action of every run given the run that follows it
+
+    """
+    pitches, qualities = CHORD_TABLE.code_arrays()
+    p1 = pitches[run_codes]
+    p2 = p1[nxt]
+    q1 = qualities[run_codes]
+    q2 = q1[nxt]
+    interval = np.where((p1 < 0) | (p2 < 0), NO_INTERVAL, (p2 - p1) % 12)
+    return rules[q1, q2, interval]
+
+def lemmatize_codes(codes, lengths):
+    """Integer-coded form of the context-dependent part of lemmatize.
+    The input is the concatenated CHORD_TABLE codes of the
+    enharmonically mapped and de-slashed chords of a batch of songs,
+    and the number of chords in each song.  Contiguous repeats are
+    collapsed into runs (as by compress_sequence), the add9, major
+    triad and sus rules are applied to all runs of all songs at once
+    through the rule tables, and the runs are expanded back into an
+    array of codes with the same layout as the input.  As in lemmatize,
+    each rule sees the chords as they were before that rule was
+    applied, and the last chord of a song is followed by its first.
+
+    """
+
+    codes = np.asarray(codes, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    N = len(codes)
+    if N == 0:
+        return codes
+
+    # Compress contiguous repeats within each song into runs
+    song = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.ones(N, dtype=bool)
+    starts[1:] = (codes[1:] != codes[:-1]) | (song[1:] != song[:-1])
+    run_pos = np.flatnonzero(starts)
+    run_codes = codes[run_pos]
+    run_song = song[run_pos]
+    run_len = np.diff(np.append(run_pos, N))
+
+    # The run following each run, wrapping around within its song
+    R = len(run_codes)
+    first = np.ones(R, dtype=bool)
+    first[1:] = run_song[1:] != run_song[:-1]
+    last = np.ones(R, dtype=bool)
+    last[:-1] = first[1:]
+    song_first = np.maximum.accumulate(np.where(first, np.arange(R), 0))
+    nxt = np.where(last, song_first, np.arange(1, R+1))
+
+    pitches, qualities = CHORD_TABLE.code_arrays()
+    run_codes = _apply_lemma_actions(run_codes, ADD9_RULES[qualities[run_codes]])
+    run_codes = _apply_lemma_actions(run_codes, _context_actions(TRIAD_RULES, run_codes, nxt))
+    distinct, inverse = np.unique(run_codes, return_inverse=True)
+    run_codes = np.array([CHORD_TABLE.inversion(c) for c in distinct.tolist()], dtype=np.int64)[inverse]
+    run_codes = _apply_lemma_actions(run_codes, _context_actions(SUS_RULES, run_codes, nxt))
+
+    return np.repeat(run_codes, run_len)
+
+@ctrace.traced()
+def lemmatize_batch(progressions):
+    """Lemmatize a batch of progressions with the integer-coded
+    lemmatizer (see lemmatize_codes).  The output is identical to
+    [lemmatize(p) for p in progressions]
+
+    """
+
+    chords = [strip_bars(p) for p in progressions]
+    deslashed = {}
+    for c in chords:
+        for s in c:
+            if s not in deslashed:
+                deslashed[s] = CHORD_TABLE.code(convert_slash(map_enharmonic(s)))
+    codes = [deslashed[s] for c in chords for s in c]
+    lengths = [len(c) for c in chords]
+    lemmas = lemmatize_codes(codes, lengths).tolist()
+
+    out = []
+    k = 0
+    for p, n in zip(progressions, lengths):
+        out.append(inject_bars(p, [CHORD_TABLE.symbols[c] for c in lemmas[k:k+n]]))
+        k += n
+    return out
+
+# Progressions exercising the enharmonic, slash chord, add9 and sus
+# rules of lemmatize, checked against lemmatize_batch along with the
+# whole corpus (see test_ChordProgUtils.py)
+
+LEMMATIZER_CHECKS = [
+    ['C', '|', 'F', '|', 'Bb', '|', 'Eb', '|'],
+    ['G7sus4', '|', 'C7sus4', '|', 'F7', '|', 'Bbsus2', '|', 'Eb', '|'],
+    ['Gadd9/B', '|', 'C/E', '|', 'D7/F#', '|', 'G', '|', 'Gm', '|', 'C', '|', 'Bm7', '|'],
+    ['C9sus4', '|', 'Cm', '|', 'Dbsus4', '|', 'Cm7', '|', 'F', 'E', '|', 'NC', '|'],
+    ['Eb/F', '|', 'Bb7', '|', 'F#', '|', 'BM7', '|', 'Cadd9', 'Cmadd9', '|', 'G7sus4', '|', 'G7b9', '|'],
+]
+
+def check_lemmatizer(progressions=LEMMATIZER_CHECKS):
+    """Return the indices of the progressions for which lemmatize_batch
+    and lemmatize disagree
+
+    """
+    fast = lemmatize_batch(progressions)
+    return [k for k, p in enumerate(progressions) if lemmatize(p) != fast[k]]
+
 def inject_bars(progression, symbols):
     """Create a symbol progression by injecting the input symbols into a
        structure with the same bar separators as the input progression
@@ -680,22 +1066,19 @@ def strip_bars(progression):
     return symbols
 
 def getinterval(chord1, chord2):
-    r1 = getroot(chord1)
-    r2 = getroot(chord2)
-    chromatic = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
     interval = ['0', 'bii', 'ii', 'biii', 'iii', 'iv', 'bv', 'v', 'bvi', 'vi', 'bvii', 'vii']
-    b1 = chromatic.index(r1)
-    b2 = chromatic.index(r2)
+    b1 = CHORD_TABLE[chord1].pitch
+    b2 = CHORD_TABLE[chord2].pitch
+    if b1 is None or b2 is None:
+        raise ValueError('No interval between chord symbols ' + repr(chord1) + ' and ' + repr(chord2))
     delta = b2 - b1
     if delta < 0: delta += 12
     return interval[delta]
 
 def getroot(chord):
-    if chord != 'NC':
-        m = re.match('([A-G]b?)', chord)
-        root = m.groups()[0]
-    else:
-        root = chord
+    root = CHORD_TABLE[chord].root
+    if root is None:
+        raise ValueError('Cannot find the root of chord symbol: ' + repr(chord))
     return root
 
 def getclass(chord):
@@ -708,46 +1091,70 @@ def getclass(chord):
 
     """
 
-    # The order of the tests is important (e.g., 7sus4 vs 7)
-    
-    if re.match('^[A-G]b?(m7b5|h7)', chord):
-        chordclass = 'h'
-    elif re.match('^[A-G]b?(7|9|13)?sus4?', chord):
-        chordclass = '7'
-    elif re.match('^[A-G]b?maj(7|9|11|13)', chord):
-        chordclass = 'M'
-    elif re.match('^[A-G]b?(M|M7|M9|2|6|69)', chord):
-        chordclass = 'M'
-    elif re.match('^[A-G]b?m(M|Maj)?(7|9|11|13|6|b6|69)', chord):
-        chordclass = 'm'
-    elif re.match('^[A-G]b?(o|dim)M?7', chord):
-        chordclass = 'o'
-    elif re.match('^[A-G]b?(7sus4b9|7sus4b9b13|7b9sus4|susb9)', chord):
-        chordclass = '7'
-    elif re.match('^[A-G]b?(7|9|11|13|7alt|7\+)', chord):
-        chordclass = '7'
-    elif re.match('^[A-G]b?$', chord):
-        chordclass = 'M'
-    elif re.match('^[A-G]b?m', chord):
-        chordclass = 'm'
-    elif re.match('^[A-G]b?(4|phryg)', chord):
-        chordclass = 'm'
-    elif re.match('^[A-G]b?(\+|aug)', chord):
-        chordclass = '7'
-    elif re.match('^[A-G]b?(o|dim)$', chord):
-        chordclass = 'o'
-    elif re.match('^[A-G]b?addb?9', chord):
-        chordclass = 'M'
-    elif re.match('^[A-G]b?maddb?9', chord):
-        chordclass = 'm'
-    elif re.match('^[A-G]b?5$', chord):
-        chordclass = 'M'
-    elif chord == 'NC':
-        chordclass = 'NC'
+    return CHORD_TABLE[chord].quality
+
+_ROOT = re.compile('([A-G]b?)')
+
+def _getroot(chord):
+    if chord != 'NC':
+        m = _ROOT.match(chord)
+        root = m.groups()[0] if m else None
     else:
-        chordclass = 'U'
-    return chordclass
+        root = chord
+    return root
+
+# The order of the tests is important (e.g., 7sus4 vs 7)
+
+_CLASS_PATTERNS = [(re.compile(pattern), chordclass) for pattern, chordclass in [
+    ('^[A-G]b?(m7b5|h7)', 'h'),
+    ('^[A-G]b?(7|9|13)?sus4?', '7'),
+    ('^[A-G]b?maj(7|9|11|13)', 'M'),
+    ('^[A-G]b?(M|M7|M9|2|6|69)', 'M'),
+    ('^[A-G]b?m(M|Maj)?(7|9|11|13|6|b6|69)', 'm'),
+    ('^[A-G]b?(o|dim)M?7', 'o'),
+    ('^[A-G]b?(7sus4b9|7sus4b9b13|7b9sus4|susb9)', '7'),
+    (r'^[A-G]b?(7|9|11|13|7alt|7\+)', '7'),
+    ('^[A-G]b?$', 'M'),
+    ('^[A-G]b?m', 'm'),
+    ('^[A-G]b?(4|phryg)', 'm'),
+    (r'^[A-G]b?(\+|aug)', '7'),
+    ('^[A-G]b?(o|dim)$', 'o'),
+    ('^[A-G]b?addb?9', 'M'),
+    ('^[A-G]b?maddb?9', 'm'),
+    ('^[A-G]b?5$', 'M'),
+]]
+
+def _getclass(chord):
+    for pattern, chordclass in _CLASS_PATTERNS:
+        if pattern.match(chord):
+            return chordclass
+    if chord == 'NC':
+        return 'NC'
+    return 'U'
+
+def parse_chord_symbol(symbol):
+    """Parse a chord symbol into a ChordSymbol record.  This is the
+    uncached path used by ChordTable for symbols it has not seen; all
+    other code should look symbols up in the table
 
+    """
+
+    root = _getroot(symbol)
+    pitch = CHROMATIC.index(root) if root in CHROMATIC else None
+    quality = _getclass(symbol)
+    try:
+        enharmonic = _map_enharmonic(symbol)
+    except (KeyError, ValueError):
+        enharmonic = None
+    try:
+        deslashed = _convert_slash(symbol)
+    except (KeyError, ValueError):
+        deslashed = None
+    parts = symbol.split('/')
+    bass = parts[1] if len(parts) == 2 else None
+    return ChordSymbol(symbol, root, pitch, quality, enharmonic, deslashed, bass)
+
+@ctrace.traced(events=False)
 def getsong(song):
     """Given a song filename, import the song's data, and make its
     contents available as variables
@@ -769,37 +1176,29 @@ def getsong(song):
     prog = re.sub(r'^\s+', '', prog)
     prog = re.sub(r'\s+\|\s*$', '', prog)
     prog = prog.split()
+    ctrace.count('songs parsed')
     
     return title, composedby, dbkeysig, timesig, nbars, prog
 
-def findsong(search_term):
+def findsong(search_term, songdb_paths=None):
     """Input is string containing tokens separated by white space.  Result
-    is list of songs that contain all the tokens.  Example: 
-    
-    song = findsong('gre do') 
-    print(song) 
-    'SongDB/OnGreenDolphinStreet.txt'
-
-    """
-    terms = search_term.split()
-    allsongs = os.listdir('SongDB')
-    lst = []
-    for t in terms:
-        idx = {k for k in range(len(allsongs)) if re.search(t, allsongs[k], re.IGNORECASE)}
-        lst.append(idx)
-    res = list(lst[0].intersection(*lst))
-    if len(res) == 1:
-        song = allsongs[res[0]]
-    elif len(res) > 1:
-        for i, j in enumerate(res):
-            print(i, allsongs[j])
-        choice = int(input('\nSong number? '))
-        song = allsongs[res[choice]]
-    else:
-        print('\n ==> Search term ambiguous\n')
+    is the path of the song whose title (or file name, or composer)
+    best matches the tokens, or None if no song matches.  The search
+    uses the metadata index of all SongDB subdirectories (see
+    ChordCorpusUtils.SongIndex), built on the first call.  Example:
+
+    song = findsong('gre do')
+    print(song)
+    '../SongDB/Songs[H-O]/OnGreenDolphinStreet.txt'
 
-    return song
+    """
+    # ChordCorpusUtils imports this module, so import it on use
+    import ChordCorpusUtils as ccorp
+    index = ccorp.SongIndex.open(songdb_paths or ccorp.SONGDB_PATHS)
+    best = index.search(search_term, 1)
+    return index.paths[best[0][0]] if best else None
 
+@ctrace.traced(events=False)
 def get_beats(timesig, roman):
     bpm = timesig[0]
     btyp = timesig[1]
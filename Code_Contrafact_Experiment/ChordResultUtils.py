@@ -0,0 +1,184 @@
+import os
+import json
+import queue
+import argparse
+import threading
+import numpy as np
+
+RESULTS_DIR = 'EXPERIMENTAL_RESULTS'
+RESULTS_FILE = os.path.join(RESULTS_DIR, 'results.bin')
+RESULTS_MAGIC = b'JCPRSLT1'
+
+class ResultWriter:
+    """Writes the ranked membrane areas of every query song (contrafact)
+    to one columnar file.  The file is laid out like the compiled
+    corpus store (see ChordCorpusUtils.compile_corpus): a JSON header
+    (the corpus titles and the array layout) followed by 8-byte aligned
+    arrays, preallocated for n_queries queries and memory-mapped.  Each
+    query adds its candidates in ranked order with add(); a background
+    thread copies them into place, so every byte is written once, and
+    bumps the count of completed queries.  The mapping is flushed to
+    disk every flush_every queries and by close(), so a crash loses at
+    most the queries added since the last flush.  The file holds, per
+    row:
+
+      query      int32    corpus index of the query song
+      candidate  int32    corpus index of the candidate song
+      area       float64  membrane area (-1 for the query itself)
+      rank       int32    position of the candidate in the ranking
+
+    and, per query (rows of query k are offsets[k]:offsets[k+1]):
+
+      queries, originals, orig_ranks, offsets
+
+    plus the number of completed queries and the corpus titles, so that
+    candidate ids can be resolved
+
+    """
+
+    def __init__(self, path, titles, n_queries, flush_every=16):
+        self.path = path
+        self.flush_every = flush_every
+        N = len(titles)
+        layout = [('query', np.int32, n_queries*N), ('candidate', np.int32, n_queries*N),
+                  ('area', np.float64, n_queries*N), ('rank', np.int32, n_queries*N),
+                  ('queries', np.int32, n_queries), ('originals', np.int32, n_queries),
+                  ('orig_ranks', np.int32, n_queries), ('offsets', np.int64, n_queries+1),
+                  ('completed', np.int64, 1)]
+        header = {'titles': list(titles), 'arrays': {}}
+        offset = 0
+        for name, dtype, n in layout:
+            header['arrays'][name] = [np.dtype(dtype).str, n, offset]
+            offset += -(-np.dtype(dtype).itemsize*n//8)*8
+        hbytes = json.dumps(header).encode()
+        hbytes += b' '*(-(len(hbytes)+16) % 8)
+        base = 16 + len(hbytes)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(RESULTS_MAGIC)
+            fh.write(np.uint64(len(hbytes)).tobytes())
+            fh.write(hbytes)
+            fh.truncate(base + offset)
+        self.buf = np.memmap(path, dtype=np.uint8, mode='r+')
+        self.columns = {name: np.frombuffer(self.buf, dtype=dtype, count=n, offset=base+off)
+                        for name, (dtype, n, off) in header['arrays'].items()}
+        self.columns['offsets'][0] = 0
+        self.n = 0
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, query, original, orig_rank, ranked, areas):
+        """Add the results of one query: the corpus indices of its
+        original song, the original's rank, the candidates in ranked
+        order and the areas of all songs (indexed by corpus index)
+
+        """
+        self.queue.put((query, original, orig_rank, ranked, areas))
+
+    def _append(self, query, original, orig_rank, ranked, areas):
+        c, k = self.columns, self.n
+        ranked = np.asarray(ranked)
+        start, stop = c['offsets'][k], c['offsets'][k] + len(ranked)
+        c['query'][start:stop] = query
+        c['candidate'][start:stop] = ranked
+        c['area'][start:stop] = np.asarray(areas, dtype=float)[ranked]
+        c['rank'][start:stop] = np.arange(len(ranked))
+        c['queries'][k] = query
+        c['originals'][k] = original
+        c['orig_ranks'][k] = orig_rank
+        c['offsets'][k+1] = stop
+        # Only count the query once its rows are in place
+        self.n = k + 1
+        c['completed'][0] = self.n
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    self.buf.flush()
+                    return
+                self._append(*item)
+                if self.flush_every and self.n % self.flush_every == 0:
+                    self.buf.flush()
+            except Exception as e:
+                self.error = e
+                return
+
+    def close(self):
+        """Flush the file once the queued results are in, without
+        waiting for it (see join)
+
+        """
+        self.queue.put(None)
+
+    def join(self):
+        """Wait for the file to be flushed.  Raises the writer's error,
+        if any
+
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def load_results(path=RESULTS_FILE):
+    """
+    Return the results written by a ResultWriter as a dict of arrays
+    memory-mapped from the file, holding the completed queries only
+    """
+    with open(path, 'rb') as fh:
+        if fh.read(8) != RESULTS_MAGIC:
+            raise ValueError(path + ' is not a results file')
+        hlen = int(np.frombuffer(fh.read(8), dtype=np.uint64)[0])
+        header = json.loads(fh.read(hlen))
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    base = 16 + hlen
+    arrays = {name: np.frombuffer(buf, dtype=dtype, count=n, offset=base+offset)
+              for name, (dtype, n, offset) in header['arrays'].items()}
+    n = int(arrays.pop('completed')[0])
+    rows = int(arrays['offsets'][n])
+    results = {name: arrays[name][:n] for name in ('queries', 'originals', 'orig_ranks')}
+    results['offsets'] = arrays['offsets'][:n+1]
+    results.update({name: arrays[name][:rows] for name in ('query', 'candidate', 'area', 'rank')})
+    results['titles'] = np.array(header['titles'])
+    return results
+
+def query_results(results, k):
+    """
+    Return the candidate ids, areas and ranks of the k-th query of the
+    results (see load_results)
+    """
+    start, stop = results['offsets'][k], results['offsets'][k+1]
+    return results['candidate'][start:stop], results['area'][start:stop], results['rank'][start:stop]
+
+def export_text(results, directory=RESULTS_DIR):
+    """
+    Write the results in the text layout of the original experiment:
+    one file per contrafact, named <original rank>__<original>__<contrafact
+    file>, with a line 'rank<TAB>area<TAB>title' per candidate
+    """
+    titles = [str(t) for t in results['titles']]
+    os.makedirs(directory, exist_ok=True)
+    for k, (q, o, r) in enumerate(zip(results['queries'], results['originals'], results['orig_ranks'])):
+        candidates, areas, ranks = query_results(results, k)
+        fname = str(r).zfill(4)+'__'+titles[o].split('.')[0]+'__'+titles[q]
+        lines = [str(d) + '\t' + ('-1' if i == q else str(float(a))) + '\t' + titles[i].split('.')[0] + '\n'
+                 for d, a, i in zip(ranks.tolist(), areas.tolist(), candidates.tolist())]
+        with open(os.path.join(directory, fname), 'w') as f:
+            f.writelines(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Contrafact experiment result files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('export-text', help='write the results as one text file per contrafact')
+    p.add_argument('--results', default=RESULTS_FILE)
+    p.add_argument('directory', nargs='?', default=RESULTS_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'export-text':
+        results = load_results(args.results)
+        export_text(results, args.directory)
+        print('Wrote', len(results['queries']), 'result files to', args.directory)
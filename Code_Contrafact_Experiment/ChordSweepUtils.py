@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from texttable import Texttable
+import ChordVecUtils as cvu
+import ChordCorpusUtils as ccorp
+
+CONTRAFACT_LIST = 'CONTRAFACT_DATA/contrafact_list.csv'
+SWEEP_GRID = {'win_size': [1, 2, 3, 4], 'causal': [False, True], 'cmpress': [True, False]}
+
+def sweep_configs(grid=SWEEP_GRID):
+    """
+    Return the list of co-occurrence configurations of a sweep grid,
+    each a dict with keys win_size, causal and cmpress.  The grid is
+    either a dict mapping each key to a list of values (all
+    combinations are swept) or a list of configurations.  As in
+    contrafact_experiment.py, causal matrices are always built from the
+    raw progressions, so cmpress is cleared for causal configurations
+    and the duplicates this creates are dropped
+    """
+    if isinstance(grid, dict):
+        keys = ('win_size', 'causal', 'cmpress')
+        values = [grid.get(k, SWEEP_GRID[k]) for k in keys]
+        grid = [dict(zip(keys, v)) for v in itertools.product(*values)]
+    configs = []
+    for c in grid:
+        config = {'win_size': int(c['win_size']), 'causal': bool(c['causal']),
+                  'cmpress': bool(c['cmpress']) and not bool(c['causal'])}
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+def read_sweep_grid(path):
+    """
+    Return the configurations of the sweep grid in the JSON file at
+    path (see sweep_configs)
+    """
+    with open(path) as f:
+        return sweep_configs(json.load(f))
+
+def contrafact_rank(areas, cfact_index, orig_index):
+    """
+    Return the rank of the original song among the membrane areas from
+    its contrafact, as in contrafact_experiment.py: the contrafact
+    itself is ranked first and ties with the original are resolved in
+    its favour, so the rank is the number of songs with a smaller area
+    """
+    areas = np.array(areas, dtype=float)
+    areas[cfact_index] = -1
+    return int(np.count_nonzero(areas < areas[orig_index]))
+
+# State shared with forked sweep workers: the ingested corpus (a
+# cvu.Corpus) and the cumulative lagged co-occurrence counts
+_sweep_state = {}
+
+def _run_config(config):
+    """Rank every contrafact's original under one configuration
+
+    """
+    t0 = time.perf_counter()
+    state = _sweep_state
+    counts = state['lagged'][config['cmpress']][config['win_size']]
+    if not config['causal']:
+        counts = counts + counts.T
+    M = cvu.normalize_rows(counts)
+
+    corpus = state['corpus']
+    samples = cvu.membrane_samples(state['n_samples'])
+    points = cvu.make_corpus_path_samples(corpus, None, corpus.chord_idx, M, samples)
+
+    cfacts, origs = state['cfacts'], state['origs']
+    areas = cvu.membrane_distance_matrix(points[cfacts], points, dtype=float)
+    ranks = [contrafact_rank(row, c, o) for row, c, o in zip(areas, cfacts, origs)]
+    result = dict(config)
+    result.update({'median_rank': float(np.median(ranks)), 'mean_rank': float(np.mean(ranks)),
+                   'ranks': ranks, 'seconds': time.perf_counter() - t0})
+    return result
+
+def run_sweep(configs, songdb_paths=ccorp.SONGDB_PATHS, contrafact_list=CONTRAFACT_LIST,
+              processes=None, n_samples=cvu.MEMBRANE_SAMPLES, progress=False):
+    """
+    Run the contrafact experiment for every co-occurrence configuration
+    and return one result dict per configuration (the configuration,
+    median_rank, mean_rank, the 80 ranks and the seconds it took).  The
+    corpus is ingested and integer coded once, the co-occurrence
+    matrices of all window sizes come from one pass over the lagged
+    pairs for each of compressed and raw progressions, and the
+    configurations are spread across a pool of processes (all cores
+    if processes is None, inline if it is 1)
+    """
+    configs = sweep_configs(configs)
+    romans, meters, titles, timings = ccorp.ingest_corpus(songdb_paths, progress=progress)
+    corpus = cvu.Corpus.from_lists(romans, meters, titles)
+    codes, docs, chord_idx = cvu.encode_corpus(corpus)
+    max_lag = max(c['win_size'] for c in configs)
+    lagged = {cmpress: cvu.lagged_co_occurrence_counts(codes, docs, len(chord_idx), max_lag, cmpress)
+              for cmpress in {c['cmpress'] for c in configs}}
+
+    df = pd.read_csv(contrafact_list)
+    _sweep_state.update({'corpus': corpus, 'lagged': lagged,
+                         'n_samples': n_samples,
+                         'cfacts': [titles.index(c) for c in df.contrafacts],
+                         'origs': [titles.index(o) for o in df.originals]})
+
+    if processes is None:
+        processes = os.cpu_count()
+    # Fork so the workers inherit the shared state without copying it;
+    # spawned workers would not see it, so run inline without fork
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+    if processes == 1:
+        results = map(_run_config, configs)
+        pool = None
+    else:
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(min(processes, len(configs)))
+        results = pool.imap(_run_config, configs)
+
+    sweep = []
+    for result in results:
+        sweep.append(result)
+        if progress:
+            sys.stderr.write('\rSwept {}/{} configurations'.format(len(sweep), len(configs)))
+            sys.stderr.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if progress:
+        sys.stderr.write('\n')
+    return sweep
+
+def sweep_table(sweep):
+    """
+    Return the comparison table of a sweep (median and mean rank of the
+    originals for each configuration) as a string
+    """
+    t = Texttable()
+    t.set_deco(Texttable.BORDER | Texttable.HEADER | Texttable.VLINES)
+    t.set_cols_align(['r', 'c', 'c', 'r', 'r', 'r'])
+    t.set_cols_dtype(['i', 't', 't', 'f', 'f', 'f'])
+    t.set_precision(2)
+    t.add_row(['win_size', 'causal', 'cmpress', 'median rank', 'mean rank', 'seconds'])
+    for r in sweep:
+        t.add_row([r['win_size'], str(r['causal']), str(r['cmpress']),
+                   r['median_rank'], r['mean_rank'], r['seconds']])
+    return t.draw()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Contrafact experiment parameter sweeps')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('sweep', help='rank the contrafacts under a grid of co-occurrence configurations')
+    p.add_argument('--grid', default=None, help='JSON sweep grid (default: window sizes 1-4, causal and symmetric, compressed and raw)')
+    p.add_argument('--processes', type=int, default=None)
+    p.add_argument('--samples', type=int, default=cvu.MEMBRANE_SAMPLES)
+    p.add_argument('--output', default=None, help='also write the per-configuration results to this JSON file')
+    p.add_argument('songdb_paths', nargs='*', default=ccorp.SONGDB_PATHS)
+    args = parser.parse_args()
+
+    if args.command == 'sweep':
+        configs = read_sweep_grid(args.grid) if args.grid else sweep_configs()
+        sweep = run_sweep(configs, args.songdb_paths, processes=args.processes,
+                          n_samples=args.samples, progress=True)
+        print(sweep_table(sweep))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(sweep, f, indent=1)
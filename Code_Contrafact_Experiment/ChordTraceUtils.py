@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+import tracemalloc
+
+# Opt-in instrumentation of the contrafact pipeline.  Nothing is
+# recorded unless enable() has been called (or enable_from_env() found
+# CONTRAFACT_TRACE set): stage() then returns a shared no-op context
+# manager, count() returns at once and traced functions call straight
+# through, so the hooks can stay in place in production runs.  When
+# enabled, stages are recorded as timed events (aggregated per stage
+# name as well), counters are summed, peak RSS is sampled at the end of
+# every stage and, with memory=True, tracemalloc snapshots are taken at
+# snapshot() calls.  Only the calling process is traced: pool workers
+# report their own timings (see ChordCorpusUtils.ingest_corpus), which
+# are added with add_time().
+
+ENABLED = False
+
+_NULL_STAGE = contextlib.nullcontext()
+_state = {}
+
+def reset():
+    """
+    Discard everything recorded so far and restart the trace clock
+    """
+    _state.update({'t0': time.perf_counter_ns(), 'events': [], 'timers': {}, 'calls': {},
+                   'counters': {}, 'snapshots': [], 'peak_rss_mib': 0.0})
+
+def enable(memory=False, memory_frames=1):
+    """
+    Start recording.  If memory is True tracemalloc is started as well
+    (with memory_frames frames per allocation), which slows allocation
+    heavy code noticeably
+    """
+    global ENABLED
+    reset()
+    _state['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start(memory_frames)
+    ENABLED = True
+
+def disable():
+    """
+    Stop recording (the recorded data is kept until reset or enable)
+    """
+    global ENABLED
+    ENABLED = False
+    if _state.get('memory') and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def enable_from_env():
+    """
+    Enable tracing if the CONTRAFACT_TRACE environment variable names
+    an output file, with tracemalloc if CONTRAFACT_TRACE_MEMORY is set
+    to a non-empty value other than 0.  Returns the output file name
+    (None if tracing is not requested)
+    """
+    path = os.environ.get('CONTRAFACT_TRACE')
+    if path:
+        enable(memory=os.environ.get('CONTRAFACT_TRACE_MEMORY', '0') not in ('', '0'))
+    return path or None
+
+def peak_rss_mib():
+    """
+    Return the peak resident set size of the process in MiB, or None
+    where the resource module is not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+class _Stage:
+    """A timed stage, recorded when it exits
+
+    """
+    __slots__ = ('name', 'args', 'event', 't0')
+
+    def __init__(self, name, args, event=True):
+        self.name = name
+        self.args = args
+        self.event = event
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.perf_counter_ns()
+        dur = t1 - self.t0
+        _state['timers'][self.name] = _state['timers'].get(self.name, 0) + dur
+        _state['calls'][self.name] = _state['calls'].get(self.name, 0) + 1
+        if self.event:
+            _state['events'].append((self.name, self.t0 - _state['t0'], dur,
+                                     threading.get_ident(), self.args))
+            _state['peak_rss_mib'] = peak_rss_mib()
+        return False
+
+def stage(name, **args):
+    """
+    Return a context manager timing the stage name.  Keyword arguments
+    are attached to the stage's event
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(name, args)
+
+def traced(name=None, events=True):
+    """
+    Decorator timing every call of a function as the stage name (the
+    function name by default).  With events=False the calls are only
+    aggregated, for functions called too often to keep one event each
+    """
+    def decorate(f):
+        label = name or f.__name__
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            with _Stage(label, {}, events):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    """
+    Add n to the counter name
+    """
+    if not ENABLED:
+        return
+    _state['counters'][name] = _state['counters'].get(name, 0) + n
+
+def add_time(name, seconds, calls=0):
+    """
+    Add time measured elsewhere (for example in a worker process) to
+    the aggregated timer of the stage name
+    """
+    if not ENABLED:
+        return
+    _state['timers'][name] = _state['timers'].get(name, 0) + int(seconds*1e9)
+    _state['calls'][name] = _state['calls'].get(name, 0) + calls
+
+def snapshot(label, top=10):
+    """
+    Record the current and peak traced memory and the top allocation
+    sites (requires enable(memory=True)), and the peak RSS
+    """
+    if not ENABLED:
+        return
+    snap = {'label': label, 't_us': (time.perf_counter_ns() - _state['t0'])/1000,
+            'peak_rss_mib': peak_rss_mib()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:top]
+        snap.update({'traced_mib': current/2**20, 'traced_peak_mib': peak/2**20,
+                     'top': [{'site': str(s.traceback), 'mib': s.size/2**20, 'count': s.count}
+                             for s in stats]})
+    _state['snapshots'].append(snap)
+    _state['peak_rss_mib'] = snap['peak_rss_mib']
+
+def _max_rss(a, b):
+    """The larger of two peak RSS readings, either of which may be None
+
+    """
+    values = [v for v in (a, b) if v is not None]
+    return max(values) if values else None
+
+def report():
+    """
+    Return the recorded data as a dict: per-stage seconds and call
+    counts, counters, peak RSS and memory snapshots
+    """
+    return {'stages': {name: {'seconds': ns/1e9, 'calls': _state['calls'].get(name, 0)}
+                       for name, ns in _state['timers'].items()},
+            'counters': dict(_state['counters']),
+            'peak_rss_mib': _max_rss(_state['peak_rss_mib'], peak_rss_mib()),
+            'snapshots': list(_state['snapshots'])}
+
+def chrome_trace():
+    """
+    Return the recorded data in the Chrome trace event format (load it
+    in chrome://tracing or Perfetto): one complete event per stage, a
+    counter event per memory snapshot and the final counters
+    """
+    pid = os.getpid()
+    events = [{'name': name, 'cat': 'stage', 'ph': 'X', 'ts': t/1000, 'dur': dur/1000,
+               'pid': pid, 'tid': tid, 'args': args}
+              for name, t, dur, tid, args in _state['events']]
+    for snap in _state['snapshots']:
+        values = {k: snap[k] for k in ('peak_rss_mib', 'traced_mib') if snap.get(k) is not None}
+        events.append({'name': 'memory', 'ph': 'C', 'ts': snap['t_us'], 'pid': pid, 'args': values})
+    end = (time.perf_counter_ns() - _state['t0'])/1000
+    if _state['counters']:
+        events.append({'name': 'counters', 'ph': 'C', 'ts': end, 'pid': pid, 'args': dict(_state['counters'])})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': report()}
+
+def write_trace(path, fmt=None):
+    """
+    Write the recorded data to path, as a JSON report (fmt 'json') or a
+    Chrome trace (fmt 'chrome').  By default the format is taken from
+    CONTRAFACT_TRACE_FORMAT, or 'json'
+    """
+    fmt = fmt or os.environ.get('CONTRAFACT_TRACE_FORMAT', 'json')
+    data = chrome_trace() if fmt == 'chrome' else report()
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1)
+
+reset()
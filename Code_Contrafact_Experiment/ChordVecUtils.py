@@ -1,10 +1,17 @@
+import pickle
+import time
+import multiprocessing.pool
 import numpy as np
+from scipy import sparse
 from itertools import groupby
+import ChordTraceUtils as ctrace
 
 def distinct_chords(corpus):
     """
     Return the set of unique chords in the corpus
     """
+    if isinstance(corpus, Corpus):
+        return [corpus.vocab[t] for t in np.unique(corpus.tokens)]
     corpus_words = []
     flat = [y for x in corpus for y in x]
     corpus_words = list(set(flat))
@@ -21,102 +28,445 @@ def compress_sequence(chords):
     grouped_chords = [(k, len(list(g))) for k, g in groupby(chords)]
     return grouped_chords
 
+def encode_corpus(corpus, word_idx=None):
+    """
+    Return the corpus integer-encoded as one flat array of chord
+    indices, the array of song indices of each token, and the chord
+    index dictionary.  If word_idx is None it is built from
+    distinct_chords(corpus)
+    """
+    if isinstance(corpus, Corpus):
+        if word_idx is None:
+            return corpus.tokens.astype(np.int64), corpus.docs(), corpus.chord_idx
+        return corpus.code_map(word_idx)[corpus.tokens], corpus.docs(), word_idx
+    if word_idx is None:
+        words = distinct_chords(corpus)
+        word_idx = dict(zip(words,range(len(words))))
+    lengths = np.array([len(doc) for doc in corpus], dtype=np.int64)
+    codes = np.fromiter((word_idx[w] for doc in corpus for w in doc), dtype=np.int64, count=lengths.sum())
+    docs = np.repeat(np.arange(len(corpus)), lengths)
+    return codes, docs, word_idx
+
+class Corpus:
+    """An ingested corpus in compact ragged (CSR) form: the roman numeral
+    tokens of all songs in one int32 array of vocabulary codes, their
+    beats in one float32 array aligned with the tokens, and the offsets
+    of each song in both (song k is tokens[offsets[k]:offsets[k+1]]).
+    The vocabulary is sorted as in distinct_chords, so codes are the
+    chord indices of co_occurrence_matrix.  Song access returns views
+    of the arrays, and pickling copies just the arrays, vocabulary and
+    titles.
+
+    Songs whose meter is shorter than their chord sequence (see
+    get_beats) get zero beats for the trailing chords: zero-beat chords
+    add nothing to a song's path, so every path is unchanged.  The
+    utilities of this module accept a Corpus wherever they take a
+    corpus and its meters (pass None for the meters).
+
+    """
+
+    def __init__(self, tokens, beats, offsets, vocab, titles):
+        self.tokens = np.asarray(tokens, dtype=np.int32)
+        self.beats = np.asarray(beats, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.vocab = list(vocab)
+        self.titles = list(titles)
+
+    @classmethod
+    def from_lists(cls, romans, meters, titles, vocab=None):
+        """Build a Corpus from the lists returned by ingest_corpus
+
+        """
+        if vocab is None:
+            vocab = distinct_chords(romans)
+        word_idx = {w: i for i, w in enumerate(vocab)}
+        codes, docs, word_idx = encode_corpus(romans, word_idx)
+        offsets = np.zeros(len(romans)+1, dtype=np.int64)
+        np.cumsum([len(song) for song in romans], out=offsets[1:])
+        beats = np.zeros(len(codes), dtype=np.float32)
+        for k, meter in enumerate(meters):
+            if len(meter) > offsets[k+1] - offsets[k]:
+                raise ValueError('Meter longer than the song: ' + str(titles[k]))
+            beats[offsets[k]:offsets[k]+len(meter)] = meter
+        return cls(codes, beats, offsets, vocab, titles)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def song(self, k):
+        """Return views of the token codes and beats of song k
+
+        """
+        start, stop = self.offsets[k], self.offsets[k+1]
+        return self.tokens[start:stop], self.beats[start:stop]
+
+    def romans(self, k):
+        """Return the roman numeral progression of song k as strings
+
+        """
+        return [self.vocab[t] for t in self.song(k)[0].tolist()]
+
+    @property
+    def chord_idx(self):
+        return {w: i for i, w in enumerate(self.vocab)}
+
+    def docs(self):
+        """Return the song index of every token
+
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def code_map(self, chord_idx):
+        """Return the array mapping the corpus vocabulary codes to the
+        indices of chord_idx (the identity for the corpus' own)
+
+        """
+        return np.array([chord_idx[w] for w in self.vocab], dtype=np.int64)
+
+    def subset(self, indices):
+        """Return a new Corpus holding the songs with the given indices
+
+        """
+        songs = [self.song(k) for k in indices]
+        offsets = np.zeros(len(songs)+1, dtype=np.int64)
+        np.cumsum([len(t) for t, b in songs], out=offsets[1:])
+        tokens = np.concatenate([t for t, b in songs]) if songs else np.zeros(0)
+        beats = np.concatenate([b for t, b in songs]) if songs else np.zeros(0)
+        return Corpus(tokens, beats, offsets, self.vocab, [self.titles[k] for k in indices])
+
+    def to_lists(self):
+        """Return the corpus as lists of roman numeral progressions and
+        meters, and the titles
+
+        """
+        romans = [self.romans(k) for k in range(len(self))]
+        meters = [self.song(k)[1].tolist() for k in range(len(self))]
+        return romans, meters, list(self.titles)
+
+def compress_codes(codes, docs):
+    """
+    Return an encoded corpus (see encode_corpus) with contiguous
+    repeated chords collapsed, as in compress_sequence
+    """
+    keep = np.ones(len(codes), dtype=bool)
+    keep[1:] = (codes[1:] != codes[:-1]) | (docs[1:] != docs[:-1])
+    return codes[keep], docs[keep]
+
+def co_occurrence_pairs(codes, docs, window_size=2, causal=False, compressed=False):
+    """
+    Return the (center, context) chord index pairs of an encoded corpus
+    (see encode_corpus) as two arrays.  Pairs are generated with one
+    shifted-array comparison per lag, never crossing song boundaries.
+    A causal window only looks back, a symmetric one looks both ways.
+    A compressed corpus has contiguous repeated chords collapsed
+    first, as in compress_sequence
+    """
+    if compressed:
+        codes, docs = compress_codes(codes, docs)
+
+    rows = []
+    cols = []
+    for d in range(1, window_size+1):
+        same = docs[d:] == docs[:-d]
+        later = codes[d:][same]
+        earlier = codes[:-d][same]
+        rows.append(later)
+        cols.append(earlier)
+        if not causal:
+            rows.append(earlier)
+            cols.append(later)
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+@ctrace.traced()
+def co_occurrence_matrix(corpus, window_size=2, causal=False, compressed=False, dense=False):
+    """
+    Return the co-occurrence matrix of the distinct chords based on the
+    collection of songs in the corpus, and the chord index dictionary.
+    The window is window_size chords back (causal) or on both sides
+    (symmetric) of each chord, and the songs are optionally compressed
+    (see compress_sequence) beforehand.  The matrix is returned as a
+    scipy.sparse CSR matrix, or as a dense array if dense is True
+    """
+    codes, docs, word_idx = encode_corpus(corpus)
+    rows, cols = co_occurrence_pairs(codes, docs, window_size, causal, compressed)
+    ctrace.count('co-occurrence pairs', len(rows))
+    K = len(word_idx)
+
+    # Sum the duplicate pairs before building the sparse matrix with a
+    # sort of the linear cell indices, so that memory follows the
+    # number of pairs and of nonzero cells rather than K*K
+    cells, counts = np.unique(rows*K + cols, return_counts=True)
+    M = sparse.csr_matrix((counts.astype(float), (cells//K, cells%K)), shape=(K,K))
+    if dense:
+        M = M.toarray()
+    return M, word_idx
+
+def lagged_co_occurrence_counts(codes, docs, K, max_lag, compressed=False):
+    """
+    Return the (max_lag+1 x K x K) array of cumulative co-occurrence
+    counts of an encoded corpus (see encode_corpus): element [w, i, j]
+    counts chord i occurring at most w chords after chord j in the same
+    song.  Slice w is the causal co-occurrence matrix with window size
+    w, and slice w plus its transpose is the symmetric one, so every
+    window size is derived from a single pass over the lagged pairs
+    """
+    if compressed:
+        codes, docs = compress_codes(codes, docs)
+    counts = np.zeros((max_lag+1, K*K))
+    for d in range(1, max_lag+1):
+        same = docs[d:] == docs[:-d]
+        counts[d] = counts[d-1] + np.bincount(codes[d:][same]*K + codes[:-d][same], minlength=K*K)
+    return counts.reshape(max_lag+1, K, K)
+
 def compute_co_occurrence_matrix(corpus, window_size=2):
     """
     Return the co-occurrence matrix of the distinct chords based on the
     collection of songs in the corpus
     """
-    words = distinct_chords(corpus)
-    word_idx = dict(zip(words,range(len(words))))
-    word2ind = {}
-    for doc in corpus:
-        # TODO: consider using compress_sequence(doc) before computing co-occurrence 
-        N = len(doc)
-        for c in range(N):
-            wc = doc[c]
-            wc_idx = word_idx[wc]
-            window = list(range(max(0,c-window_size),c)) + list(range(c+1, min(N,c+window_size+1)))
-            idx = []
-            for o in window:
-                wo = doc[o]
-                wo_idx = word_idx[wo]
-                idx = [wc_idx, wo_idx]
-                if wc in word2ind:
-                    word2ind[wc].append(idx)
-                else:
-                    word2ind[wc] = []
-                    word2ind[wc].append(idx)
-    K = len(words)
-    M = np.zeros((K,K))
-    for j in word2ind:
-        for x, y in word2ind[j]:
-            M[x][y] += 1
-    return M, word_idx
+    return co_occurrence_matrix(corpus, window_size, dense=True)
 
 def compute_compressed_co_occurrence_matrix(corpus, window_size=2):
     """
     Return the co-occurrence matrix of the distinct chords based on the
     collection of songs in the corpus
     """
-    words = distinct_chords(corpus)
-    word_idx = dict(zip(words,range(len(words))))
-    word2ind = {}
-    for fulldoc in corpus:
-        doctup = compress_sequence(fulldoc)
-        doc = [k for k,j in doctup]
-        N = len(doc)
-        for c in range(N):
-            wc = doc[c]
-            wc_idx = word_idx[wc]
-            window = list(range(max(0,c-window_size),c)) + list(range(c+1, min(N,c+window_size+1)))
-            idx = []
-            for o in window:
-                wo = doc[o]
-                wo_idx = word_idx[wo]
-                idx = [wc_idx, wo_idx]
-                if wc in word2ind:
-                    word2ind[wc].append(idx)
-                else:
-                    word2ind[wc] = []
-                    word2ind[wc].append(idx)
-    K = len(words)
-    M = np.zeros((K,K))
-    for j in word2ind:
-        for x, y in word2ind[j]:
-            M[x][y] += 1
-    return M, word_idx
+    return co_occurrence_matrix(corpus, window_size, compressed=True, dense=True)
 
 def compute_causal_co_occurrence_matrix(corpus, window_size=2):
     """
     Return the co-occurrence matrix of the distinct chords based on the
     collection of songs in the corpus
     """
-    words = distinct_chords(corpus)
-    word_idx = dict(zip(words,range(len(words))))
-    word2ind = {}
-    for doc in corpus:
-        # TODO: consider using compress_sequence(doc) before computing co-occurrence 
-        N = len(doc)
-        for c in range(N):
-            wc = doc[c]
-            wc_idx = word_idx[wc]
-            window = list(range(max(0,c-window_size),c))
-            idx = []
-            for o in window:
-                wo = doc[o]
-                wo_idx = word_idx[wo]
-                idx = [wc_idx, wo_idx]
-                if wc in word2ind:
-                    word2ind[wc].append(idx)
-                else:
-                    word2ind[wc] = []
-                    word2ind[wc].append(idx)
-    K = len(words)
-    M = np.zeros((K,K))
-    for j in word2ind:
-        for x, y in word2ind[j]:
-            M[x][y] += 1
-    return M, word_idx
+    return co_occurrence_matrix(corpus, window_size, causal=True, dense=True)
+
+def normalize_rows(M, rows=None):
+    """
+    Return the row normalized co-occurrence matrix, as in equation (1)
+    of the paper.  If rows is given, only those rows of M are
+    normalized, in place.  All-zero rows are left as zeros
+    """
+    if rows is None:
+        M = np.array(M, dtype=float)
+        rows = range(len(M))
+    for r in rows:
+        norm = np.linalg.norm(M[r])
+        if norm > 0:
+            M[r] = M[r]/norm
+    return M
+
+class CoOccurrenceModel:
+    """A co-occurrence model that can be updated as songs are added,
+    edited or removed.  It keeps the raw co-occurrence counts, the
+    vocabulary (chord_idx), the row normalized matrix M and the songs
+    themselves.  Each edit applies the count deltas of the songs
+    involved, appends any new chords to the vocabulary (growing the
+    matrices by a zero row and column), and renormalizes only the rows
+    whose counts changed.  Sampled song paths (see song_points) are
+    cached per song and only the songs in which a chord whose row
+    changed has a non-zero number of beats are invalidated (chords with
+    no beats, like <START> and <END>, do not move a song's path).
+
+    The chord indices of a model built incrementally follow the order
+    in which chords were first seen rather than sorted order, which
+    permutes the coordinates of the chord vectors but does not change
+    any distance between them.
+
+    """
+
+    def __init__(self, window_size=2, causal=False, compressed=False):
+        self.window_size = window_size
+        self.causal = causal
+        self.compressed = compressed
+        self.chord_idx = {}
+        self.counts = np.zeros((0,0))
+        self.M = np.zeros((0,0))
+        self.songs = {}
+        self.meters = {}
+        self.chord_songs = {}
+        self.points = {}
+
+    @classmethod
+    def from_corpus(cls, corpus, meters, titles, window_size=2, causal=False, compressed=False):
+        """Build the model for a corpus in one pass.  corpus may be a
+        Corpus (meters is then ignored, and titles may be None)
+
+        """
+        if isinstance(corpus, Corpus):
+            corpus, meters, corpus_titles = corpus.to_lists()
+            titles = corpus_titles if titles is None else titles
+        model = cls(window_size, causal, compressed)
+        counts, chord_idx = co_occurrence_matrix(corpus, window_size, causal, compressed, dense=True)
+        model.chord_idx = chord_idx
+        model.counts = counts
+        model.M = normalize_rows(counts)
+        for title, song, meter in zip(titles, corpus, meters):
+            model._register(title, song, meter)
+        return model
+
+    def _path_chords(self, title):
+        """The chords that shape a song's path: those with a non-zero
+        number of beats (so not <START> and <END>)
+
+        """
+        return {w for w, b in zip(self.songs[title], self.meters[title]) if b != 0}
+
+    def _register(self, title, song, meter):
+        self.songs[title] = list(song)
+        self.meters[title] = list(meter)
+        for w in self._path_chords(title):
+            self.chord_songs.setdefault(w, set()).add(title)
+
+    def _unregister(self, title):
+        for w in self._path_chords(title):
+            self.chord_songs[w].discard(title)
+        song = self.songs.pop(title)
+        del self.meters[title]
+        return song
+
+    def _grow(self, song):
+        new = [w for w in dict.fromkeys(song) if w not in self.chord_idx]
+        if new:
+            for w in new:
+                self.chord_idx[w] = len(self.chord_idx)
+            K = len(self.chord_idx)
+            n = K - len(self.counts)
+            self.counts = np.pad(self.counts, ((0,n),(0,n)))
+            self.M = np.pad(self.M, ((0,n),(0,n)))
+
+    def _apply(self, removed, added):
+        """Apply the count deltas of removing and adding the given songs,
+        and return the rows whose counts changed
+
+        """
+        K = len(self.chord_idx)
+        delta = np.zeros(K*K)
+        for songs, sign in ((removed, -1), (added, 1)):
+            if songs:
+                codes, docs, word_idx = encode_corpus(songs, self.chord_idx)
+                rows, cols = co_occurrence_pairs(codes, docs, self.window_size, self.causal, self.compressed)
+                delta += sign*np.bincount(rows*K + cols, minlength=K*K)
+        delta = delta.reshape(K, K)
+        self.counts += delta
+        return set(np.flatnonzero(delta.any(axis=1)).tolist())
+
+    def _refresh(self, rows):
+        """Renormalize the given rows and invalidate the cached paths of
+        the songs that use them.  Returns the invalidated song titles
+
+        """
+        rows = sorted(rows)
+        self.M[rows] = self.counts[rows]
+        normalize_rows(self.M, rows)
+        words = list(self.chord_idx)
+        affected = set()
+        for r in rows:
+            affected |= self.chord_songs.get(words[r], set())
+        for title in affected:
+            self.points.pop(title, None)
+        return affected
+
+    def add_song(self, title, song, meter):
+        """Add a song (a roman numeral sequence with <START> and <END>
+        tags, and its beats).  Returns the titles of the songs whose
+        derived data is invalidated by the edit
+
+        """
+        if title in self.songs:
+            raise ValueError('Song already in model: ' + title)
+        self._grow(song)
+        rows = self._apply([], [song])
+        self._register(title, song, meter)
+        return self._refresh(rows) | {title}
+
+    def remove_song(self, title):
+        """Remove a song.  Returns the titles of the songs whose derived
+        data is invalidated by the edit
+
+        """
+        song = self._unregister(title)
+        self.points.pop(title, None)
+        rows = self._apply([song], [])
+        return self._refresh(rows) | {title}
+
+    def update_song(self, title, song, meter):
+        """Replace a song with an edited version.  Returns the titles of
+        the songs whose derived data is invalidated by the edit
+
+        """
+        old = self._unregister(title)
+        self.points.pop(title, None)
+        self._grow(song)
+        rows = self._apply([old], [song])
+        self._register(title, song, meter)
+        return self._refresh(rows) | {title}
+
+    def song_vecs(self, title):
+        """Return the sequence of vectors representing the chords of a song
+
+        """
+        return make_song_vecs(self.songs[title], self.chord_idx, self.M)
+
+    def song_points(self, title, samples=None):
+        """Return the sampled path of a song (see make_path_samples),
+        from the cache when it is still valid.  Paths cached before the
+        vocabulary grew are padded with zeros for the new chords, which
+        is exact since only invalidated songs use them
+
+        """
+        K = len(self.chord_idx)
+        if samples is not None:
+            return make_path_samples(self.song_vecs(title), self.meters[title], samples)
+        if title not in self.points:
+            self.points[title] = make_path_samples(self.song_vecs(title), self.meters[title])
+        points = self.points[title]
+        if points.shape[1] < K:
+            points = np.pad(points, ((0,0),(0,K-points.shape[1])))
+            self.points[title] = points
+        return points
+
+    def save(self, path):
+        """Save the model to path
+
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        """Load a model saved with save
+
+        """
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+def project_rows(M, energy=1.0, rtol=None):
+    """
+    Return the rows of M expressed in an orthonormal basis of its row
+    space: the (K x r) matrix M @ V, the (K x r) basis V and a report
+    dict (rank, dims, energy).  Chord vectors, path points and their
+    differences are all linear combinations of rows of M, so their L2
+    norms, and every membrane area, are the same with the projected
+    rows, while path samples and the all-pairs products shrink from K
+    to r columns.  With energy=1 the basis is the whole row space (r is
+    the numerical rank, with singular values below rtol times the
+    largest treated as zero) and the projection is exact; with
+    energy < 1 only the leading singular directions holding that
+    fraction of the squared singular values are kept
+    """
+    M = np.asarray(M, dtype=float)
+    U, sv, Vt = np.linalg.svd(M, full_matrices=False)
+    if rtol is None:
+        rtol = max(M.shape)*np.finfo(float).eps
+    rank = int(np.count_nonzero(sv > rtol*sv[0])) if len(sv) and sv[0] > 0 else 0
+    sq = sv[:rank]**2
+    dims = rank
+    if energy < 1 and rank:
+        dims = min(rank, int(np.searchsorted(np.cumsum(sq)/sq.sum(), energy)) + 1)
+    basis = Vt[:dims].T
+    report = {'rank': rank, 'dims': dims, 'energy': float(sq[:dims].sum()/sq.sum()) if rank else 1.0}
+    return M @ basis, basis, report
 
 def make_song_vecs(song, chord_idx, M):
     """
@@ -142,17 +492,776 @@ def vector_point(sample, vecs, meter):
     point = np.matmul(norm_meter[:i], vecs[:i,:]) + delta * norm_meter[i] * vecs[i,:]
     return point
 
-def compute_membrane_area(vec1,vals1,vec2,vals2):
+MEMBRANE_SAMPLES = 254
+
+def membrane_samples(n_samples=MEMBRANE_SAMPLES):
+    """
+    Return the n_samples equally spaced interior sample positions in
+    [0, 1] at which the membrane area is evaluated.  The default of 254
+    is the resolution used in the paper
+    """
+    return np.linspace(0,1,n_samples+2)[1:-1]
+
+def make_path_samples(vecs, meter, samples=None):
+    """
+    Return the (S x K) matrix of vector space points sampled along the
+    song's piecewise linear representation.  Row s is
+    vector_point(samples[s], vecs, meter), but the cumulative meter and
+    the weighted prefix sums of the vectors are computed only once and
+    gathered for all samples with a single searchsorted.  The prefix
+    sums add the vectors in a different order than the matmul of
+    vector_point, so the points agree to rounding rather than bit for
+    bit: on SongDB they differ by less than 5e-16, and membrane areas
+    computed from them by less than 2e-15 relative to those of the
+    original per-sample loop (ranks are unchanged)
+    """
+    if samples is None:
+        samples = membrane_samples()
+    meter = np.asarray(meter, dtype=float)
+    vecs = np.asarray(vecs, dtype=float)[:len(meter)]
+    cum_meter = np.cumsum(meter)
+    normalized_position = cum_meter/cum_meter[-1]
+    norm_meter = meter/cum_meter[-1]
+
+    # prefix[i] is the point reached at the start of segment i, that is,
+    # np.matmul(norm_meter[:i], vecs[:i,:])
+    prefix = np.zeros((len(meter)+1, vecs.shape[1]))
+    np.cumsum(norm_meter[:,None]*vecs, axis=0, out=prefix[1:])
+
+    i = np.searchsorted(normalized_position, samples, side='right')
+    delta = (samples - normalized_position[i-1])/(normalized_position[i] - normalized_position[i-1])
+    points = prefix[i] + (delta*norm_meter[i])[:,None]*vecs[i]
+    return points
+
+@ctrace.traced()
+def corpus_song_vecs(corpus, meters, chord_idx, M, indices=None):
+    """
+    Yield the chord vectors and meter of each song of the corpus (of
+    the songs with the given indices if not None).  corpus is either a
+    list of roman numeral progressions with the list of their meters,
+    or a Corpus (meters is then ignored), whose vectors are gathered
+    from M with one fancy index per song instead of a dict lookup per
+    chord
+    """
+    if indices is None:
+        indices = range(len(corpus))
+    if isinstance(corpus, Corpus):
+        rows = M[corpus.code_map(chord_idx)]
+        for k in indices:
+            tokens, beats = corpus.song(k)
+            yield rows[tokens], beats.astype(float)
+    else:
+        for k in indices:
+            yield make_song_vecs(corpus[k], chord_idx, M), meters[k]
+
+def corpus_subset(corpus, meters, indices):
+    """
+    Return the songs of the corpus with the given indices, and their
+    meters (None for a Corpus)
+    """
+    if isinstance(corpus, Corpus):
+        return corpus.subset(indices), None
+    return [corpus[k] for k in indices], [meters[k] for k in indices]
+
+def make_corpus_path_samples(corpus, meters, chord_idx, M, samples=None):
+    """
+    Return the (N x S x K) array of sampled path points for all N songs
+    in the corpus (see corpus_song_vecs)
+    """
+    if samples is None:
+        samples = membrane_samples()
+    P = np.empty((len(corpus), len(samples), M.shape[1]))
+    for k, (vecs, meter) in enumerate(corpus_song_vecs(corpus, meters, chord_idx, M)):
+        P[k] = make_path_samples(vecs, meter, samples)
+    ctrace.count('path samples', P.shape[0]*P.shape[1])
+    return P
+
+def membrane_area(points1, points2):
+    """
+    Return the membrane area between two songs given their sampled path
+    points (see make_path_samples)
+    """
+    areas = np.linalg.norm(points1 - points2, axis=-1).sum(axis=-1)
+    if ctrace.ENABLED:
+        ctrace.count('pairs compared', np.size(areas))
+        ctrace.count('samples evaluated', np.size(areas)*np.shape(points1)[-2])
+    return areas
+
+@ctrace.traced()
+def membrane_areas(points, corpus_points, chunk=256):
+    """
+    Return the membrane areas between one song's sampled path points
+    (S x K) and those of every song in corpus_points (N x S x K).  The
+    corpus is processed in chunks of songs to bound the size of the
+    temporary difference array
+    """
+    N = len(corpus_points)
+    areas = np.empty(N)
+    for k in range(0, N, chunk):
+        areas[k:k+chunk] = membrane_area(corpus_points[k:k+chunk], points)
+    return areas
+
+def membrane_block_size(S, K, memory_budget):
+    """
+    Return the largest power of two number of songs per tile such that
+    two tiles of path samples and the float64 accumulators of one tile
+    pair fit in memory_budget bytes (at least 1, even if one song does
+    not fit)
+    """
+    def tile_bytes(b):
+        return 8*(2*b*S*K + 3*b*b)
+    b = 1
+    while tile_bytes(2*b) <= memory_budget:
+        b *= 2
+    return b
+
+@ctrace.traced()
+def membrane_distance_matrix(points1, points2=None, out=None, dtype=np.float32,
+                             memory_budget=2**28, processes=1):
+    """
+    Return the matrix of membrane areas between every song in points1
+    (N1 x S x K) and every song in points2 (N2 x S x K).  If points2 is
+    None the all-pairs matrix of points1 is returned, computing only
+    the upper triangular tiles and mirroring them.
+
+    The songs are processed in tiles sized to fit memory_budget.  For
+    each pair of tiles, and one sample point at a time, the squared
+    distances are expanded as |a|^2 + |b|^2 - 2 a.b so that all of the
+    work is a matrix multiply.  The result is accumulated in float64
+    and stored as dtype in out, which may be an array, None (a new
+    array is allocated) or a filename (a memory-mapped .npy file is
+    created).  With processes > 1 the rows of tiles are shared out
+    between that many threads (numpy releases the GIL for the matrix
+    multiplies), and the tiles are sized so that all threads together
+    fit in memory_budget.
+
+    Rounding in the expansion makes each squared distance accurate to
+    about (K+2)*eps*(|a|^2 + |b|^2), with eps the float64 machine
+    epsilon, so the distance at a sample where the paths (nearly) meet
+    can be off by up to sqrt((K+2)*eps*(|a|^2 + |b|^2)), about 1e-7
+    for row normalized M.  Against membrane_area the areas of distinct
+    songs of SongDB differ by less than 3e-8 relative.  Songs with
+    identical path samples (duplicate entries in the corpus) would be
+    about 1e-6 apart instead of 0, so they are found by hashing the
+    samples of each song and given an area of exactly 0
+    """
+    symmetric = points2 is None
+    if symmetric:
+        points2 = points1
+    keys1 = _path_sample_keys(points1)
+    keys2 = keys1 if symmetric else _path_sample_keys(points2)
+    N1, S, K = points1.shape
+    N2 = points2.shape[0]
+    if out is None:
+        out = np.empty((N1, N2), dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(N1, N2))
+
+    pairs = N1*(N1-1)//2 if symmetric else N1*N2
+    ctrace.count('pairs compared', pairs)
+    ctrace.count('samples evaluated', pairs*S)
+
+    processes = max(1, min(processes, N1))
+    b = membrane_block_size(S, K, memory_budget//processes)
+    tiles = list(range(0, N1, b))
+    if processes == 1:
+        for i in tiles:
+            _membrane_tile_row(points1, points2, keys1, keys2, out, i, b, symmetric)
+    else:
+        # Hand out the rows of tiles one at a time: in the symmetric
+        # case the later rows hold fewer tiles of the upper triangle
+        pool = multiprocessing.pool.ThreadPool(processes)
+        try:
+            pool.starmap(_membrane_tile_row, [(points1, points2, keys1, keys2, out, i, b, symmetric)
+                                                 for i in tiles], 1)
+        finally:
+            pool.close()
+            pool.join()
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+def _path_sample_keys(points):
+    """Return a hash of the path samples of each song, so that songs
+    with identical samples can be found without comparing them all
+
+    """
+    return np.array([hash(np.ascontiguousarray(p).tobytes()) for p in points], dtype=np.int64)
+
+def _membrane_tile_row(points1, points2, keys1, keys2, out, i, b, symmetric):
+    """Fill the row of tiles of out starting at song i of points1
+
+    """
+    N2, S = points2.shape[0], points2.shape[1]
+    A = np.ascontiguousarray(np.swapaxes(points1[i:i+b], 0, 1), dtype=float)
+    An = np.einsum('snk,snk->sn', A, A)
+    for j in range(i if symmetric else 0, N2, b):
+        B = np.ascontiguousarray(np.swapaxes(points2[j:j+b], 0, 1), dtype=float)
+        Bn = np.einsum('snk,snk->sn', B, B)
+        E = np.zeros((A.shape[1], B.shape[1]))
+        for s in range(S):
+            d2 = np.matmul(A[s], B[s].T)
+            d2 *= -2
+            d2 += An[s][:,None]
+            d2 += Bn[s][None,:]
+            np.maximum(d2, 0, out=d2)
+            E += np.sqrt(d2, out=d2)
+        # Identical songs are exactly 0 apart, free of rounding error
+        for a, c in np.argwhere(keys1[i:i+b,None] == keys2[None,j:j+b]):
+            if np.array_equal(points1[i+a], points2[j+c]):
+                E[a,c] = 0
+        out[i:i+b, j:j+b] = E
+        if symmetric and i != j:
+            out[j:j+b, i:i+b] = E.T
+
+def compute_membrane_area(vec1,vals1,vec2,vals2,n_samples=MEMBRANE_SAMPLES):
     """
     Return the membrane area between two songs represented by 
-    [vec1, vals1] and [vec2, vals2]
+    [vec1, vals1] and [vec2, vals2], sampled at n_samples points
+    """
+    samples = membrane_samples(n_samples)
+    p1 = make_path_samples(vec1, vals1, samples)
+    p2 = make_path_samples(vec2, vals2, samples)
+    return float(membrane_area(p1, p2))
+
+def path_speed(vecs, meter):
+    """
+    Return the largest speed of a song's path with respect to the
+    normalized position s.  On segment i the path moves along vecs[i]
+    over a stretch of s of length norm_meter[i] while covering
+    norm_meter[i]*vecs[i], so its speed is |vecs[i]| (at most 1 for a
+    row normalized M).  Segments with no beats are never traversed
+    """
+    meter = np.asarray(meter, dtype=float)
+    vecs = np.asarray(vecs, dtype=float)[:len(meter)]
+    norms = np.linalg.norm(vecs[meter > 0], axis=1)
+    return float(norms.max()) if len(norms) else 0.0
+
+def coarse_sample_plan(n_samples=MEMBRANE_SAMPLES, n_coarse=32):
+    """
+    Return the coarse sample positions (a subset of the n_samples fine
+    positions), the number of fine positions for which each coarse
+    position stands in (the nearest one), and the total distance D
+    between the fine positions and the coarse ones standing in for
+    them.  If the difference of two paths is L-Lipschitz in s, the
+    fine membrane area differs from the weighted coarse sum by at most
+    L*D
+    """
+    fine = membrane_samples(n_samples)
+    coarse_idx = np.unique(np.round(np.linspace(0, n_samples-1, n_coarse)).astype(int))
+    midpoints = (coarse_idx[1:] + coarse_idx[:-1])/2
+    nearest = np.searchsorted(midpoints, np.arange(n_samples))
+    weights = np.bincount(nearest, minlength=len(coarse_idx)).astype(float)
+    D = np.abs(fine - fine[coarse_idx[nearest]]).sum()
+    return fine[coarse_idx], weights, D
+
+def membrane_search(query_vecs, query_meter, corpus, meters, chord_idx, M, k=10,
+                    n_coarse=32, n_samples=MEMBRANE_SAMPLES, margin_scale=1.0,
+                    coarse_points=None, speeds=None):
+    """
+    Coarse-to-fine search for the k songs of the corpus with the
+    smallest membrane area to the query song, at a resolution of
+    n_samples.  Every song is first scored with n_coarse samples (a
+    subset of the fine ones, each weighted by the number of fine
+    samples it stands in for).  The difference of two paths is
+    Lipschitz in s with constant the sum of their speeds (see
+    path_speed), which bounds the error of each coarse score by
+    margin_scale*(L1 + L2)*D (see coarse_sample_plan).  With
+    margin_scale=1 the bound is provable and the result equals a full
+    resolution search; smaller values prune more aggressively at the
+    risk of missing a neighbour.  Songs whose lower bound exceeds the
+    k-th smallest upper bound are pruned, and only the survivors are
+    evaluated at full resolution.
+
+    The coarse corpus samples and the song speeds can be precomputed
+    and passed in (coarse_points, speeds) to amortize them over many
+    queries.  Returns the indices of the k nearest songs, their areas,
+    and a report dict with the number of songs pruned
+    """
+    coarse, weights, D = coarse_sample_plan(n_samples, n_coarse)
+    if coarse_points is None:
+        coarse_points = make_corpus_path_samples(corpus, meters, chord_idx, M, coarse)
+    if speeds is None:
+        speeds = np.array([path_speed(vecs, meter)
+                           for vecs, meter in corpus_song_vecs(corpus, meters, chord_idx, M)])
+
+    q_coarse = make_path_samples(query_vecs, query_meter, coarse)
+    q_speed = path_speed(query_vecs, query_meter)
+    estimate = (np.linalg.norm(coarse_points - q_coarse, axis=-1)*weights).sum(axis=-1)
+    margin = margin_scale*(speeds + q_speed)*D*(1 + 1e-9)
+    lower = estimate - margin
+    upper = estimate + margin
+
+    k = min(k, len(corpus))
+    bound = np.partition(upper, k-1)[k-1]
+    survivors = np.flatnonzero(lower <= bound)
+
+    fine = membrane_samples(n_samples)
+    q_fine = make_path_samples(query_vecs, query_meter, fine)
+    areas = np.array([membrane_area(make_path_samples(vecs, meter, fine), q_fine)
+                      for vecs, meter in corpus_song_vecs(corpus, meters, chord_idx, M, survivors)])
+    order = np.lexsort((survivors, areas))[:k]
+    report = {'songs': len(corpus), 'pruned': len(corpus) - len(survivors), 'refined': len(survivors)}
+    return survivors[order], areas[order], report
+
+def membrane_search_report(queries, corpus, meters, chord_idx, M, k=10, n_coarse=32,
+                           n_samples=MEMBRANE_SAMPLES, margin_scale=1.0):
+    """
+    Run membrane_search for each query song index (excluding the query
+    itself from its results) and compare with a full resolution
+    search.  Returns a list of per-query dicts with the number of songs
+    pruned and whether the ranked top k matched the baseline
+    """
+    coarse, weights, D = coarse_sample_plan(n_samples, n_coarse)
+    coarse_points = make_corpus_path_samples(corpus, meters, chord_idx, M, coarse)
+    fine_points = make_corpus_path_samples(corpus, meters, chord_idx, M, membrane_samples(n_samples))
+    speeds = np.array([path_speed(vecs, meter)
+                       for vecs, meter in corpus_song_vecs(corpus, meters, chord_idx, M)])
+    results = []
+    for q in queries:
+        others = [j for j in range(len(corpus)) if j != q]
+        qvecs, qmeter = next(corpus_song_vecs(corpus, meters, chord_idx, M, [q]))
+        ocorpus, ometers = corpus_subset(corpus, meters, others)
+        idx, areas, report = membrane_search(qvecs, qmeter, ocorpus, ometers, chord_idx, M, k,
+                                             n_coarse, n_samples, margin_scale,
+                                             coarse_points[others], speeds[others])
+        baseline = membrane_areas(fine_points[q], fine_points[others])
+        base_idx = np.lexsort((np.arange(len(others)), baseline))[:k]
+        report['query'] = q
+        report['ranks_match'] = bool(np.array_equal(idx, base_idx))
+        results.append(report)
+    return results
+
+def path_breakpoints(vecs, meter):
+    """
+    Return the breakpoints of a song's piecewise linear path: their
+    normalized positions (starting at 0) and the (n+1 x K) matrix of
+    points reached there.  Between two breakpoints the path is linear
+    in the normalized position s
+    """
+    meter = np.asarray(meter, dtype=float)
+    vecs = np.asarray(vecs, dtype=float)[:len(meter)]
+    total = meter.sum()
+    positions = np.zeros(len(meter)+1)
+    np.cumsum(meter/total, out=positions[1:])
+    positions[-1] = 1.0
+    points = np.zeros((len(meter)+1, vecs.shape[1]))
+    np.cumsum((meter/total)[:,None]*vecs, axis=0, out=points[1:])
+    return positions, points
+
+def make_corpus_breakpoints(corpus, meters, chord_idx, M):
+    """
+    Return the list of path breakpoints (see path_breakpoints) for all
+    songs in the corpus (see corpus_song_vecs)
+    """
+    return [path_breakpoints(vecs, meter)
+            for vecs, meter in corpus_song_vecs(corpus, meters, chord_idx, M)]
+
+def interpolate_path(positions, points, s):
+    """
+    Return the points of the path with the given breakpoints at the
+    normalized positions s
+    """
+    j = np.searchsorted(positions, s, side='right') - 1
+    j = np.clip(j, 0, len(positions)-2)
+    width = positions[j+1] - positions[j]
+    t = np.divide(s - positions[j], width, out=np.zeros(len(s)), where=width > 0)
+    return points[j] + t[:,None]*(points[j+1] - points[j])
+
+GAUSS_NODES, GAUSS_WEIGHTS = np.polynomial.legendre.leggauss(8)
+GAUSS_NODES = (GAUSS_NODES + 1)/2
+GAUSS_WEIGHTS = GAUSS_WEIGHTS/2
+
+def segment_norm_integrals(d0, d1, quadrature_ratio=1e-3):
+    """
+    Return the integrals over t in [0, 1] of |d0 + t*(d1 - d0)| for
+    each row of d0 and d1.  With e = d1 - d0 the squared integrand is
+    the quadratic C + 2*b*t + A*t^2 with C = |d0|^2, b = d0.e and
+    A = |e|^2, so only these three dot products are formed.  With
+    u = t + b/A and k^2 = C/A - (b/A)^2 the integrand is
+    |e|*sqrt(u^2 + k^2), whose antiderivative is
+
+      |e|/2 * (u*sqrt(u^2 + k^2) + k^2*asinh(u/k))
+
+    The closed form cancels badly when |e| is small relative to |d0|
+    (the distance barely changes along the segment), so those rows are
+    integrated with 8 point Gauss-Legendre quadrature instead, which is
+    exact to rounding for such a nearly constant integrand
+    """
+    e = d1 - d0
+    A = np.einsum('ij,ij->i', e, e)
+    b = np.einsum('ij,ij->i', d0, e)
+    C = np.einsum('ij,ij->i', d0, d0)
+    closed = A > quadrature_ratio**2*C
+    result = np.empty(len(d0))
+
+    Ac, bc, Cc = A[closed], b[closed], C[closed]
+    c = bc/Ac
+    k2 = np.maximum(Cc/Ac - c*c, 0)
+    k = np.sqrt(k2)
+    def F(u):
+        r = u*np.sqrt(u*u + k2)
+        return r + k2*np.arcsinh(np.divide(u, k, out=np.zeros(len(u)), where=k > 0))
+    result[closed] = np.sqrt(Ac)/2*(F(1+c) - F(c))
+
+    t = GAUSS_NODES[None,:]
+    q = ~closed
+    values = C[q,None] + 2*b[q,None]*t + A[q,None]*t*t
+    result[q] = np.sqrt(np.maximum(values, 0)) @ GAUSS_WEIGHTS
+    return result
+
+def exact_membrane_area(breakpoints1, breakpoints2, return_segments=False):
+    """
+    Return the exact membrane area between two songs given their path
+    breakpoints (see path_breakpoints): the integral over s in [0, 1]
+    of |p1(s) - p2(s)|.  Both paths are linear between the merged
+    breakpoints of the two songs, so the integral is a sum of one
+    closed form segment integral per merged segment, and does not
+    depend on a sampling grid.  The sampled membrane_area with S
+    samples approximates (S+1) times this value.  If return_segments
+    is True, also return the number of merged segments evaluated
+    """
+    pos1, pts1 = breakpoints1
+    pos2, pts2 = breakpoints2
+    grid = np.union1d(pos1, pos2)
+    diff = interpolate_path(pos1, pts1, grid) - interpolate_path(pos2, pts2, grid)
+    area = float(np.diff(grid) @ segment_norm_integrals(diff[:-1], diff[1:]))
+    if return_segments:
+        return area, len(grid)-1
+    return area
+
+@ctrace.traced()
+def exact_membrane_areas(breakpoints, corpus_breakpoints, chunk=256, return_segments=False):
+    """
+    Return the exact membrane areas between one song and every song of
+    a corpus, given their path breakpoints.  The merged breakpoints of
+    the song with a chunk of corpus songs are formed with one lexsort
+    over (song, position), and all of their segments are integrated
+    together.  At equal positions corpus breakpoints sort before the
+    song's, so a running maximum over the corpus breakpoint indices
+    gives the corpus segment each merged breakpoint falls in.  If
+    return_segments is True, also return the number of merged segments
+    evaluated for each corpus song.
+
+    This is an offline check of the sampled areas, not a faster path:
+    a pair of songs takes about 70 merged segments against 254
+    samples, but each segment costs several K-dimensional gathers and
+    a closed form integral rather than a share of a matrix multiply.
+    On SongDB one song against the corpus takes about 1 s, so the 80
+    contrafacts take 75 to 100 s, against about 1.5 s for all of them
+    with membrane_distance_matrix
+    """
+    pos_q, pts_q = breakpoints
+    areas = np.empty(len(corpus_breakpoints))
+    segments = np.empty(len(corpus_breakpoints), dtype=np.int64)
+    for start in range(0, len(corpus_breakpoints), chunk):
+        block = corpus_breakpoints[start:start+chunk]
+        n = len(block)
+        lens = np.array([len(pos) for pos, pts in block])
+        ends = np.cumsum(lens) - 1
+        pos_c = np.concatenate([pos for pos, pts in block])
+        pts_c = np.concatenate([pts for pos, pts in block])
+
+        all_pos = np.concatenate([pos_c, np.tile(pos_q, n)])
+        all_sid = np.concatenate([np.repeat(np.arange(n), lens), np.repeat(np.arange(n), len(pos_q))])
+        all_src = np.concatenate([np.zeros(len(pos_c), dtype=np.int8), np.ones(n*len(pos_q), dtype=np.int8)])
+        order = np.lexsort((all_src, all_pos, all_sid))
+        pos, sid = all_pos[order], all_sid[order]
+        keep = np.ones(len(pos), dtype=bool)
+        keep[1:] = (sid[1:] != sid[:-1]) | (pos[1:] != pos[:-1])
+
+        # Corpus path at the merged breakpoints
+        r = np.where(order < len(pos_c), order, -1)
+        r = np.maximum.accumulate(r)[keep]
+        pos, sid = pos[keep], sid[keep]
+        nxt = np.minimum(r+1, ends[sid])
+        width = pos_c[nxt] - pos_c[r]
+        t = np.divide(pos - pos_c[r], width, out=np.zeros(len(pos)), where=width > 0)
+        diff = pts_c[r] + t[:,None]*(pts_c[nxt] - pts_c[r])
+        diff -= interpolate_path(pos_q, pts_q, pos)
+
+        # Integrate between all consecutive merged breakpoints, then drop
+        # the pairs that straddle two songs
+        integrals = np.diff(pos)*segment_norm_integrals(diff[:-1], diff[1:])
+        integrals[sid[1:] != sid[:-1]] = 0
+        ctrace.count('pairs compared', n)
+        ctrace.count('segments evaluated', len(pos) - n)
+        areas[start:start+n] = np.bincount(sid[:-1], weights=integrals, minlength=n)
+        segments[start:start+n] = np.bincount(sid, minlength=n) - 1
+    if return_segments:
+        return areas, segments
+    return areas
+
+def exact_membrane_report(queries, corpus, meters, chord_idx, M, sample_counts=(32, 64, MEMBRANE_SAMPLES), k=10):
+    """
+    Compare the exact membrane areas between each query song index and
+    the rest of the corpus with the sampled areas at each number of
+    samples in sample_counts (scaled by 1/(S+1)).  Returns a list of
+    per-query dicts with the mean number of merged segments evaluated
+    by the exact integration and its time, and for every sample count
+    the largest relative difference to the exact areas, whether the
+    ranked top k matched and the time of the sampled areas
+    """
+    breakpoints = make_corpus_breakpoints(corpus, meters, chord_idx, M)
+    sampled = {S: make_corpus_path_samples(corpus, meters, chord_idx, M, membrane_samples(S))
+               for S in sample_counts}
+    results = []
+    for q in queries:
+        others = np.array([j for j in range(len(corpus)) if j != q])
+        t0 = time.perf_counter()
+        exact, segments = exact_membrane_areas(breakpoints[q], [breakpoints[j] for j in others],
+                                               return_segments=True)
+        exact_idx = np.lexsort((others, exact))[:k]
+        report = {'query': q, 'segments': float(np.mean(segments)), 'seconds': time.perf_counter() - t0}
+        for S, points in sampled.items():
+            t0 = time.perf_counter()
+            areas = membrane_areas(points[q], points[others])/(S+1)
+            report[S] = {'max_rel_diff': float(np.max(np.abs(areas - exact)/exact)),
+                         'ranks_match': bool(np.array_equal(np.lexsort((others, areas))[:k], exact_idx)),
+                         'seconds': time.perf_counter() - t0}
+        results.append(report)
+    return results
+
+def projection_report(corpus, meters, chord_idx, M, queries, energies=(1.0, 0.9999, 0.999, 0.99), k=10):
+    """
+    Compare the membrane areas between each query song index and every
+    song of the corpus computed with the rows of M projected at each
+    energy of energies (see project_rows) with those computed with M.
+    Returns a list of per-energy dicts with the number of dimensions
+    kept, the largest area difference (absolute, and relative to the
+    median area), whether the ranked top
+    k of every query matched and the size of the path samples relative
+    to the full ones
+    """
+    points = make_corpus_path_samples(corpus, meters, chord_idx, M)
+    full = membrane_distance_matrix(points[queries], points, dtype=float)
+    order = np.arange(len(points))
+    def top(areas, q):
+        areas = areas.copy()
+        areas[q] = np.inf
+        return np.lexsort((order, areas))[:k]
+
+    results = []
+    for energy in energies:
+        P, basis, report = project_rows(M, energy)
+        reduced = make_corpus_path_samples(corpus, meters, chord_idx, P)
+        areas = membrane_distance_matrix(reduced[queries], reduced, dtype=float)
+        # Relative to the median area: near-duplicate songs have areas
+        # at the rounding floor of the all-pairs expansion
+        report['max_abs_diff'] = float(np.max(np.abs(areas - full)))
+        report['max_rel_diff'] = report['max_abs_diff']/float(np.median(full))
+        report['ranks_match'] = all(np.array_equal(top(a, q), top(f, q))
+                                    for a, f, q in zip(areas, full, queries))
+        report['size_ratio'] = reduced.shape[-1]/points.shape[-1]
+        results.append(report)
+    return results
+
+class PrefixPaths:
+    """The paths of a corpus in prefix-sum form, from which the path of
+    any window of any song can be sampled without rebuilding it: the
+    chord vectors of all songs back to back (vecs, T x K), the beat at
+    which each chord begins within its song, and the beat weighted
+    cumulative sums of each song's vectors (prefix, T x K), so that the
+    unnormalized point reached x beats into a song is prefix[i] + (x -
+    begins[i])*vecs[i] for the chord i sounding at x.  The window of a
+    song starting offset beats into it and lasting length beats has the
+    path (P(offset + s*length) - P(offset))/length over s in [0, 1],
+    which for the whole song is its membrane path (see
+    make_path_samples).  Chords are located with one searchsorted on
+    the end beats of the songs laid end to end, while the sums are kept
+    per song so that their rounding does not grow with the corpus.
+
+    """
+
+    def __init__(self, vecs, beats, offsets):
+        self.vecs = np.asarray(vecs, dtype=float)
+        self.beats = np.asarray(beats, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ends = np.cumsum(self.beats)
+        bounds = np.concatenate([[0.0], self.ends])[self.offsets]
+        self.starts = bounds[:-1]
+        self.lengths = np.diff(bounds)
+        self.begins = np.zeros(len(self.beats))
+        self.prefix = np.zeros(self.vecs.shape)
+        for a, b in zip(self.offsets[:-1], self.offsets[1:]):
+            np.cumsum(self.beats[a:b-1], out=self.begins[a+1:b])
+            np.cumsum(self.beats[a:b-1,None]*self.vecs[a:b-1], axis=0, out=self.prefix[a+1:b])
+
+    @classmethod
+    @ctrace.traced()
+    def from_corpus(cls, corpus, meters, chord_idx, M):
+        """Build the prefix sums of the songs of a corpus (see
+        corpus_song_vecs)
+
+        """
+        songs = [(vecs[:len(meter)], meter) for vecs, meter in corpus_song_vecs(corpus, meters, chord_idx, M)]
+        offsets = np.zeros(len(songs)+1, dtype=np.int64)
+        np.cumsum([len(meter) for vecs, meter in songs], out=offsets[1:])
+        vecs = np.concatenate([vecs for vecs, meter in songs]) if songs else np.zeros((0, M.shape[1]))
+        beats = np.concatenate([np.asarray(meter, dtype=float) for vecs, meter in songs]) if songs else np.zeros(0)
+        return cls(vecs, beats, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def points(self, songs, x):
+        """Return the unnormalized path points (... x K) x beats into the
+        given songs (songs and x broadcast together)
+
+        """
+        songs = np.asarray(songs)
+        i = np.searchsorted(self.ends, self.starts[songs] + x, side='right')
+        i = np.clip(i, self.offsets[songs], self.offsets[songs+1] - 1)
+        return self.prefix[i] + (x - self.begins[i])[...,None]*self.vecs[i]
+
+    def window_points(self, songs, offsets, lengths, samples=None):
+        """Return the (W x S x K) sampled path points of the windows of
+        the given songs starting offsets beats into them and lasting
+        lengths beats
+
+        """
+        if samples is None:
+            samples = membrane_samples()
+        songs = np.asarray(songs)
+        a = np.asarray(offsets, dtype=float)
+        lengths = np.asarray(lengths, dtype=float)
+        points = self.points(songs[:,None], a[:,None] + lengths[:,None]*samples)
+        points -= self.points(songs, a)[:,None]
+        points /= lengths[:,None,None]
+        return points
+
+    def windows(self, window, bar=4, songs=None):
+        """Return the bar aligned windows of window beats in the given
+        songs (all of them by default): the position of each window's
+        song in songs, its offset and its length in beats, and the index
+        of the first window of each song.  bar is the number of beats per
+        bar, for all songs or per song.  A song shorter than the window
+        has one window, the whole song
+
+        """
+        if songs is None:
+            songs = np.arange(len(self))
+        L = self.lengths[songs]
+        bar = np.broadcast_to(np.asarray(bar, dtype=float), L.shape)
+        W = np.minimum(float(window), L)
+        n = np.floor((L - W)/bar + 1e-6).astype(np.int64) + 1
+        first = np.zeros(len(n), dtype=np.int64)
+        np.cumsum(n[:-1], out=first[1:])
+        owner = np.repeat(np.arange(len(n)), n)
+        offset = (np.arange(n.sum()) - first[owner])*bar[owner]
+        return owner, offset, W[owner], first
+
+    def speeds(self):
+        """Return the largest speed of each song's path (see path_speed),
+        which bounds the speed of the path of any of its windows as well
+
+        """
+        norms = np.where(self.beats > 0, np.linalg.norm(self.vecs, axis=1), 0.0)
+        speeds = np.zeros(len(self))
+        nonempty = np.flatnonzero(np.diff(self.offsets) > 0)
+        if len(nonempty):
+            speeds[nonempty] = np.maximum.reduceat(norms, self.offsets[nonempty])
+        return speeds
+
+def window_membrane_areas(query_points, paths, songs, offsets, lengths, samples=None,
+                          weights=None, memory_budget=2**22):
+    """
+    Return the membrane areas between the query's sampled path points
+    (S x K, sampled at samples) and each window of paths (a
+    PrefixPaths) given by its song, offset and length in beats (see
+    PrefixPaths.windows), with the samples weighted by weights if given.
+    The windows are evaluated together, in batches sized to fit
+    memory_budget bytes (small enough to stay in cache)
+    """
+    S, K = np.shape(query_points)
+    chunk = max(1, memory_budget//(8*3*S*K))
+    areas = np.empty(len(songs))
+    for c in range(0, len(songs), chunk):
+        points = paths.window_points(songs[c:c+chunk], offsets[c:c+chunk], lengths[c:c+chunk], samples)
+        if weights is None:
+            areas[c:c+chunk] = membrane_area(points, query_points)
+        else:
+            areas[c:c+chunk] = (np.linalg.norm(points - query_points, axis=-1)*weights).sum(axis=-1)
+    ctrace.count('windows evaluated', len(songs))
+    return areas
+
+def best_windows(areas, owner, first):
+    """
+    Return the smallest area of each song's windows (see
+    PrefixPaths.windows) and the index of the earliest window attaining
+    it
+    """
+    best = np.minimum.reduceat(areas, first)
+    hits = np.flatnonzero(areas == best[owner])
+    return best, hits[np.unique(owner[hits], return_index=True)[1]]
+
+@ctrace.traced()
+def subsequence_membrane_areas(query_points, paths, window, bar=4, samples=None, songs=None,
+                               memory_budget=2**22):
+    """
+    Slide a window of window beats across each of the given songs of
+    paths (a PrefixPaths; all songs by default) at bar aligned offsets
+    and return, per song, the smallest membrane area between the
+    query's sampled path points (S x K, sampled at samples) and a
+    window, and the offset and length in beats of that window
+    """
+    songs = np.arange(len(paths)) if songs is None else np.asarray(songs)
+    owner, offset, length, first = paths.windows(window, bar, songs)
+    areas = window_membrane_areas(query_points, paths, songs[owner], offset, length, samples,
+                                  memory_budget=memory_budget)
+    best, index = best_windows(areas, owner, first)
+    return best, offset[index], length[index]
+
+@ctrace.traced()
+def subsequence_search(query_vecs, query_meter, paths, k=10, window=None, bar=4, section=None,
+                       n_coarse=32, n_samples=MEMBRANE_SAMPLES, margin_scale=1.0,
+                       exclude=(), speeds=None):
+    """
+    Return the k songs of paths (a PrefixPaths) containing the bar
+    aligned windows with the smallest membrane area to the query song,
+    as a list of (song index, offset, length, area) with the window's
+    offset and length in beats.  The query is the whole song, or its
+    section (start, length) in beats if given, and the windows last as
+    many beats as the query unless window is given.  Songs in exclude
+    (such as the query itself) are skipped.
+
+    As in membrane_search, every window of every song is first scored
+    with n_coarse samples, within margin_scale times a provable bound
+    (a window's path is no faster than its song's, see
+    PrefixPaths.speeds, which can be precomputed and passed in).
+    Windows whose lower bound exceeds the k-th smallest per-song upper
+    bound are pruned and the rest are evaluated at n_samples.  Returns
+    the results and a report dict with the number of windows pruned
     """
-    samples = np.linspace(0,1,256)[1:-1]
+    query = PrefixPaths(np.asarray(query_vecs, dtype=float)[:len(query_meter)], query_meter,
+                        [0, len(query_meter)])
+    start, qlen = section if section is not None else (0.0, query.lengths[0])
+    if speeds is None:
+        speeds = paths.speeds()
+    songs = np.setdiff1d(np.arange(len(paths)), np.asarray(exclude, dtype=np.int64))
+    owner, offset, length, first = paths.windows(window or qlen, bar, songs)
 
-    E = 0
-    for s in samples:
-        p1 = vector_point(s, vec1, vals1)
-        p2 = vector_point(s, vec2, vals2)
-        E += np.linalg.norm(p1-p2)
-    return E
+    coarse, weights, D = coarse_sample_plan(n_samples, n_coarse)
+    q_coarse = query.window_points([0], [start], [qlen], coarse)[0]
+    estimate = window_membrane_areas(q_coarse, paths, songs[owner], offset, length, coarse, weights)
+    margin = margin_scale*(speeds[songs[owner]] + query.speeds()[0])*D*(1 + 1e-9)
+    k = min(k, len(songs))
+    upper = np.minimum.reduceat(estimate + margin, first)
+    bound = np.partition(upper, k-1)[k-1]
+    survivors = np.flatnonzero(estimate - margin <= bound)
 
+    fine = membrane_samples(n_samples)
+    q_fine = query.window_points([0], [start], [qlen], fine)[0]
+    areas = window_membrane_areas(q_fine, paths, songs[owner[survivors]], offset[survivors],
+                                  length[survivors], fine)
+    # Renumber the songs with surviving windows consecutively
+    owner = owner[survivors]
+    starts = np.diff(owner, prepend=-1) != 0
+    best, index = best_windows(areas, np.cumsum(starts) - 1, np.flatnonzero(starts))
+    candidates = songs[owner[starts]]
+    index = survivors[index]
+    order = np.lexsort((candidates, best))[:k]
+    results = [(int(candidates[i]), float(offset[index[i]]), float(length[index[i]]), float(best[i]))
+               for i in order]
+    report = {'windows': len(estimate), 'pruned': len(estimate) - len(survivors), 'refined': len(survivors)}
+    return results, report
@@ -0,0 +1,312 @@
+# Benchmarks of the hot paths of the contrafact pipeline, on fixed
+# inputs drawn from the bundled SongDB:
+#
+#   getsong, lemmatize, estimatekey, map2roman, get_beats   (every 10th song file)
+#   each co-occurrence builder                              (the ingested corpus)
+#   make_song_vecs                                          (the ingested corpus)
+#   compute_membrane_area                                   (fixed song pairs)
+#   the full 80 contrafact experiment                       (ingest, M, paths,
+#                                                            areas and ranks)
+#
+# Each benchmark reports its best wall time over --repeat runs, its
+# throughput (songs/s or pairs/s), the peak Python heap memory traced
+# by tracemalloc (measured in a separate run, so it does not inflate
+# the timings; numpy buffers are included but BLAS workspaces and
+# memory maps are not) and the peak RSS of the process so far (a high
+# water mark, so it includes the benchmarks run before).
+#
+# Results can be saved as a baseline JSON file, along with the
+# environment they were measured in (Python and numpy versions, host
+# and platform).  Baselines are machine specific and are not committed.
+# Later runs in the same environment are compared against it: a
+# benchmark whose time grows by more than --threshold (a fraction) is
+# a regression and the run exits with status 1.  A missing baseline
+# file, or a benchmark missing from the baseline, also fails the run
+# (status 2) until the baseline is saved again.  A baseline from a
+# different environment is only shown for reference, with a warning.
+#
+#   python contrafact_benchmark.py --save-baseline
+#   python contrafact_benchmark.py --threshold 0.25
+#   python contrafact_benchmark.py --only getsong lemmatize
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+from ChordProgUtils import getsong, lemmatize, estimatekey, map2roman, get_beats
+import ChordVecUtils as cvu
+import ChordCorpusUtils as ccorp
+import ChordSweepUtils as csu
+import ChordTraceUtils as ctrace
+
+BENCHMARK_BASELINE = 'CONTRAFACT_DATA/benchmark_baseline.json'
+SONG_STRIDE = 10
+MEMBRANE_PAIRS = 500
+
+def benchmark_songs():
+    """The fixed song files of the per-song benchmarks: every
+    SONG_STRIDE-th file of the sorted SongDB listing
+
+    """
+    return sorted(ccorp.list_songdb())[::SONG_STRIDE]
+
+def benchmark_corpus():
+    """The ingested corpus, roman numeral progressions and beats
+
+    """
+    romans, meters, titles, timings = ccorp.ingest_corpus(processes=1)
+    return romans, meters, titles
+
+def benchmark_pairs(N):
+    """MEMBRANE_PAIRS fixed (seeded) pairs of song indices
+
+    """
+    rng = np.random.default_rng(0)
+    return rng.integers(N, size=(MEMBRANE_PAIRS, 2))
+
+# Each benchmark is (name, unit, setup, run): setup builds the fixed
+# inputs once (shared inputs are memoized in _inputs) and returns the
+# argument of run and the number of units it processes
+_inputs = {}
+
+def _memo(name, make):
+    if name not in _inputs:
+        _inputs[name] = make()
+    return _inputs[name]
+
+def _songs():
+    return _memo('songs', lambda: [getsong(f) for f in benchmark_songs()])
+
+def _keyed_songs():
+    def make():
+        return [(estimatekey(s[3][0], s[5])[0][0], s) for s in _songs()]
+    return _memo('keyed', make)
+
+def _romans():
+    return _memo('romans', lambda: [(s[3], map2roman(key, s[5])) for key, s in _keyed_songs()])
+
+def _corpus():
+    return _memo('corpus', benchmark_corpus)
+
+def _model():
+    def make():
+        romans, meters, titles = _corpus()
+        M, chord_idx = cvu.co_occurrence_matrix(romans, 1, compressed=True, dense=True)
+        return cvu.normalize_rows(M), chord_idx
+    return _memo('model', make)
+
+def _setup_getsong():
+    files = benchmark_songs()
+    return files, len(files)
+
+def _run_getsong(files):
+    for f in files:
+        getsong(f)
+
+def _setup_lemmatize():
+    progs = [s[5] for s in _songs()]
+    return progs, len(progs)
+
+def _run_lemmatize(progs):
+    for prog in progs:
+        lemmatize(prog)
+
+def _setup_estimatekey():
+    songs = [(s[3][0], s[5]) for s in _songs()]
+    return songs, len(songs)
+
+def _run_estimatekey(songs):
+    for bpm, prog in songs:
+        estimatekey(bpm, prog)
+
+def _setup_map2roman():
+    songs = [(key, s[5]) for key, s in _keyed_songs()]
+    return songs, len(songs)
+
+def _run_map2roman(songs):
+    for key, prog in songs:
+        map2roman(key, prog)
+
+def _setup_get_beats():
+    romans = _romans()
+    return romans, len(romans)
+
+def _run_get_beats(romans):
+    for timesig, roman in romans:
+        get_beats(timesig, roman)
+
+def _co_occurrence_benchmark(builder):
+    def setup():
+        romans = _corpus()[0]
+        return romans, len(romans)
+    def run(romans):
+        builder(romans)
+    return setup, run
+
+def _setup_make_song_vecs():
+    romans = _corpus()[0]
+    M, chord_idx = _model()
+    return (romans, chord_idx, M), len(romans)
+
+def _run_make_song_vecs(args):
+    romans, chord_idx, M = args
+    for song in romans:
+        cvu.make_song_vecs(song, chord_idx, M)
+
+def _setup_compute_membrane_area():
+    romans, meters, titles = _corpus()
+    M, chord_idx = _model()
+    songs = [(cvu.make_song_vecs(song, chord_idx, M), meter) for song, meter in zip(romans, meters)]
+    pairs = [songs[a] + songs[b] for a, b in benchmark_pairs(len(songs))]
+    return pairs, len(pairs)
+
+def _run_compute_membrane_area(pairs):
+    for vec1, vals1, vec2, vals2 in pairs:
+        cvu.compute_membrane_area(vec1, vals1, vec2, vals2)
+
+def _setup_experiment():
+    df = pd.read_csv(csu.CONTRAFACT_LIST)
+    contrafacts = list(zip(df.contrafacts, df.originals))
+    return contrafacts, len(contrafacts)*len(_corpus()[0])
+
+def _run_experiment(contrafacts):
+    romans, meters, titles, timings = ccorp.ingest_corpus(processes=1)
+    M, chord_idx = cvu.co_occurrence_matrix(romans, 1, compressed=True, dense=True)
+    M = cvu.normalize_rows(M)
+    points = cvu.make_corpus_path_samples(romans, meters, chord_idx, M)
+    cfacts = [titles.index(c) for c, o in contrafacts]
+    areas = cvu.membrane_distance_matrix(points[cfacts], points, dtype=float)
+    return [csu.contrafact_rank(row, c, titles.index(o))
+            for row, c, (cf, o) in zip(areas, cfacts, contrafacts)]
+
+BENCHMARKS = [
+    ('getsong', 'songs', _setup_getsong, _run_getsong),
+    ('lemmatize', 'songs', _setup_lemmatize, _run_lemmatize),
+    ('estimatekey', 'songs', _setup_estimatekey, _run_estimatekey),
+    ('map2roman', 'songs', _setup_map2roman, _run_map2roman),
+    ('get_beats', 'songs', _setup_get_beats, _run_get_beats),
+    ('compute_co_occurrence_matrix', 'songs',
+     *_co_occurrence_benchmark(lambda c: cvu.compute_co_occurrence_matrix(c, 2))),
+    ('compute_compressed_co_occurrence_matrix', 'songs',
+     *_co_occurrence_benchmark(lambda c: cvu.compute_compressed_co_occurrence_matrix(c, 2))),
+    ('compute_causal_co_occurrence_matrix', 'songs',
+     *_co_occurrence_benchmark(lambda c: cvu.compute_causal_co_occurrence_matrix(c, 2))),
+    ('co_occurrence_matrix', 'songs',
+     *_co_occurrence_benchmark(lambda c: cvu.co_occurrence_matrix(c, 1, compressed=True))),
+    ('make_song_vecs', 'songs', _setup_make_song_vecs, _run_make_song_vecs),
+    ('compute_membrane_area', 'pairs', _setup_compute_membrane_area, _run_compute_membrane_area),
+    ('contrafact_experiment', 'pairs', _setup_experiment, _run_experiment),
+]
+
+def run_benchmark(setup, run, repeat=3):
+    """
+    Run one benchmark: its best wall time over repeat runs and the
+    peak Python heap memory traced during one more run (in MiB), plus
+    the number of units processed
+    """
+    args, units = setup()
+    times = []
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        run(args)
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    run(args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), units, peak/2**20
+
+def run_benchmarks(names=None, repeat=3, progress=False):
+    """
+    Run the benchmarks (all of them, or those in names) and return a
+    dict mapping each name to its seconds, units, unit, throughput,
+    traced_mib and peak_rss_mib (None where it cannot be measured)
+    """
+    results = {}
+    for name, unit, setup, run in BENCHMARKS:
+        if names and name not in names:
+            continue
+        if progress:
+            sys.stderr.write('Running {}...\n'.format(name))
+        seconds, units, traced = run_benchmark(setup, run, repeat)
+        results[name] = {'seconds': seconds, 'units': units, 'unit': unit,
+                         'throughput': units/seconds, 'traced_mib': traced,
+                         'peak_rss_mib': ctrace.peak_rss_mib()}
+    return results
+
+def benchmark_environment():
+    """
+    Return the environment benchmarks are measured in: the Python and
+    numpy versions, the host name, the machine type and the platform
+    """
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'host': platform.node(), 'machine': platform.machine(),
+            'platform': platform.platform()}
+
+def compare_benchmarks(results, baseline, threshold=0.25):
+    """
+    Return the names of the benchmarks whose time exceeds the baseline
+    time by more than threshold (a fraction of the baseline)
+    """
+    return [name for name, r in results.items()
+            if name in baseline and r['seconds'] > baseline[name]['seconds']*(1+threshold)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Contrafact pipeline benchmarks')
+    parser.add_argument('--only', nargs='*', default=None, help='run only these benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown as a fraction of the baseline time')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, args.repeat, progress=True)
+    environment = benchmark_environment()
+    try:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline, baseline_environment = saved['results'], saved.get('environment')
+    except FileNotFoundError:
+        if not args.save_baseline:
+            sys.stderr.write('ERROR: no benchmark baseline at {}; nothing can be compared\n'.format(args.baseline))
+        baseline, baseline_environment = {}, environment
+    differences = [k for k in environment if (baseline_environment or {}).get(k) != environment[k]]
+
+    print('-'*108)
+    print('{:<40} {:>10} {:>16} {:>10} {:>10} {:>14}'.format(
+        'Benchmark', 'Time (s)', 'Throughput', 'Heap MiB', 'RSS MiB', 'vs baseline'))
+    print('-'*108)
+    for name, r in results.items():
+        change = ''
+        if name in baseline:
+            change = '{:+.1%}'.format(r['seconds']/baseline[name]['seconds'] - 1)
+        rss = '' if r['peak_rss_mib'] is None else '{:.1f}'.format(r['peak_rss_mib'])
+        print('{:<40} {:>10.4f} {:>10.1f} {:<5} {:>10.2f} {:>10} {:>14}'.format(
+            name, r['seconds'], r['throughput'], r['unit']+'/s', r['traced_mib'], rss, change))
+    print('-'*108)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment': environment, 'results': results}, f, indent=1)
+        print('Saved baseline to', args.baseline)
+    elif differences:
+        sys.stderr.write('WARNING: the baseline was measured in a different environment ({}); '
+                         'the times are not compared (run with --save-baseline here)\n'.format(
+                             ', '.join('{}: {} here, {} in the baseline'.format(
+                                 k, environment[k], (baseline_environment or {}).get(k)) for k in differences)))
+    else:
+        regressions = compare_benchmarks(results, baseline, args.threshold)
+        for name in regressions:
+            print('Regression: {} is {:.1%} slower than the baseline'.format(
+                name, results[name]['seconds']/baseline[name]['seconds'] - 1))
+        missing = [name for name in results if name not in baseline]
+        for name in missing:
+            print('Missing baseline: {} was not compared (run with --save-baseline)'.format(name))
+        if regressions:
+            sys.exit(1)
+        if missing:
+            sys.exit(2)
@@ -10,13 +10,18 @@
 #   Membrane Area. In Proceedings of the International Society for
 #   Music Information Retrieval Conference (ISMIR), Milan, Italy, 2023.
 
-import os
-import sys
-import re
 import numpy as np
 import pandas as pd
-from ChordProgUtils import *
 import ChordVecUtils as cvu
+import ChordCacheUtils as ccu
+import ChordCorpusUtils as ccorp
+import ChordTraceUtils as ctrace
+import ChordResultUtils as cru
+
+# Set CONTRAFACT_TRACE=<file> to record per-stage timers, counters and
+# peak memory (CONTRAFACT_TRACE_FORMAT=chrome for a Chrome trace,
+# CONTRAFACT_TRACE_MEMORY=1 for tracemalloc snapshots)
+trace_path = ctrace.enable_from_env()
 
 ################################################################################
 # Read in the curated list of contrafacts (and their corresponding
@@ -34,7 +39,9 @@ Ncontrafacts = len(contrafacts)
 
 ################################################################################
 # Read in all the chord progression data
-# NB: Songs are split across three subdirectories
+# NB: Songs are split across three subdirectories.  They are read from
+# a compiled binary store, which is rebuilt whenever a song file changes
+# (see ChordCorpusUtils.py compile-corpus and ingest_corpus)
 ################################################################################
 songdb_paths = ['../SongDB/Songs[#,A-G]', '../SongDB/Songs[H-O]', '../SongDB/Songs[P-Z]']
 
@@ -43,23 +50,12 @@ songdb_paths = ['../SongDB/Songs[#,A-G]', '../SongDB/Songs[H-O]', '../SongDB/Son
 # notation.  This requires key estimation.  The entire corpus is
 # structured into lists for the progressions (corpus_romans), the
 # number of beats (corpus_meters) for each chord, and the song titles
-# (corpus_titles).
+# (corpus_titles).  The songs are spread across a pool of processes.
 ################################################################################
 
-corpus_romans = []
-corpus_titles = []
-corpus_meters = []
-for sdb in songdb_paths:
-    files = os.listdir(sdb)
-    for f in files:
-        song_name, composer, dbkey, timesig, nbars, progression = getsong(sdb+'/'+f)
-        ranked_keys = estimatekey(timesig[0], progression)
-        bestkey = ranked_keys[0][0]
-        roman_prog = map2roman(bestkey, progression)
-        beats = get_beats(timesig, roman_prog)
-        corpus_romans.append(['<START>'] + strip_bars(roman_prog) + ['<END>'])
-        corpus_meters.append([0] + beats + [0])
-        corpus_titles.append(f)
+with ctrace.stage('ingest'):
+    corpus_romans, corpus_meters, corpus_titles, ingest_timings = ccorp.ingest_corpus(songdb_paths, progress=True)
+ctrace.snapshot('ingest')
 
 ################################################################################
 # As per equation (1) in the paper cited above, compute the
@@ -72,14 +68,26 @@ for sdb in songdb_paths:
 win_size = 1
 causal = False
 cmpress = True
-if causal == True:
-    M, chord_idx = cvu.compute_causal_co_occurrence_matrix(corpus_romans, win_size)
-elif cmpress == True:
-    M, chord_idx = cvu.compute_compressed_co_occurrence_matrix(corpus_romans, win_size)
-else:
-    M, chord_idx = cvu.compute_co_occurrence_matrix(corpus_romans, win_size)
+n_samples = cvu.MEMBRANE_SAMPLES
+exact_area = False    # integrate the membrane area exactly instead of sampling it (an offline check, ~100x slower)
+export_text = True    # also write the results as the per-contrafact text files in EXPERIMENTAL_RESULTS
+embedding = None      # project the chord vectors keeping this energy (1.0 = exact)
+cmpress = cmpress and not causal    # causal matrices are always built from the raw progressions
+with ctrace.stage('co-occurrence', win_size=win_size, causal=causal, cmpress=cmpress):
+    M, chord_idx = cvu.co_occurrence_matrix(corpus_romans, win_size, causal=causal,
+                                            compressed=cmpress, dense=True)
         
-M = np.array([[item/np.linalg.norm(row) for item in row] for row in M])
+    M = np.array([[item/np.linalg.norm(row) for item in row] for row in M])
+
+################################################################################
+# Optionally express the chord vectors in an orthonormal basis of the
+# row space of M (truncated to the leading singular directions holding
+# the given energy).  Membrane areas only depend on distances within
+# that space, so the paths shrink to the effective rank of M.
+################################################################################
+if embedding is not None:
+    M, basis, embedding_report = cvu.project_rows(M, embedding)
+    print('Projected chord vectors to', embedding_report['dims'], 'of', len(M), 'dimensions')
 
 ranks = []
 rank_areas = []
@@ -91,9 +99,44 @@ print('{:^5} {:<34} {:<33} {:>5}'.format('#/N','Contrafact File','Original File'
 print('-'*80)
 
 ################################################################################
-# For each contrafact, compute the membrane area between it and each
-# of the other songs in the corpus
+# Each song's piecewise linear path is sampled once, giving an (S x K)
+# matrix of points per song.  The membrane area between two songs is
+# then a row-wise norm of the difference of their sample matrices.
+# The samples are cached on disk (keyed by the corpus content and the
+# co-occurrence configuration) and memory-mapped on later runs.
 ################################################################################
+with ctrace.stage('paths', n_samples=n_samples):
+    corpus_points = ccu.cached_corpus_path_samples(corpus_romans, corpus_meters, corpus_titles,
+                                                   chord_idx, M, win_size, causal, cmpress,
+                                                   n_samples=n_samples, embedding=embedding)
+ctrace.snapshot('paths')
+
+################################################################################
+# Compute the membrane area between each contrafact and each of the
+# other songs in the corpus with a single call (one row per contrafact).
+# With exact_area the area is integrated in closed form over the merged
+# chord change positions of each pair of songs instead.  This is an
+# offline check of the sampled areas and takes minutes rather than
+# seconds (see exact_membrane_areas)
+################################################################################
+cfact_corpus_indices = [corpus_titles.index(c) for c in contrafacts]
+with ctrace.stage('membrane areas', exact=exact_area):
+    if exact_area:
+        corpus_breakpoints = cvu.make_corpus_breakpoints(corpus_romans, corpus_meters, chord_idx, M)
+        cfact_areas = np.array([cvu.exact_membrane_areas(corpus_breakpoints[k], corpus_breakpoints)
+                                for k in cfact_corpus_indices])
+    else:
+        cfact_areas = cvu.membrane_distance_matrix(corpus_points[cfact_corpus_indices], corpus_points, dtype=float)
+ctrace.snapshot('membrane areas')
+
+################################################################################
+# The ranked areas of every contrafact are collected into one columnar,
+# memory-mapped file (see ChordResultUtils.py): a background thread
+# copies each contrafact's rows into place while the next ones are
+# ranked, and flushes the file every 16 contrafacts
+################################################################################
+writer = cru.ResultWriter(cru.RESULTS_FILE, corpus_titles, Ncontrafacts)
+
 for cfact_num, cfact_file in enumerate(contrafacts):
     # cfact_num is the index of the contrafact in the contrafact list
     # and cfact_file is the filename containing the data of that contrafact
@@ -105,22 +148,9 @@ for cfact_num, cfact_file in enumerate(contrafacts):
     # contrafact in the corpus 
     orig_corpus_index = corpus_titles.index(orig_file)
     cfact_corpus_index = corpus_titles.index(cfact_file)
-    cfact_title = corpus_titles[cfact_corpus_index]
-    cfact_roman = corpus_romans[cfact_corpus_index]
-    cfact_meter = corpus_meters[cfact_corpus_index]
-    cfact_vecs = cvu.make_song_vecs(cfact_roman, chord_idx, M)
-
-    areas = []
-    for k in range(len(corpus_romans)):
-        test_title = corpus_titles[k]
-        if test_title == cfact_title:
-            areas.append(-1)           # test is same as contrafact
-            continue
-        test_roman = corpus_romans[k]
-        test_meter = corpus_meters[k]
-        test_vecs = cvu.make_song_vecs(test_roman, chord_idx, M)
-        area_k = cvu.compute_membrane_area(cfact_vecs, cfact_meter, test_vecs, test_meter)
-        areas.append(area_k)
+
+    areas = [float(a) for a in cfact_areas[cfact_num]]
+    areas[cfact_corpus_index] = -1     # test is same as contrafact
 
     # Find and save the rank of the original in the list of sorted
     # areas (and output it)
@@ -140,12 +170,18 @@ for cfact_num, cfact_file in enumerate(contrafacts):
 # Save data 
 ################################################################################
 
-    fname = str(adjusted_rank).zfill(4)+'__'+orig_file.split('.')[0]+'__'+cfact_file
-    f = open('EXPERIMENTAL_RESULTS/'+fname, 'w')
-    for d, i in enumerate(sorted_idx_by_area):
-        title_i = corpus_titles[i].split('.')[0]
-        f.write(str(d) + '\t' + str(areas[i]) + '\t' + title_i + '\n')
-    f.close()
+    writer.add(cfact_corpus_index, orig_corpus_index, adjusted_rank, sorted_idx_by_area, areas)
+
+writer.close()
+
+writer.join()
+if export_text:
+    cru.export_text(cru.load_results(cru.RESULTS_FILE), cru.RESULTS_DIR)
+
+if trace_path:
+    ctrace.snapshot('done')
+    ctrace.write_trace(trace_path)
+    print('Wrote trace to', trace_path)
 
 ################################################################################
 # Output histogram and performance stats
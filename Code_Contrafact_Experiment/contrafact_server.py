@@ -0,0 +1,385 @@
+# Resident similarity query server for the jazz chord progression
+# corpus.  The corpus is ingested, the co-occurrence matrix is built
+# and the sampled song paths are loaded (from the path cache) once, and
+# membrane area queries are then answered over HTTP on a local TCP port
+# or Unix socket:
+#
+#   GET /similarity?a=<file>&b=<file>   membrane area between two songs
+#   GET /topk?song=<file>&k=10          the k songs nearest to a song
+#   GET /song?song=<file>               metadata and roman numeral progression
+#   GET /search?q=<terms>&k=10          songs best matching the terms by title or composer
+#   GET /stats                          request, batch and latency counters
+#
+# Songs are named by their SongDB file name (with or without .txt).
+# Similarity and top-k requests arriving within a short window are
+# answered together: all top-k queries of the window are computed with
+# one membrane_distance_matrix call and all similarity pairs with one
+# vectorized membrane_area call.
+#
+#   python contrafact_server.py serve --port 8765
+#   python contrafact_server.py serve --unix /tmp/contrafact.sock
+#   python contrafact_server.py selftest
+#
+# selftest starts the server on a free local port, sends every
+# contrafact of CONTRAFACT_DATA as a concurrent top-k and similarity
+# request, checks the answers against a direct computation, searches
+# for every original by file name and prints the counters.  It needs nothing but the bundled SongDB.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pandas as pd
+import ChordVecUtils as cvu
+import ChordCacheUtils as ccu
+import ChordCorpusUtils as ccorp
+
+ENDPOINTS = ('/similarity', '/topk', '/song', '/search', '/stats')
+
+class QueryError(Exception):
+    """A request that cannot be answered, with its HTTP status
+
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class SimilarityService:
+    """The corpus, co-occurrence matrix and sampled song paths, loaded
+    once, and the (synchronous) computations behind every endpoint
+
+    """
+
+    def __init__(self, songdb_paths=ccorp.SONGDB_PATHS, win_size=1, causal=False, cmpress=True,
+                 n_samples=cvu.MEMBRANE_SAMPLES, processes=None):
+        romans, meters, titles, timings = ccorp.ingest_corpus(songdb_paths, processes)
+        cmpress = cmpress and not causal
+        M, chord_idx = cvu.co_occurrence_matrix(romans, win_size, causal=causal,
+                                                compressed=cmpress, dense=True)
+        M = cvu.normalize_rows(M)
+        self.romans = romans
+        self.titles = titles
+        self.store = ccorp.open_corpus_store(songdb_paths)
+        self.index = ccorp.SongIndex.open(songdb_paths)
+        self.points = ccu.cached_corpus_path_samples(romans, meters, titles, chord_idx, M,
+                                                     win_size, causal, cmpress, n_samples=n_samples)
+        self.title_idx = {}
+        for k, t in enumerate(titles):
+            self.title_idx[t] = k
+            self.title_idx[os.path.splitext(t)[0]] = k
+
+    def song_index(self, song):
+        if song not in self.title_idx:
+            raise QueryError(404, 'Unknown song: ' + song)
+        return self.title_idx[song]
+
+    def song(self, k):
+        meta = dict(self.store.songs[k])
+        meta['roman'] = self.romans[k][1:-1]
+        return meta
+
+    def search(self, terms, k=10):
+        results = []
+        for j, score in self.index.search(terms, k):
+            song = self.index.song(j)
+            song['score'] = score
+            results.append(song)
+        return results
+
+    def answer(self, topk, pairs):
+        """Answer a batch of top-k queries, given as (song index, k), and
+        similarity queries, given as (song index, song index).  Returns
+        the list of top-k results, each a list of (file, area) nearest
+        first excluding the query song, and the array of pair areas
+
+        """
+        results = []
+        if topk:
+            queries = sorted({q for q, k in topk})
+            rows = dict(zip(queries, cvu.membrane_distance_matrix(self.points[queries], self.points, dtype=float)))
+            order = np.arange(len(self.titles))
+            for q, k in topk:
+                areas = rows[q].copy()
+                areas[q] = np.inf
+                best = np.lexsort((order, areas))[:k]
+                results.append([(self.titles[j], float(areas[j])) for j in best])
+        areas = np.zeros(0)
+        if pairs:
+            a, b = np.array(pairs).T
+            areas = cvu.membrane_area(self.points[a], self.points[b])
+        return results, areas
+
+class QueryBatcher:
+    """Collects top-k and similarity queries and answers them in
+    batches.  A batch is started by the first query to arrive and
+    closed window seconds later (or at max_batch queries); it is then
+    computed in a worker thread while the next batch fills up
+
+    """
+
+    def __init__(self, service, window=0.005, max_batch=256):
+        self.service = service
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.batched_queries = 0
+
+    async def submit(self, kind, args):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((kind, args, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            topk = [item for item in batch if item[0] == 'topk']
+            pairs = [item for item in batch if item[0] == 'similarity']
+            try:
+                results, areas = await loop.run_in_executor(None, self.service.answer,
+                                                            [item[1] for item in topk],
+                                                            [item[1] for item in pairs])
+            except Exception as e:
+                for item in batch:
+                    item[2].set_exception(e)
+                continue
+            for item, result in zip(topk, results):
+                item[2].set_result(result)
+            for item, area in zip(pairs, areas):
+                item[2].set_result(float(area))
+            self.batches += 1
+            self.batched_queries += len(batch)
+
+class ServerStats:
+    """Request counters and the latencies of the most recent requests
+
+    """
+
+    def __init__(self, recent=10000):
+        self.started = time.time()
+        self.requests = {}
+        self.errors = 0
+        self.latencies = deque(maxlen=recent)
+
+    def record(self, endpoint, latency, ok):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        self.errors += not ok
+        self.latencies.append(latency)
+
+    def report(self, batcher):
+        uptime = time.time() - self.started
+        total = sum(self.requests.values())
+        lat = np.array(self.latencies)*1000
+        report = {'uptime_s': uptime, 'requests': dict(self.requests), 'errors': self.errors,
+                  'throughput_rps': total/uptime if uptime > 0 else 0.0,
+                  'batches': batcher.batches,
+                  'mean_batch_size': batcher.batched_queries/batcher.batches if batcher.batches else 0.0}
+        if len(lat):
+            report['latency_ms'] = {'mean': float(lat.mean()), 'p50': float(np.percentile(lat, 50)),
+                                    'p95': float(np.percentile(lat, 95)), 'max': float(lat.max())}
+        return report
+
+class SimilarityServer:
+    """HTTP front end: parses GET requests, dispatches them to the
+    service (through the batcher for membrane area queries) and writes
+    JSON responses.  One request per connection
+
+    """
+
+    def __init__(self, service, window=0.005, max_batch=256):
+        self.service = service
+        self.batcher = QueryBatcher(service, window, max_batch)
+        self.stats = ServerStats()
+
+    async def dispatch(self, endpoint, params):
+        def param(name, default=None):
+            if name in params:
+                return params[name][0]
+            if default is None:
+                raise QueryError(400, 'Missing parameter: ' + name)
+            return default
+
+        def count_param():
+            N = len(self.service.titles)
+            try:
+                k = int(param('k', '10'))
+            except ValueError:
+                raise QueryError(400, 'k must be an integer')
+            if not 1 <= k <= N:
+                raise QueryError(400, 'k must be between 1 and {}'.format(N))
+            return k
+
+        if endpoint == '/similarity':
+            a = self.service.song_index(param('a'))
+            b = self.service.song_index(param('b'))
+            area = await self.batcher.submit('similarity', (a, b))
+            return {'a': self.service.titles[a], 'b': self.service.titles[b], 'area': area}
+        elif endpoint == '/topk':
+            q = self.service.song_index(param('song'))
+            k = count_param()
+            result = await self.batcher.submit('topk', (q, k))
+            return {'song': self.service.titles[q],
+                    'results': [{'song': t, 'area': a} for t, a in result]}
+        elif endpoint == '/song':
+            return self.service.song(self.service.song_index(param('song')))
+        elif endpoint == '/search':
+            return {'songs': self.service.search(param('q'), count_param())}
+        elif endpoint == '/stats':
+            return self.stats.report(self.batcher)
+        raise QueryError(404, 'Unknown endpoint: ' + endpoint)
+
+    async def handle(self, reader, writer):
+        t0 = time.perf_counter()
+        endpoint = None
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                raise QueryError(405, 'Only GET requests are supported')
+            url = urlsplit(parts[1])
+            endpoint = url.path
+            status, body = 200, await self.dispatch(endpoint, parse_qs(url.query))
+        except QueryError as e:
+            status, body = e.status, {'error': str(e)}
+        except Exception as e:
+            status, body = 500, {'error': repr(e)}
+
+        data = json.dumps(body).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, 'OK' if status == 200 else 'Error', len(data)).encode())
+        writer.write(data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        if endpoint is not None:
+            self.stats.record(endpoint if endpoint in ENDPOINTS else 'other',
+                              time.perf_counter() - t0, status == 200)
+
+    async def start(self, host='127.0.0.1', port=8765, unix=None):
+        self.batch_task = asyncio.create_task(self.batcher.run())
+        if unix is not None:
+            return await asyncio.start_unix_server(self.handle, path=unix)
+        return await asyncio.start_server(self.handle, host, port)
+
+async def http_get(path, host='127.0.0.1', port=8765, unix=None):
+    """Send a GET request to the server and return (status, decoded
+    JSON body)
+
+    """
+    if unix is not None:
+        reader, writer = await asyncio.open_unix_connection(unix)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, host).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b'\r\n\r\n', 1)
+    return int(head.split()[1]), json.loads(body)
+
+async def serve(args):
+    service = SimilarityService(processes=args.processes)
+    server = SimilarityServer(service, args.window_ms/1000, args.max_batch)
+    listener = await server.start(args.host, args.port, args.unix)
+    where = args.unix if args.unix is not None else '{}:{}'.format(args.host, args.port)
+    print('Serving', len(service.titles), 'songs on', where, flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+async def selftest(args):
+    from urllib.parse import quote
+    service = SimilarityService(processes=args.processes)
+    server = SimilarityServer(service, args.window_ms/1000, args.max_batch)
+    listener = await server.start('127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    df = pd.read_csv('CONTRAFACT_DATA/contrafact_list.csv')
+    pairs = list(zip(df.contrafacts, df.originals))
+    requests = (['/topk?song={}&k=10'.format(quote(c)) for c, o in pairs] +
+                ['/similarity?a={}&b={}'.format(quote(c), quote(o)) for c, o in pairs])
+    t0 = time.perf_counter()
+    responses = await asyncio.gather(*[http_get(r, port=port) for r in requests])
+    elapsed = time.perf_counter() - t0
+
+    failures = 0
+    points = service.points
+    for (c, o), (status, body) in zip(pairs, responses[:len(pairs)]):
+        q = service.song_index(c)
+        areas = cvu.membrane_areas(points[q], points)
+        areas[q] = np.inf
+        best = np.lexsort((np.arange(len(areas)), areas))[:10]
+        expected = [service.titles[j] for j in best]
+        if status != 200 or [r['song'] for r in body['results']] != expected:
+            failures += 1
+            print('Mismatch: /topk', c)
+    for (c, o), (status, body) in zip(pairs, responses[len(pairs):]):
+        area = cvu.membrane_area(points[service.song_index(c)], points[service.song_index(o)])
+        if status != 200 or not np.isclose(body['area'], area, rtol=1e-9):
+            failures += 1
+            print('Mismatch: /similarity', c, o)
+    searches = await asyncio.gather(*[http_get('/search?q={}&k=1'.format(quote(o)), port=port)
+                                      for c, o in pairs])
+    for (c, o), (status, body) in zip(pairs, searches):
+        if status != 200 or [s['file'] for s in body['songs']] != [o]:
+            failures += 1
+            print('Mismatch: /search', o)
+    status, body = await http_get('/topk?song=NoSuchSong', port=port)
+    if status != 404:
+        failures += 1
+        print('Unknown song returned status', status)
+    bad_k = ['/topk?song={}&k={}'.format(quote(pairs[0][0]), k) for k in (0, -1, len(service.titles)+1)]
+    bad_k += ['/search?q={}&k={}'.format(quote(pairs[0][1]), k) for k in (0, -1)]
+    for r, (status, body) in zip(bad_k, await asyncio.gather(*[http_get(r, port=port) for r in bad_k])):
+        if status != 400:
+            failures += 1
+            print('Out of range k returned status', status, r)
+
+    status, stats = await http_get('/stats', port=port)
+    listener.close()
+    await listener.wait_closed()
+    print('{} requests in {:.3f} s'.format(len(requests), elapsed))
+    print(json.dumps(stats, indent=2))
+    total = len(requests) + len(searches) + 1 + len(bad_k)
+    print(total - failures, 'of', total, 'responses correct')
+    return failures == 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Membrane area similarity query server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help in (('serve', 'load the corpus and serve queries'),
+                       ('selftest', 'serve on a free local port and check concurrent queries')):
+        p = subparsers.add_parser(name, help=help)
+        p.add_argument('--window-ms', type=float, default=5.0, help='batching window')
+        p.add_argument('--max-batch', type=int, default=256)
+        p.add_argument('--processes', type=int, default=None, help='ingest processes')
+        if name == 'serve':
+            p.add_argument('--host', default='127.0.0.1')
+            p.add_argument('--port', type=int, default=8765)
+            p.add_argument('--unix', default=None, help='serve on this Unix socket instead')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        asyncio.run(serve(args))
+    elif args.command == 'selftest':
+        if not asyncio.run(selftest(args)):
+            sys.exit(1)
@@ -0,0 +1,50 @@
+import os
+import json
+import pytest
+from ChordProgUtils import getsong, lemmatize, lemmatize_batch, LEMMATIZER_CHECKS
+
+# Run with pytest from any directory; the SongDB paths are relative to
+# this file rather than to the working directory
+HERE = os.path.dirname(os.path.abspath(__file__))
+SONGDB = os.path.join(HERE, '..', 'SongDB')
+SONGDB_PATHS = [os.path.join(SONGDB, d) for d in ('Songs[#,A-G]', 'Songs[H-O]', 'Songs[P-Z]')]
+
+# Output of the original regex lemmatizer (before the chord symbol
+# table) for LEMMATIZER_CHECKS and every 10th song of the sorted SongDB
+# listing, keyed by the song's path relative to SongDB
+LEMMATIZE_GOLDEN = os.path.join(HERE, 'CONTRAFACT_DATA', 'lemmatize_golden.json')
+
+with open(LEMMATIZE_GOLDEN) as f:
+    GOLDEN = json.load(f)
+
+def corpus_progressions():
+    """Return the file names and chord progressions of every song in SongDB
+
+    """
+    files = sorted(os.path.join(sdb, f) for sdb in SONGDB_PATHS for f in os.listdir(sdb))
+    return [os.path.basename(f) for f in files], [getsong(f)[5] for f in files]
+
+@pytest.mark.parametrize('progression', LEMMATIZER_CHECKS)
+def test_lemmatize_batch_edge_cases(progression):
+    assert lemmatize_batch([progression]) == [lemmatize(progression)]
+
+def test_lemmatize_batch_corpus():
+    files, progressions = corpus_progressions()
+    assert len(files) == 2614
+    fast = lemmatize_batch(progressions)
+    bad = [f for f, p, q in zip(files, progressions, fast) if lemmatize(p) != q]
+    assert bad == []
+
+def test_lemmatize_golden_checks():
+    assert [p for p, lemmas in GOLDEN['checks']] == LEMMATIZER_CHECKS
+    for progression, lemmas in GOLDEN['checks']:
+        assert lemmatize(progression) == lemmas
+        assert lemmatize_batch([progression]) == [lemmas]
+
+def test_lemmatize_golden_corpus():
+    files = sorted(GOLDEN['songs'])
+    progressions = [getsong(os.path.join(SONGDB, f))[5] for f in files]
+    fast = lemmatize_batch(progressions)
+    bad = [f for f, p, q in zip(files, progressions, fast)
+           if lemmatize(p) != GOLDEN['songs'][f] or q != GOLDEN['songs'][f]]
+    assert bad == []